@@ -7,13 +7,49 @@
 #     4. You have valid flow
 
 import pytest
+import numpy as np
+import json
+import os
+import threading
+import time
+import types
+
+import requests
 
 from ximilar.client.constants import *
+from ximilar.client.constants import _ID
 from ximilar.client.recognition import RecognitionClient, Image, Label, Task
 from ximilar.client.detection import DetectionClient, DetectionObject, DetectionLabel, DetectionTask
 from ximilar.client.tagging import FashionTaggingClient, GenericTaggingClient
 from ximilar.client.colors import DominantColorProductClient, DominantColorGenericClient
-from ximilar.client.flows import FlowsClient
+from ximilar.client.flows import FlowsClient, FlowRegistry
+from ximilar.client.asyncr import (
+    AsyncRClient,
+    AsynchronousRequest,
+    AsyncRequestScheduler,
+    WebhookReceiver,
+    SHARED_SCHEDULERS,
+)
+from ximilar.client.search import SimilarityPhotosClient
+from ximilar.client.removebg import RemoveBGClient
+from ximilar.client.upscaler import UpscaleClient
+from ximilar.client.utils.metrics import MetricsRegistry
+from ximilar.client.utils.singleflight import SingleFlight
+from ximilar.client.utils.entity_cache import EntityCache
+from ximilar.client.utils.result_cache import ResultCache
+from ximilar.client.utils.dedup import DedupIndex
+from ximilar.client.utils.workspace_index import WorkspaceIndex
+from ximilar.client.utils.collection_export import CollectionExporter, read_export
+from ximilar.client.utils.collection_sync import CollectionSync
+from ximilar.client.utils.vector_index import VectorIndex
+from ximilar.client.utils.dominant_colors import DominantColors, DominantColorsAggregator
+from ximilar.client.utils.tiling import TileStitcher
+from ximilar.client.utils.crops import CropPipeline
+from ximilar.client.utils.output_sink import DirectorySink, OutputPipeline, OUTPUT_PATHS
+from ximilar.client.utils.resize import letterbox, letterbox_batch, resize_batch
+from ximilar.client.utils.base64_data import base64_payload, decode_base64, encode_base64
+from ximilar.client.utils.image_probe import probe_base64
+from ximilar.client.utils.encoding import EncodingPolicy
 
 TASK_NAME = "Test-Task-In-Vize-X-1"
 LABEL_NAME = "Test-Task-In-Vize-Label-X-1"
@@ -357,3 +393,934 @@ def test_17_test_flow(request):
             assert RECORDS in result and len(result[RECORDS]) > 0
             assert "type" in json_flow and "id" in json_flow
             break
+
+
+def test_18_metrics_registry(request):
+    """
+    Test recording of the request metrics and export to prometheus format.
+    """
+    registry = MetricsRegistry()
+    events = []
+    registry.add_listener(events.append)
+
+    registry.record_request("GET", "recognition/v2/task/0b9a8a9e-1111-4222-8333-123456789abc/?page=1", 0.2, 0, 100, 200)
+    registry.record_request("POST", "recognition/v2/classify/", 1.5, 2000, 300, 500)
+    registry.record_retry("POST", "recognition/v2/classify/")
+
+    snapshot = registry.snapshot()
+    text = registry.to_prometheus()
+
+    assert len(events) == 3
+    assert [stats["endpoint"] for stats in snapshot["endpoints"]] == [
+        "recognition/v2/task/{id}",
+        "recognition/v2/classify",
+    ]
+    assert snapshot["endpoints"][1]["errors"] == 1 and snapshot["endpoints"][1]["retries"] == 1
+    assert 'ximilar_client_bytes_sent_total{method="POST",endpoint="recognition/v2/classify"} 2000' in text
+    assert (
+        'ximilar_client_request_latency_seconds_bucket{method="GET",endpoint="recognition/v2/task/{id}",le="0.25"} 1'
+        in text
+    )
+
+
+def test_19_single_flight(request):
+    """
+    Test that concurrent identical calls share one call and get their own copy of result.
+    """
+    flights, calls, results = SingleFlight(), [], []
+
+    def slow_call():
+        calls.append(1)
+        time.sleep(0.2)
+        return {"id": "__ID__"}
+
+    threads = [threading.Thread(target=lambda: results.append(flights.do("key", slow_call))) for i in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert len(results) == 5 and sum(shared for _, shared in results) == 4
+    assert len(set(id(result) for result, _ in results)) == 5
+    assert flights.in_flight() == 0
+
+    # callers coming after forget (e.g. after some write) do not join the call which is already in flight
+    first = threading.Thread(target=lambda: results.append(flights.do("key", slow_call)))
+    first.start()
+    time.sleep(0.05)
+    flights.forget()
+    second = threading.Thread(target=lambda: results.append(flights.do("key", slow_call)))
+    second.start()
+    time.sleep(0.05)
+    first.join()
+    assert flights.in_flight() == 1
+    second.join()
+
+    assert len(calls) == 3
+    assert not any(shared for _, shared in results[5:])
+    assert flights.in_flight() == 0
+
+
+def test_20_entity_cache(request):
+    """
+    Test name index, lists and precise invalidation of the entity cache.
+    """
+    cache, ns = EntityCache(ttl=60), ("endpoint", "token")
+    cache.put(ns, "label", {ID: "1", NAME: "cat"}, scope="ws")
+    cache.put(ns, "label", {ID: "2", NAME: "dog"}, scope="ws")
+    cache.set_complete(ns, "label", "ws")
+    cache.put_list(ns, ("task", "T", LABELS), "label", ["1", "2"])
+
+    assert cache.find_by_name(ns, "label", "ws", "cat") == (["1"], True)
+    assert cache.find_by_name(ns, "label", "ws", "bird") == ([], True)
+    assert len(cache.get_list(ns, ("task", "T", LABELS))) == 2
+
+    # modified entity keeps its name index, but lists containing it must be downloaded again
+    cache.invalidate(ns, "label", "1")
+    assert cache.get(ns, "label", "1") is None and cache.find_by_name(ns, "label", "ws", "cat")[0] == ["1"]
+    assert cache.get_list(ns, ("task", "T", LABELS)) is None
+
+    # renamed and deleted entities
+    cache.put(ns, "label", {ID: "1", NAME: "kitten"}, scope="ws")
+    cache.remove(ns, "label", "2")
+    assert cache.find_by_name(ns, "label", "ws", "cat")[0] == []
+    assert cache.find_by_name(ns, "label", "ws", "kitten")[0] == ["1"]
+    assert cache.find_by_name(ns, "label", "ws", "dog")[0] == [] and cache.get(ns, "label", "2") is None
+
+
+def test_21_workspace_index(request, tmp_path):
+    """
+    Test local index of workspace labels and tasks.
+    """
+    client = get_recognition_client(request)
+    index = client.get_workspace_index(path=str(tmp_path / "index.sqlite3"))
+    labels, status = client.get_all_labels()
+    tasks, status = client.get_all_tasks()
+
+    assert index.age() < 60
+    assert sorted(label.id for label in index.get_labels()) == sorted(label.id for label in labels)
+    assert sorted(task.id for task in index.get_tasks()) == sorted(task.id for task in tasks)
+    if len(tasks):
+        task_labels, status = tasks[0].get_labels()
+        assert sorted(l.id for l in index.get_labels(task_id=tasks[0].id)) == sorted(l.id for l in task_labels)
+
+
+def test_22_result_cache(request):
+    """
+    Test that only the records missing in the result cache are sent.
+    """
+    cache, sent = ResultCache(max_size=10), []
+
+    def send(records):
+        sent.append(len(records))
+        return {
+            RECORDS: [dict(record, best_label={NAME: record[URL]}) for record in records],
+            STATUS: {"code": 200, "text": "OK"},
+        }
+
+    cache.process([{URL: "a"}, {URL: "b"}], ("task", 1), send)
+    result = cache.process([{URL: "b"}, {URL: "c"}, {URL: "a"}], ("task", 1), send)
+    assert sent == [2, 1]
+    assert [record["best_label"][NAME] for record in result[RECORDS]] == ["b", "c", "a"]
+
+    # new version of the model has its own results
+    cache.process([{URL: "a"}], ("task", 2), send)
+    assert sent == [2, 1, 1]
+
+    # same image in one batch is sent once and every duplicate gets the result with its own fields
+    result = cache.process([{URL: "d", _ID: "1"}, {URL: "e"}, {URL: "d", _ID: "2"}, {URL: "a"}], ("task", 2), send)
+    assert sent == [2, 1, 1, 2]
+    assert [record.get(_ID) for record in result[RECORDS]] == ["1", None, "2", None]
+    assert [record["best_label"][NAME] for record in result[RECORDS]] == ["d", "e", "d", "a"]
+
+    # version of the cache key is sent with the request
+    client = RecognitionClient("__TOKEN__", endpoint="http://localhost/")
+    client.result_cache, calls = ResultCache(max_size=10), []
+    client.get_task = lambda task_id: (types.SimpleNamespace(production_version=3), RESULT_OK)
+    client.post = lambda api_endpoint, data=None, **kwargs: calls.append(data) or send(data[RECORDS])
+
+    client.classify_records([{URL: "a"}], "task")
+    client.classify_records([{URL: "a"}], "task")
+    assert [data[VERSION] for data in calls] == [3]
+
+
+def test_23_dedup_index(request):
+    """
+    Test filtering of exact and near duplicate records.
+    """
+    image = np.zeros((120, 160, 3), dtype=np.uint8)
+    image[30:90, 40:80] = 255
+    other = np.zeros((120, 160, 3), dtype=np.uint8)
+    other[10:50, 90:150] = 255
+
+    index = DedupIndex(threshold=6)
+    records = [
+        {"_id": "1", IMG_DATA: image},
+        {"_id": "2", IMG_DATA: image.copy()},
+        {"_id": "3", IMG_DATA: np.clip(image.astype(int) + 10, 0, 255).astype(np.uint8)},
+        {"_id": "4", IMG_DATA: other},
+        {URL: "http://image"},
+        {URL: "http://image"},
+        {"_id": "5"},
+    ]
+    unique, duplicates = index.filter(records)
+
+    assert [record.get("_id") for record in unique] == ["1", "4", None, "5"]
+    assert index.duplicates == [("2", "1"), ("3", "1"), ("http://image", "http://image")]
+
+    # with same_id only the same record is duplicate and the records are registered only by register
+    index = DedupIndex(threshold=6)
+    records = [{"_id": "1", IMG_DATA: image}, {"_id": "2", IMG_DATA: image}, {"_id": "1", IMG_DATA: image}]
+    unique, duplicates = index.filter(records, same_id=True, register=False)
+    assert [record["_id"] for record in unique] == ["1", "2"] and len(index) == 0
+    assert index.filter(records, same_id=True, register=False)[0] == unique
+
+    index.register(unique[0])
+    assert [record["_id"] for record in index.filter(records, same_id=True)[0]] == ["2"]
+
+
+def test_24_vector_index(request, tmp_path):
+    """
+    Test local kNN index with filters and persistence.
+    """
+    index = VectorIndex()
+    index.add_records(
+        [
+            {"_id": "1", DESCRIPTOR: [1.0, 0.0], "color": "red"},
+            {"_id": "2", DESCRIPTOR: [0.9, 0.1], "color": "blue"},
+            {"_id": "3", DESCRIPTOR: [0.0, 1.0], "color": "red"},
+        ]
+    )
+
+    result = index.search({"_id": "1"}, k=2)
+    assert [record["_id"] for record in result[ANSWER_RECORDS]] == ["1", "2"]
+    result = index.search([1.0, 0.0], k=2, filter={"color": "red"}, fields_to_return=["color"])
+    assert [(record["_id"], record["color"]) for record in result[ANSWER_RECORDS]] == [("1", "red"), ("3", "red")]
+
+    index.remove(["1"])
+    index.save(str(tmp_path))
+    loaded = VectorIndex.load(str(tmp_path))
+    assert len(loaded) == 2
+    assert [record["_id"] for record in loaded.search_batch([[1.0, 0.0], [0.0, 1.0]], k=1)[1][ANSWER_RECORDS]] == ["3"]
+
+
+def test_25_dominant_colors(request):
+    """
+    Test vectorized aggregation of dominant colors.
+    """
+    records = [
+        {DOMINANT_COLORS: {RGB_COLORS: [[250, 10, 10], [10, 10, 240]], PERCENTAGES: [70.0, 30.0]}},
+        {STATUS: {"code": 500}},
+        {DOMINANT_COLORS: {RGB_COLORS: [[5, 5, 5]], PERCENTAGES: [100.0]}},
+    ]
+    palette = [[255, 0, 0], [0, 0, 255], [0, 0, 0]]
+
+    colors = DominantColors.from_records(records)
+    assert len(colors) == 3 and colors.count == 3
+    assert colors.nearest_palette(palette).tolist() == [0, 1, 2]
+    assert colors.dominant().tolist() == [0, -1, 2]
+    assert colors.palette_shares(palette).tolist() == [[70, 30, 0], [0, 0, 0], [0, 0, 100]]
+
+    aggregator = DominantColorsAggregator(palette)
+    aggregator.update({RECORDS: records[:2]})
+    aggregator.update({RECORDS: records[2:]})
+    assert aggregator.records == 3
+    assert aggregator.palette_counts.tolist() == [70, 30, 100]
+    assert aggregator.histogram.sum() == 200
+
+
+def test_26_tile_stitcher(request):
+    """
+    Test that overlapping tiles are blended back into the same image.
+    """
+    image = np.random.randint(0, 256, (700, 1100, 3), dtype=np.uint8)
+    stitcher = TileStitcher(700, 1100, scale=2, tile_size=256, overlap=32)
+
+    tiles = stitcher.tiles()
+    for row, column, (y0, y1), (x0, x1) in reversed(tiles):
+        stitcher.add(row, column, np.repeat(np.repeat(image[y0:y1, x0:x1], 2, axis=0), 2, axis=1))
+
+    assert len(tiles) == 3 * 5 and stitcher.done()
+    assert np.array_equal(stitcher.output, np.repeat(np.repeat(image, 2, axis=0), 2, axis=1))
+
+
+def test_27_crop_pipeline(request):
+    """
+    Test that every image is decoded once and the crops are cut from it.
+    """
+    image = np.random.randint(0, 256, (100, 200, 3), dtype=np.uint8)
+    decoded = []
+
+    def load():
+        decoded.append(1)
+        return image
+
+    pipeline = CropPipeline(transform=lambda key, crop: crop.copy(), max_workers=2)
+    result = dict(pipeline.process([(load, [("a", [0, 0, 50, 40]), ("b", [150, 80, 250, 120])]), (load, [])]))
+
+    assert len(decoded) == 1 and not pipeline.errors
+    assert np.array_equal(result["a"], image[0:40, 0:50])
+    assert np.array_equal(result["b"], image[80:100, 150:200])
+
+    # failed transform is recorded in errors and the other crops are still returned
+    def transform(key, crop):
+        if key == "a":
+            raise ValueError("transform failed")
+        return crop.copy()
+
+    pipeline = CropPipeline(transform=transform, max_workers=2)
+    result = dict(pipeline.process([(load, [("a", [0, 0, 50, 40]), ("b", [150, 80, 250, 120])])]))
+    assert list(result) == ["b"] and pipeline.errors == [("a", "transform failed")]
+
+    # image which can not be decoded is skipped and recorded in errors, the other images are still cut
+    broken = lambda: None
+    pipeline = CropPipeline(max_workers=2)
+    result = dict(pipeline.process([(broken, [("c", [0, 0, 10, 10])]), (load, [("d", [0, 0, 10, 10])])]))
+    assert list(result) == ["d"] and len(pipeline.errors) == 1 and pipeline.errors[0][0] is broken
+
+
+def test_28_resize_batch(request):
+    """
+    Test batched resizing with the client policy and letterboxing.
+    """
+    images = [np.zeros((800, 1000, 3), dtype=np.uint8), np.zeros((300, 1000, 3), dtype=np.uint8)]
+    resized = resize_batch(images, 600)
+    assert resized[0].shape == (600, 750, 3) and resized[1] is images[1]
+
+    boxes = letterbox_batch([np.zeros((100, 200, 3), dtype=np.uint8), np.zeros((50, 50, 3), dtype=np.uint8)], 100)
+    assert boxes.shape == (2, 100, 100, 3)
+    assert boxes[0, :25].min() == 255 and boxes[0, 25:75].max() == 0
+    assert boxes[1, 25:75, 25:75].max() == 0 and boxes[1, :25].min() == 255
+
+    # BGRA images (cv2.IMREAD_UNCHANGED) are padded with opaque color, gray images with the first value of the color
+    boxes = letterbox_batch([np.zeros((16, 32, 4), dtype=np.uint8)], 32, color=(0, 0, 128))
+    assert boxes.shape == (1, 32, 32, 4) and boxes[0, 0, 0].tolist() == [0, 0, 128, 255]
+    assert boxes[0, 8:24].max() == 0
+    assert letterbox(np.zeros((16, 32), dtype=np.uint8), 32, color=(64, 0, 0))[0, 0] == 64
+
+
+def test_29_base64_data(request):
+    """
+    Test decoding of base64 data with and without header from str and bytes.
+    """
+    encoded = encode_base64(b"image data")
+    assert encoded == "data:image/jpeg;base64,aW1hZ2UgZGF0YQ=="
+    assert encode_base64(b"image data", header=None) == "aW1hZ2UgZGF0YQ=="
+
+    for data in [encoded, encoded[23:], encoded.encode("ascii"), memoryview(encoded.encode("ascii"))]:
+        assert decode_base64(data) == b"image data"
+    assert isinstance(base64_payload(encoded.encode("ascii")), memoryview)
+
+
+def test_30_image_probe(request):
+    """
+    Test reading of format and size from the header of base64 image.
+    """
+    import cv2
+
+    image = np.zeros((120, 200, 3), dtype=np.uint8)
+    jpeg = encode_base64(cv2.imencode(".jpg", image)[1])
+    png = encode_base64(cv2.imencode(".png", image)[1], header=None)
+
+    assert probe_base64(jpeg) == {"format": "jpeg", "width": 200, "height": 120, "channels": 3, "orientation": 1}
+    assert probe_base64(png) == {"format": "png", "width": 200, "height": 120, "channels": 3}
+    assert probe_base64(encode_base64(b"not an image")) is None
+
+
+def test_31_encoding_policy(request):
+    """
+    Test that the encoding policy keeps the target size and the quality floor.
+    """
+    image = np.random.randint(0, 256, (256, 256, 3), dtype=np.uint8)
+    default = EncodingPolicy().encode(image)
+
+    target = EncodingPolicy(target_bytes=default.size // 2, min_quality=10).encode(image)
+    assert target.size <= default.size // 2
+
+    floor = EncodingPolicy(target_bytes=100, min_quality=90).encode(image)
+    assert floor.size == EncodingPolicy(quality=90).encode(image).size
+    assert EncodingPolicy(webp=True).header == "data:image/webp;base64,"
+
+    # policy of the endpoint is used instead of the policy of the client
+    client = SimilarityPhotosClient("__TOKEN__", collection_id="__COLLECTION__", endpoint="http://localhost/")
+    client.encoding_policy = EncodingPolicy(quality=50)
+    client.encoding_policies["insert"] = EncodingPolicy(webp=True)
+    sent = []
+    client.post = lambda api_endpoint, data=None, params=None: sent.append(data) or {STATUS: {"code": 200}}
+    client.insert([{_ID: "1", IMG_DATA: image, COLOR_SPACE: "BGR"}])
+    assert sent[0][RECORDS][0][BASE64].startswith("data:image/webp;base64,")
+    assert client.get_encoding_policy() is client.encoding_policy
+    assert client.get_encoding_policy("insert") is client.encoding_policies["insert"]
+
+
+def test_32_workspace_index_offline(request, tmp_path):
+    """
+    Test refresh of the workspace index and the fallback to the workspace when the index is outdated.
+    """
+    client = RecognitionClient("__TOKEN__", endpoint="http://localhost/", workspace="__WORKSPACE__")
+    tasks = [{ID: "task", NAME: "task", TYPE: "multi_class", PRODUCTION_VERSION: 1}]
+    labels = [{ID: "label_1", NAME: "label_1"}, {ID: "label_2", NAME: "label_2"}]
+    links = {"task": ["label_1"]}
+
+    def get_all_paginated_items(url):
+        if "?task=" in url:
+            return [label for label in labels if label[ID] in links[url.split("?task=")[1]]], RESULT_OK
+        return list(labels if "label" in url else tasks), RESULT_OK
+
+    client.get_all_paginated_items = get_all_paginated_items
+    client.get_labels_by_substring = lambda name: (
+        [Label(client.token, client.endpoint, label) for label in labels if name in label[NAME]],
+        RESULT_OK,
+    )
+
+    index = WorkspaceIndex(client, path=str(tmp_path / "index.sqlite3"))
+    assert index.refresh() == RESULT_OK
+    assert [label.id for label in index.get_labels(task_id="task")] == ["label_1"]
+    assert index.get_label_by_name("label_2").workspace == "__WORKSPACE__"
+    assert index.get_task_by_name("task").workspace == "__WORKSPACE__"
+
+    # label attached by some other client does not change the task, only refresh_links (or links=True) sees it
+    links["task"].append("label_2")
+    index.refresh()
+    assert [label.id for label in index.get_labels(task_id="task")] == ["label_1"]
+    assert index.refresh_links("task") == (["label_1", "label_2"], RESULT_OK)
+    assert sorted(label.id for label in index.get_labels(task_id="task")) == ["label_1", "label_2"]
+
+    # label created after the refresh is found in the workspace and stored to the index
+    labels.append({ID: "label_3", NAME: "label_3"})
+    assert index.get_label_by_name("label_3") is None
+    assert [label.id for label in index.find_labels("label_3")] == ["label_3"]
+    assert index.label_ids_by_name()["label_3"] == "label_3"
+    assert index.find_labels("label_3", lambda label: label.id == "other") == []
+
+
+def test_33_upload_and_insert_duplicates(request, monkeypatch):
+    """
+    Test that duplicate images get labels and meta data of the record and repeated inserts are filtered.
+    """
+    image = np.zeros((120, 160, 3), dtype=np.uint8)
+    image[30:90, 40:80] = 255
+    image_json = {ID: "__IMAGE_ID__", IMG_PATH: "", THUMB_IMG_PATH: "", META_DATA: {}}
+    calls = []
+
+    def post(self, api_endpoint, data=None, files=None, params=None, method=None):
+        calls.append((api_endpoint, data))
+        return dict(image_json)
+
+    def put(self, api_endpoint, data=None, files=None, params=None):
+        calls.append((api_endpoint, data))
+        return dict(image_json, **data)
+
+    monkeypatch.setattr(RecognitionClient, "post", post)
+    monkeypatch.setattr(RecognitionClient, "put", put)
+    monkeypatch.setattr(
+        RecognitionClient,
+        "get",
+        lambda self, api_endpoint, data=None, params=None: calls.append((api_endpoint, None)) or dict(image_json),
+    )
+
+    client = RecognitionClient("__TOKEN__", endpoint="http://localhost/")
+    client.dedup = DedupIndex()
+    records = [
+        {IMG_DATA: image, COLOR_SPACE: "BGR", LABELS: ["__LABEL_1__"]},
+        {IMG_DATA: image, COLOR_SPACE: "BGR", LABELS: ["__LABEL_2__"], META_DATA: {"key": "value"}},
+    ]
+    images, status = client.upload_images(records)
+
+    assert [image.id for image in images] == ["__IMAGE_ID__"] * 2 and status == {STATUS: "exists"}
+    assert [endpoint for endpoint, _ in calls].count("recognition/v2/training-image/") == 1
+    assert ("recognition/v2/training-image/__IMAGE_ID__/add-label/", {LABEL_ID: "__LABEL_2__"}) in calls
+    assert images[1].meta_data == {"key": "value"}
+
+    # duplicate without meta data is not downloaded at all
+    calls.clear()
+    images, status = client.upload_images([{IMG_DATA: image, COLOR_SPACE: "BGR", LABELS: ["__LABEL_3__"]}])
+    assert calls == [("recognition/v2/training-image/__IMAGE_ID__/add-label/", {LABEL_ID: "__LABEL_3__"})]
+    assert images[0].id == "__IMAGE_ID__" and images[0].workspace == client.workspace
+
+    collection = SimilarityPhotosClient("__TOKEN__", collection_id="__COLLECTION__", endpoint="http://localhost/")
+    collection.dedup = DedupIndex()
+    responses = [{STATUS: {"code": 500, "text": "error"}}, {STATUS: {"code": 200, "text": "OK"}}]
+    inserted = []
+
+    def insert(api_endpoint, data=None, **kwargs):
+        inserted.append([record[_ID] for record in data[RECORDS]])
+        return responses.pop(0)
+
+    collection.post = insert
+    records = [{_ID: "1", IMG_DATA: image}, {_ID: "2", IMG_DATA: image}]
+    # failed insert is repeated with all the records, same image with other _id is a new record
+    assert collection.insert(records)[STATUS]["code"] == 500
+    assert collection.insert(records)[STATUS]["code"] == 200
+    result = collection.insert(records)
+    result[STATUS]["text"] = "changed"
+
+    assert inserted == [["1", "2"], ["1", "2"]]
+    assert collection.insert(records)[STATUS]["text"] == "OK (all records are duplicates)"
+
+
+class FakeAsyncRClient(object):
+    """
+    AsyncRClient with requests in memory, the listing has pages of two requests (newest first).
+    """
+
+    endpoint = "http://localhost/"
+    headers = {"Authorization": "Token __TOKEN__"}
+
+    def __init__(self, statuses, workspace="__WORKSPACE__"):
+        self.statuses = statuses
+        self.workspace = workspace
+        self.calls = []
+
+    def request(self, request_id, response=True):
+        status = self.statuses[request_id]
+        done = response and status in ["DONE", "ERROR"]
+        return types.SimpleNamespace(id=request_id, status=status, response={"id": request_id} if done else None)
+
+    def get_request(self, request_id):
+        self.calls.append(("get_request", request_id))
+        return self.request(request_id), "OK"
+
+    def get_requests(self, page_url=None, type=None, status=None):
+        page = int(page_url or 1)
+        self.calls.append(("get_requests", page))
+        ids = sorted(self.statuses, reverse=True)[(page - 1) * 2 : page * 2]
+        next_page = str(page + 1) if page * 2 < len(self.statuses) else None
+        return [self.request(request_id, response=False) for request_id in ids], next_page, {"count": 0}
+
+
+def test_34_async_request_scheduler(request):
+    """
+    Test that the listing finishes requests of every final status and misses are checked one by one.
+    """
+    statuses = {"1": "DONE", "2": "PENDING", "3": "ERROR", "4": "DONE", "5": "PENDING", "6": "DONE"}
+    client = FakeAsyncRClient(statuses)
+    scheduler = AsyncRequestScheduler(client, min_interval=0.0, list_threshold=3, max_pages=2)
+    futures = dict((request_id, scheduler.track(client.request(request_id, response=False))) for request_id in statuses)
+
+    assert scheduler.poll() == 4
+    assert client.calls.count(("get_requests", 1)) == 1 and ("get_requests", 3) not in client.calls
+    # requests 1 and 2 are not on the first two pages, 5 is listed as pending so it is not checked again
+    assert ("get_request", "1") in client.calls and ("get_request", "2") in client.calls
+    assert ("get_request", "5") not in client.calls
+    assert futures["3"].result(timeout=0).status == "ERROR"
+    assert futures["6"].result(timeout=0).response == {"id": "6"}
+    assert not futures["2"].done() and len(scheduler) == 2
+
+    statuses["2"] = statuses["5"] = "DONE"
+    assert scheduler.run(timeout=1)
+    assert futures["2"].result(timeout=0).response == {"id": "2"}
+
+
+def test_35_webhook_receiver(request):
+    """
+    Test that webhooks resolve the shared scheduler and webhook without response downloads the request.
+    """
+    import urllib.request
+
+    client = FakeAsyncRClient({"1": "PENDING", "2": "DONE"}, workspace="__WEBHOOK_WORKSPACE__")
+    with pytest.raises(Exception):
+        WebhookReceiver(client, host="0.0.0.0", port=0)
+
+    receiver = WebhookReceiver(client, port=0, secret="__SECRET__", fallback_interval=3600)
+    receiver.start()
+    try:
+
+        def webhook(request_json, secret="__SECRET__"):
+            data = json.dumps(request_json).encode("utf-8")
+            headers = {"X-Webhook-Secret": secret, "Content-Type": "application/json"}
+            try:
+                return urllib.request.urlopen(urllib.request.Request(receiver.public_url, data, headers)).status
+            except urllib.error.HTTPError as e:
+                return e.code
+
+        future = receiver.track(client.request("1", response=False))
+        assert webhook({"id": "1", "status": "DONE", "response": {"id": "1"}}, secret="__WRONG__") == 403
+        assert webhook({"id": "1", "status": "DONE", "response": {"id": "1"}}) == 200
+        assert future.result(timeout=1).response == {"id": "1"}
+
+        # webhook which comes before the tracking (and without response) resolves also the waiters of the request
+        assert webhook({"id": "2", "status": "DONE"}) == 200
+        assert ("get_request", "2") in client.calls
+        future = SHARED_SCHEDULERS[(client.endpoint, client.headers["Authorization"], client.workspace)].track(
+            client.request("2", response=False)
+        )
+        assert future.result(timeout=0).response == {"id": "2"}
+    finally:
+        receiver.stop()
+        SHARED_SCHEDULERS.pop((client.endpoint, client.headers["Authorization"], client.workspace)).stop()
+
+
+def test_36_collection_export(request, tmp_path):
+    """
+    Test that error response does not end the export and interrupted export continues.
+    """
+    records = [{_ID: str(i)} for i in range(7)]
+    errors = {2: {STATUS: {"code": 500, "text": "error"}}}
+
+    class FakeCollection(object):
+        def allRecords(self, size, page, fields_to_return):
+            if page in errors:
+                return errors[page]
+            if (page - 1) * size >= len(records):
+                # pages after the end of the collection could be also an error
+                return {"detail": "Invalid page."}
+            result = {ANSWER_RECORDS: records[(page - 1) * size : page * size]}
+            if page * size < len(records):
+                result[NEXT] = page + 1
+            return result
+
+    exporter = CollectionExporter(FakeCollection(), page_size=2, pages_per_shard=1, max_workers=3)
+    with pytest.raises(Exception):
+        exporter.export(str(tmp_path))
+    assert not json.load(open(str(tmp_path / "manifest.json")))["complete"]
+
+    errors.clear()
+    assert exporter.export(str(tmp_path)) == {"records": 7, "shards": 4, "complete": True}
+    assert [record[_ID] for record in read_export(str(tmp_path))] == [record[_ID] for record in records]
+
+
+def test_37_collection_sync(request):
+    """
+    Test that only changed fields of the local records are synchronized and failed batches do not stop the sync.
+    """
+    remote = {
+        "1": {_ID: "1", URL: "a", "name": "one", "color": "red"},
+        "2": {_ID: "2", URL: "b", "name": "two"},
+        "3": {_ID: "3", URL: "c", "name": "three"},
+        "4": {_ID: "4", URL: "d"},
+    }
+    calls = []
+
+    class FakeCollection(SimilarityPhotosClient):
+        def __init__(self):
+            super().__init__("__TOKEN__", collection_id="__COLLECTION__", endpoint="http://localhost/")
+
+        def all_records_iter(self, fields_to_return=[_ID], batch_size=1000):
+            for record in remote.values():
+                yield dict((field, record[field]) for field in [_ID] + fields_to_return if field in record)
+
+        def insert(self, records):
+            calls.append(("insert", [record[_ID] for record in records]))
+            if any(record[_ID] == "5" for record in records):
+                raise Exception("insert failed")
+            return {STATUS: {"code": 200, "text": "OK"}}
+
+        def update(self, records, fields_to_return=["*"]):
+            calls.append(("update", [record[_ID] for record in records]))
+            return {STATUS: {"code": 200, "text": "OK"}, RECORDS: [{_ID: record[_ID]} for record in records]}
+
+        def remove(self, records):
+            calls.append(("remove", [record[_ID] for record in records]))
+            return {STATUS: {"code": 200, "text": "OK"}}
+
+    records = [
+        {_ID: "1", URL: "a", "name": "one"},  # color only in the collection is not a change
+        {_ID: "2", URL: "b", "name": "TWO"},
+        {_ID: "3", URL: "C", "name": "three"},
+        {_ID: "5", URL: "e"},
+        {_ID: "6", URL: "f"},
+    ]
+    sync = CollectionSync(FakeCollection(), batch_size=1, remove_missing=True)
+    plan = sync.plan(records)
+    assert [[record[_ID] for record in plan[operation]] for operation in ["insert", "update", "reinsert"]] == [
+        ["5", "6"],
+        ["2"],
+        ["3"],
+    ]
+    assert plan["remove"] == ["4"]
+
+    summary = sync.sync(records)
+    assert summary["insert"] == {"records": 2, "error": 1}
+    assert summary["reinsert"] == {"records": 1, "error": 0} and summary["remove"] == {"records": 1, "error": 0}
+    # changed image is inserted again without removing, records are removed as the last step
+    assert ("remove", ["3"]) not in calls and calls[-1] == ("remove", ["4"])
+
+
+def test_38_flow_registry(request):
+    """
+    Test that flows and their definitions are cached with TTL and get_flow keeps the image size of the client.
+    """
+    flow_json = {ID: "flow", NAME: "flow", DESCRIPTION: "", WORKSPACE: "", TOP_NODE: "", VALID: True, "image_size": 256}
+    calls = []
+
+    client = FlowsClient("__TOKEN__", endpoint="http://localhost/", max_image_size=1024)
+    client.get = lambda api_endpoint, data=None, params=None: calls.append(api_endpoint) or dict(flow_json)
+    client.get_flow_json = lambda flow_id: calls.append("json") or {"nodes": [len(calls)]}
+
+    flow, status = client.get_flow("flow")
+    assert flow.max_image_size == 1024 and flow.image_size == 256
+
+    client.flow_registry = FlowRegistry(client, ttl=0.2)
+    flow, status = client.get_flow("flow")
+    assert flow.max_image_size == 256
+    definition = flow.to_json()
+    definition["nodes"].append("changed")
+    assert flow.to_json() == {"nodes": [definition["nodes"][0]]} and calls.count("json") == 1
+
+    time.sleep(0.25)
+    assert client.get_flow("flow")[0] is flow
+    flow.to_json()
+    assert calls.count("json") == 2
+
+
+def test_39_search_batch(request):
+    """
+    Test that identical queries are sent once and a query which can not be serialized fails alone.
+    """
+    client = SimilarityPhotosClient("__TOKEN__", collection_id="__COLLECTION__", endpoint="http://localhost/")
+    calls = []
+
+    def search(query_record, filter=None, k=5, fields_to_return=[_ID]):
+        calls.append(query_record)
+        json.dumps(query_record)
+        return {ANSWER_RECORDS: [{_ID: query_record[_ID]}], STATUS: {"code": 200, "text": "OK"}}
+
+    client.search = search
+    results = client.search_batch([{_ID: "1"}, {_ID: "2", "bad": {1, 2}}, {_ID: "1"}])
+
+    assert len(calls) == 2
+    assert results[0] == results[2] and results[0] is not results[2]
+    assert results[1][STATUS]["code"] == 500 and results[0][ANSWER_RECORDS] == [{_ID: "1"}]
+
+
+class FakeDownloadResponse(object):
+    def __init__(self, url):
+        self.url = url
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def raise_for_status(self):
+        if "broken" in self.url:
+            raise Exception("404 Not Found")
+
+    def iter_content(self, chunk_size):
+        return iter([self.url.encode()])
+
+
+class FakeDownloadSession(object):
+    """
+    Session which returns the url as the content of the downloaded file, urls with 'broken' fail.
+    """
+
+    def get(self, url, stream=False, timeout=None):
+        return FakeDownloadResponse(url)
+
+
+def test_40_output_pipeline(request, tmp_path, monkeypatch):
+    """
+    Test that the output images are streamed to the directory under safe names and failures are reported per record.
+    """
+    sink = DirectorySink(str(tmp_path / "out"))
+    path = sink.write("a.png", iter([b"ab", b"cd"]))
+    assert open(path, "rb").read() == b"abcd" and not (tmp_path / "out" / "a.png.part").exists()
+
+    assert OutputPipeline.output_name({_ID: "../x/y"}, 0, "_output_url", "http://a/b.jpg") == "_x_y_output_url.jpg"
+    assert OutputPipeline.output_name({_ID: "..\\x"}, 0, "_output_url", "http://a/b") == "_x_output_url.png"
+    assert OutputPipeline.output_name({_ID: ".."}, 3, "_output_url", "http://a/b") == "3_output_url.png"
+
+    def method(batch):
+        if batch[0][_ID] == "fail":
+            raise Exception("api down")
+        return {RECORDS: [{_ID: r[_ID], "_output_url": "http://cdn/" + r[_ID] + ".png"} for r in batch]}
+
+    pipeline = OutputPipeline(method, sink, batch_size=2, max_workers=2, download_workers=2)
+    pipeline.session = FakeDownloadSession()
+    results = {r[_ID]: r for r in pipeline.process([{_ID: "1"}, {_ID: "broken"}, {_ID: "fail"}])}
+    assert open(results["1"][OUTPUT_PATHS]["_output_url"], "rb").read() == b"http://cdn/1.png"
+    assert results["broken"]["_status"]["text"].startswith("Download failed")
+    assert results["fail"]["_status"] == {"code": 500, "text": "api down"}
+
+    pipeline.session = FakeDownloadSession()
+    assert pipeline.run([{_ID: "2"}, {_ID: "broken"}]) == {"records": 2, "outputs": 1, "error": 1}
+
+    monkeypatch.setattr(requests, "Session", FakeDownloadSession)
+    calls = []
+
+    def post(api_endpoint, data=None, params=None):
+        calls.append(api_endpoint)
+        return {
+            RECORDS: [
+                dict(r, _output_url=r[URL] + "_out.png", _upscaled_image_url=r[URL] + "_up.png") for r in data[RECORDS]
+            ]
+        }
+
+    removebg = RemoveBGClient("__TOKEN__", endpoint="http://localhost/")
+    removebg.post = post
+    records = list(removebg.removebg_stream([{_ID: "3", URL: "http://img/3"}], str(tmp_path / "removebg")))
+    assert set(records[0][OUTPUT_PATHS]) == {"_output_url", "_upscaled_image_url"}
+    assert os.path.exists(records[0][OUTPUT_PATHS]["_output_url"]) and calls[-1] == removebg.PREDICT_ENDPOINT
+
+    upscaler = UpscaleClient("__TOKEN__", endpoint="http://localhost/")
+    upscaler.post = post
+    records = list(upscaler.upscale_stream([{_ID: "4", URL: "http://img/4"}], 2, str(tmp_path / "upscale")))
+    assert open(records[0][OUTPUT_PATHS]["_upscaled_image_url"], "rb").read() == b"http://img/4_up.png"
+    assert calls[-1] == "/upscaler/2x/upscale"
+
+
+def test_41_bulk_remove_update(request):
+    """
+    Test that failed batches are repeated and every record has its own outcome.
+    """
+    client = SimilarityPhotosClient("__TOKEN__", collection_id="__COLLECTION__", endpoint="http://localhost/")
+    calls = []
+
+    def post(api_endpoint, data=None, params=None):
+        ids = [record[_ID] for record in data[RECORDS]]
+        calls.append(ids)
+        if "3" in ids and calls.count(ids) == 1:
+            return {STATUS: {"code": 503, "text": "Service Unavailable"}}
+        if "5" in ids:
+            return {STATUS: {"code": 500, "text": "Internal Server Error"}}
+        if FIELDS_TO_RETURN in data:
+            statuses = [{"code": 404 if _id == "2" else 200, "text": "Not Found"} for _id in ids]
+            return {RECORDS: [{_ID: _id, "_status": s} for _id, s in zip(ids, statuses)], STATUS: {"code": 200}}
+        return {STATUS: {"code": 200, "text": "OK"}}
+
+    client.post = post
+    result = client.remove_many([{_ID: str(i), NAME: "x"} for i in range(1, 6)], batch_size=2, attempts=2)
+    assert sorted(calls) == [["1", "2"], ["3", "4"], ["3", "4"], ["5"], ["5"]]
+    assert [outcome[_ID] for outcome in result[RECORDS]] == ["1", "2", "3", "4", "5"]
+    assert result["ok"] == 4 and result["error"] == 1
+    assert result[RECORDS][4] == {_ID: "5", STATUS: "ERROR", "detail": "Internal Server Error"}
+
+    calls.clear()
+    result = client.update_many([{_ID: "1", NAME: "a"}, {_ID: "2", NAME: "b"}], batch_size=10, attempts=1)
+    assert calls == [["1", "2"]]
+    assert [outcome[STATUS] for outcome in result[RECORDS]] == ["OK", "ERROR"]
+    assert result[RECORDS][1]["detail"] == "Not Found" and result["error"] == 1
+
+
+def test_42_search_cache(request):
+    """
+    Test that the same search is sent once and any change of the collection clears the cache.
+    """
+    client = SimilarityPhotosClient("__TOKEN__", collection_id="__COLLECTION__", endpoint="http://localhost/")
+    client.search_cache, calls = ResultCache(max_size=10), []
+
+    def post(api_endpoint, data=None, params=None):
+        calls.append(api_endpoint)
+        if QUERY_RECORD in data:
+            return {ANSWER_RECORDS: [{_ID: "1"}], STATUS: {"code": 200, "text": "OK"}}
+        return {STATUS: {"code": 200, "text": "OK"}}
+
+    client.post = post
+    client.search({_ID: "1"})
+    assert client.search({_ID: "1"}) == {ANSWER_RECORDS: [{_ID: "1"}], STATUS: {"code": 200, "text": "OK"}}
+    client.search({_ID: "1"}, k=10)
+    assert len(calls) == 2
+
+    for change in [
+        lambda: client.insert([{_ID: "2", URL: "http://localhost/2.jpg"}]),
+        lambda: client.update([{_ID: "1", NAME: "a"}]),
+        lambda: client.remove([{_ID: "1"}]),
+    ]:
+        count = len(calls)
+        change()
+        client.search({_ID: "1"})
+        assert len(calls) == count + 2
+
+
+def test_43_async_request_wait(request):
+    """
+    Test that wait, result and as_completed finish the requests through the shared scheduler.
+    """
+    import asyncio
+
+    client = FakeAsyncRClient({"1": "DONE", "2": "PENDING", "3": "ERROR"}, workspace="__WAIT_WORKSPACE__")
+    key = (client.endpoint, client.headers["Authorization"], client.workspace)
+    SHARED_SCHEDULERS[key] = AsyncRequestScheduler(client, min_interval=0.01, max_interval=0.05)
+    SHARED_SCHEDULERS[key].start()
+    try:
+        tracked = [
+            AsynchronousRequest(
+                "__TOKEN__", client.endpoint, client.workspace, {ID: request_id, STATUS: "PENDING", "type": "t"}
+            )
+            for request_id in ["1", "2", "3"]
+        ]
+        assert tracked[0].wait(timeout=1) and tracked[0].response == {"id": "1"}
+        assert not tracked[1].wait(timeout=0.1) and tracked[1].response is None
+
+        async_client = AsyncRClient("__TOKEN__", endpoint=client.endpoint, workspace=client.workspace)
+        client.statuses["2"] = "DONE"
+        finished = list(async_client.as_completed(tracked[1:] + tracked[2:], timeout=1))
+        assert sorted(r.id for r in finished) == ["2", "3", "3"] and finished[0] in tracked
+        assert tracked[2].status == "ERROR" and tracked[1].response == {"id": "2"}
+
+        request_4 = AsynchronousRequest(
+            "__TOKEN__", client.endpoint, client.workspace, {ID: "4", STATUS: "PENDING", "type": "t"}
+        )
+        client.statuses["4"] = "DONE"
+        assert asyncio.run(asyncio.wait_for(request_4.result(), 1)) == {"id": "4"}
+    finally:
+        SHARED_SCHEDULERS.pop(key).stop()
+
+
+def test_44_process_flows(request):
+    """
+    Test that the records are preprocessed once and the results of all flows are merged per record.
+    """
+    client = FlowsClient("__TOKEN__", endpoint="http://localhost/")
+    preprocess_records, preprocessed = client.preprocess_records, []
+    client.preprocess_records = lambda records: preprocessed.append(len(records)) or preprocess_records(records)
+
+    def post(api_endpoint, data=None, params=None):
+        posted.append(data["flow"])
+        if data["flow"] == "broken":
+            raise Exception("connection reset")
+        if data["flow"] == "error":
+            return {STATUS: {"code": 400, "text": "Invalid flow"}}
+        records = [{URL: record[URL], "flow": data["flow"]} for record in data[RECORDS]]
+        return {RECORDS: records, STATUS: {"code": 200, "text": "OK"}}
+
+    client.post, posted = post, []
+    flows = ["a", "b", "error", "broken", "a"]
+    result = client.process_flows(flows, [{URL: "http://localhost/1.jpg"}, {URL: "2"}])
+
+    # repeated flow is processed once
+    assert preprocessed == [2] and sorted(posted) == ["a", "b", "broken", "error"]
+    assert list(result[STATUS]) == ["a", "b", "error", "broken"]
+    assert [record["b"]["flow"] for record in result[RECORDS]] == ["b", "b"]
+    assert result[RECORDS][1]["a"] == {URL: "2", "flow": "a"} and result[RECORDS][0]["error"] is None
+    assert result[STATUS]["a"]["code"] == 200 and result[STATUS]["error"]["code"] == 400
+    assert result[STATUS]["broken"] == {"code": 500, "text": "connection reset"}
+
+    with pytest.raises(Exception):
+        client.process_flows([], [{URL: "1"}])
+
+
+def test_45_upscale_tiled(request, monkeypatch):
+    """
+    Test that the tiles are upscaled and a tile which can not be downloaded or decoded fails with its position.
+    """
+    import cv2
+    import ximilar.client.upscaler
+
+    image = np.random.randint(0, 256, (100, 150, 3), dtype=np.uint8)
+    client = UpscaleClient("__TOKEN__", endpoint="http://localhost/")
+    client.upscale = lambda records, scale, **kwargs: {RECORDS: [{"_upscaled_image_url": "http://cdn/tile.png"}]}
+    responses = {}
+
+    def get(url, timeout=None):
+        response = requests.Response()
+        response.status_code, response._content, response.url = responses["status"], responses["content"], url
+        return response
+
+    monkeypatch.setattr(ximilar.client.upscaler.requests, "get", get)
+    responses.update(status=200, content=cv2.imencode(".png", np.zeros((128, 128, 3), dtype=np.uint8))[1].tobytes())
+    assert client.upscale_tile(image[:64, :64], 2).shape == (128, 128, 3)
+
+    responses.update(content=b"<html>error</html>")
+    with pytest.raises(Exception, match="Unable to decode the upscaled tile http://cdn/tile.png"):
+        client.upscale_tile(image[:64, :64], 2)
+    with pytest.raises(Exception, match=r"Unable to upscale tile \(row 0, column 0\)"):
+        client.upscale_tiled({IMG_DATA: image, COLOR_SPACE: "BGR"}, 2, tile_size=256, max_workers=1)
+
+    responses.update(status=500)
+    with pytest.raises(requests.HTTPError):
+        client.upscale_tile(image[:64, :64], 2)
@@ -0,0 +1,90 @@
+import os
+import time
+from argparse import ArgumentParser
+
+import cv2
+
+from ximilar.client import GenericTaggingClient
+from ximilar.client.constants import COLOR_SPACE, IMG_DATA
+from ximilar.client.utils.encoding import EncodingPolicy
+from ximilar.client.utils.resize import resize_batch
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+
+
+def get_policies(args):
+    policies = {"jpeg-96 (default)": None, "jpeg-85": EncodingPolicy(quality=85)}
+    if args.target_bytes:
+        policies["jpeg-target-" + str(args.target_bytes)] = EncodingPolicy(
+            target_bytes=args.target_bytes, min_quality=args.min_quality
+        )
+    if args.webp:
+        policies["webp-85"] = EncodingPolicy(quality=85, webp=True)
+    return policies
+
+
+def benchmark_encoding(images, policy):
+    """
+    :return: average size of base64 data in bytes, average encoding time in ms
+    """
+    policy = policy or EncodingPolicy()
+    start, size = time.perf_counter(), 0
+    for image in images:
+        size += (policy.encode(image).size + 2) // 3 * 4 + len(policy.header)
+    return size / len(images), (time.perf_counter() - start) * 1000 / len(images)
+
+
+def benchmark_throughput(client, images, policy, threads, batch_size):
+    """
+    :return: number of processed images per second
+    """
+    client.encoding_policy = policy
+    # decoded images are encoded by the policy (small jpeg files would be sent as they are)
+    records = [{IMG_DATA: image, COLOR_SPACE: "BGR"} for image in images]
+    start = time.perf_counter()
+    client.parallel_records_processing(records, client.tags, max_workers=threads, batch_size=batch_size)
+    return len(records) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Compare payload size and throughput of image encoding policies")
+    parser.add_argument("--images_dir", help="directory with images", required=True)
+    parser.add_argument("--max_image_size", help="images are resized as by the client", default=512, type=int)
+    parser.add_argument("--target_bytes", help="add policy with target size in bytes", default=60000, type=int)
+    parser.add_argument("--min_quality", help="quality floor of the target size policy", default=75, type=int)
+    parser.add_argument("--webp", help="add webp policy", action="store_true")
+    parser.add_argument("--api_prefix", help="API prefix", default="")
+    parser.add_argument("--auth_token", help="if set, throughput of generic tagging is measured for every policy")
+    parser.add_argument("--threads", help="# of threads for the throughput", default=3, type=int)
+    parser.add_argument("--batch_size", help="batch size for the throughput", default=10, type=int)
+    parser.add_argument("--limit", help="max number of images", default=200, type=int)
+
+    args = parser.parse_args()
+
+    paths = sorted(
+        os.path.join(args.images_dir, name)
+        for name in os.listdir(args.images_dir)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )[: args.limit]
+    images = [cv2.imread(path) for path in paths]
+    skipped = [path for path, image in zip(paths, images) if image is None]
+    for path in skipped:
+        print("unable to read image " + path)
+    images = resize_batch([image for image in images if image is not None], args.max_image_size)
+    if not images:
+        raise Exception("No images found in " + args.images_dir)
+
+    client = None
+    if args.auth_token:
+        kwargs = {"endpoint": args.api_prefix} if args.api_prefix else {}
+        client = GenericTaggingClient(token=args.auth_token, **kwargs)
+        client.max_image_size = args.max_image_size
+
+    print(f"{len(images)} images, max image size {args.max_image_size}")
+    print(f"{'policy':<24}{'payload KB':>12}{'encode ms':>12}{'images/s':>12}")
+    for name, policy in get_policies(args).items():
+        size, encoding_time = benchmark_encoding(images, policy)
+        throughput = ""
+        if client is not None:
+            throughput = "%.1f" % benchmark_throughput(client, images, policy, args.threads, args.batch_size)
+        print(f"{name:<24}{size / 1024:>12.1f}{encoding_time:>12.2f}{throughput:>12}")
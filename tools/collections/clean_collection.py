@@ -13,6 +13,8 @@ if __name__ == "__main__":
     parser.add_argument("--auth_token", help="user authorization token to be used for API authentication")
     parser.add_argument("--collection_id", help="ID of collection to upload the images into", default="")
     parser.add_argument("--type", help="product or generic", default="generic")
+    parser.add_argument("--batch_size", help="batch size for remove operation", default=1000, type=int)
+    parser.add_argument("--threads", help="# of threads to remove with", default=4, type=int)
 
     args = parser.parse_args()
 
@@ -41,4 +43,5 @@ if __name__ == "__main__":
         if "next" not in result:
             break
 
-    client.parallel_records_processing(records, client.remove, batch_size=10, output=True)
+    result = client.remove_many(records, batch_size=args.batch_size, max_workers=args.threads, output=True)
+    print("removed", result["ok"], "records,", result["error"], "errors")
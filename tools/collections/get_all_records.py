@@ -9,6 +9,7 @@ from ximilar.client import (
     ImageMatchingSearchClient,
 )
 from ximilar.client.utils.json_data import read_json_file_list
+from ximilar.client.utils.collection_export import CollectionExporter
 
 
 def clean_fields(index_images, fields):
@@ -29,7 +30,9 @@ if __name__ == "__main__":
     parser.add_argument("--batch_size", help="batch size for insert operation", default=1000, type=int)
     parser.add_argument("--limit", help="limit", type=int, required=False)
     parser.add_argument("--type", help="product, generic, fashion similarity or custom service", default="generic")
-    parser.add_argument("--file_path", help="path to JSON file to print image records to", required=True)
+    parser.add_argument("--file_path", help="path to JSON file to print image records to", default="")
+    parser.add_argument("--output_dir", help="export in parallel to gzipped shards in this directory", default="")
+    parser.add_argument("--threads", help="# of threads to export with (only with --output_dir)", default=4, type=int)
 
     args = parser.parse_args()
 
@@ -50,12 +53,21 @@ if __name__ == "__main__":
     else:
         raise Exception("Please specify one of the similarity type (generic, product, visual)")
 
-    with open(args.file_path, "w") as f:
-        fields_to_return = args.fields_to_return.split(",") if args.fields_to_return else []
-        counter = 0
-        for r in client.all_records_iter(fields_to_return, args.batch_size):
-            json.dump(r, f)
-            print("", file=f)
-            counter += 1
-            if args.limit and args.limit <= counter:
-                break
+    if args.output_dir:
+        fields_to_return = ["_id"] + (args.fields_to_return.split(",") if args.fields_to_return else [])
+        exporter = CollectionExporter(
+            client, fields_to_return=fields_to_return, page_size=args.batch_size, max_workers=args.threads
+        )
+        print(exporter.export(args.output_dir))
+    elif not args.file_path:
+        raise Exception("Please specify --file_path or --output_dir")
+    else:
+        with open(args.file_path, "w") as f:
+            fields_to_return = args.fields_to_return.split(",") if args.fields_to_return else []
+            counter = 0
+            for r in client.all_records_iter(fields_to_return, args.batch_size):
+                json.dump(r, f)
+                print("", file=f)
+                counter += 1
+                if args.limit and args.limit <= counter:
+                    break
@@ -0,0 +1,51 @@
+from argparse import ArgumentParser
+
+from ximilar.client import (
+    SimilarityPhotosClient,
+    SimilarityProductsClient,
+    SimilarityCustomClient,
+    SimilarityFashionClient,
+    ImageMatchingSearchClient,
+)
+from ximilar.client.utils.collection_sync import CollectionSync
+from ximilar.client.utils.json_data import read_json_file_list
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Synchronize similarity search collection with records in a given file")
+    parser.add_argument("--api_prefix", help="API prefix", default="")
+    parser.add_argument("--auth_token", help="user authorization token to be used for API authentication")
+    parser.add_argument("--collection_id", help="ID of collection to synchronize", required=True)
+    parser.add_argument("--file_path", help="path to JSON file with image records", required=True)
+    parser.add_argument("--type", help="product, generic, fashion similarity or custom service", default="generic")
+    parser.add_argument("--is_array", help="is the data JSON array or list of JSON records", default=False, type=bool)
+    parser.add_argument("--batch_size", help="batch size for insert, update and remove", default=10, type=int)
+    parser.add_argument("--threads", help="# of threads to synchronize with", default=3, type=int)
+    parser.add_argument("--remove_missing", help="remove records which are not in the file", action="store_true")
+    parser.add_argument("--dry_run", help="only print what would be done", action="store_true")
+
+    args = parser.parse_args()
+
+    kwargs = {}
+    if args.api_prefix:
+        kwargs["endpoint"] = args.api_prefix
+
+    if args.type == "generic":
+        client = SimilarityPhotosClient(token=args.auth_token, collection_id=args.collection_id, **kwargs)
+    elif args.type == "product":
+        client = SimilarityProductsClient(token=args.auth_token, collection_id=args.collection_id, **kwargs)
+    elif args.type == "fashion":
+        client = SimilarityFashionClient(token=args.auth_token, collection_id=args.collection_id, **kwargs)
+    elif args.type == "custom":
+        client = SimilarityCustomClient(token=args.auth_token, collection_id=args.collection_id, **kwargs)
+    elif args.type == "matching":
+        client = ImageMatchingSearchClient(token=args.auth_token, collection_id=args.collection_id, **kwargs)
+    else:
+        raise Exception("Please specify one of the similarity type (generic, product, visual)")
+
+    records = read_json_file_list(args.file_path, is_array=args.is_array)
+    sync = CollectionSync(
+        client, batch_size=args.batch_size, max_workers=args.threads, remove_missing=args.remove_missing
+    )
+    summary = sync.sync(records, dry_run=args.dry_run, output=not args.dry_run)
+    for operation, result in summary.items():
+        print(operation, result["records"], "records,", result["error"], "failed records")
@@ -46,22 +46,19 @@ if __name__ == "__main__":
         images = json.load(f)
 
     # create r labels
+    index_r = client_r.get_workspace_index()
     recognition_r = {"LABELS": {}, "TASKS": {}}  # type: ignore
     for entity in recognition:
         if "label_id" in entity and entity["negative_for_task"] is None:
             print("LABEL", entity["name"])
-            labels, _ = client_r.get_labels_by_substring(entity["name"])
-
-            label = None
-            if labels is not None:
-                for label_1 in labels:
-                    if label_1.description == entity["label_id"]:
-                        label = label_1
+            labels = index_r.find_labels(entity["name"], lambda label_1: label_1.description == entity["label_id"])
+            label = labels[-1] if labels else None
 
             if label is None:
                 label, _ = client_r.create_label(
                     entity["name"], entity["label_id"], entity["output_name"], entity["type"]
                 )
+                index_r.put_label(label)
 
             recognition_r["LABELS"][entity["label_id"]] = label
         elif "label_id" in entity and entity["negative_for_task"]:
@@ -71,22 +68,23 @@ if __name__ == "__main__":
     for entity in recognition:
         if "task_id" in entity:
             print("TASK", entity["name"])
-            task = None
-            tasks, _ = client_r.get_tasks_by_name(entity["name"])
-            if tasks is not None:
-                for task_1 in tasks:
-                    if task_1.description == entity["task_id"]:
-                        task = task_1
+            tasks = index_r.find_tasks(entity["name"], lambda task_1: task_1.description == entity["task_id"])
+            task = tasks[-1] if tasks else None
 
             if task is None:
                 task, _ = client_r.create_task(entity["name"], entity["task_id"], entity["type"])
+                index_r.put_task(task)
 
             recognition_r["TASKS"][entity["task_id"]] = task
 
+            # links in the index could be outdated, labels of the task are downloaded again
+            task_label_ids, _ = index_r.refresh_links(task.id)
+            task_label_ids = set(task_label_ids or [])
             for elabel in entity["labels"]:
                 label = recognition_r["LABELS"][elabel]
-                if label != False:
+                if label != False and label.id not in task_label_ids:
                     task.add_label(label.id)
+                    index_r.link(task.id, label.id)
 
     for entity in recognition:
         if "label_id" in entity and entity["negative_for_task"]:
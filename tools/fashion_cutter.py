@@ -1,43 +1,13 @@
 import sys
-
-import cv2
 import os
 from argparse import ArgumentParser
 
 from ximilar.client import DetectionClient, RecognitionClient
-from ximilar.client.constants import DEFAULT_WORKSPACE, IMG_DATA, LABELS, META_DATA, NORESIZE
+from ximilar.client.constants import COLOR_SPACE, DEFAULT_WORKSPACE, IMG_DATA, LABELS, META_DATA, NORESIZE
 from ximilar.client.detection import DetectionObject
 from ximilar.client.recognition import Image
-
-
-def resize(image_data, rect_size, object_resize):
-    (origH, origW) = image_data.shape[:2]
-
-    # set the new width and height and then determine the ratio in change for both the width and height
-    WHITE = [255, 255, 255]
-    if not object_resize:
-        object_resize = rect_size
-    if origW >= origH:
-        rW = rH = origW / float(object_resize)
-    else:
-        rW = rH = origH / float(object_resize)
-
-    # resize the image
-    resized_image = cv2.resize(image_data, (int(origW / rW), int(origH / rH))) if rW >= 1.0 else image_data
-
-    # add white pixels to achieve the required size
-    white_top = int((rect_size - resized_image.shape[:2][0]) / 2)
-    white_left = int((rect_size - resized_image.shape[:2][1]) / 2)
-    resized_image = cv2.copyMakeBorder(
-        resized_image,
-        white_top,
-        rect_size - resized_image.shape[:2][0] - white_top,
-        white_left,
-        rect_size - resized_image.shape[:2][1] - white_left,
-        cv2.BORDER_CONSTANT,
-        value=WHITE,
-    )
-    return resized_image
+from ximilar.client.utils.crops import CropPipeline
+from ximilar.client.utils.resize import letterbox
 
 
 def get_file_name(output_dir, obj, image):
@@ -69,6 +39,7 @@ if __name__ == "__main__":
     parser.add_argument("--out_workspace", help="if used then output is uploaded to this WS")
     parser.add_argument("--max_per_label", help="max objects in each cat. to upload", default=sys.maxsize, type=int)
     parser.add_argument("--label_to_add", help="label to be added to all uploaded images")
+    parser.add_argument("--threads", help="number of threads for resizing and writing objects", type=int, default=4)
 
     args = parser.parse_args()
 
@@ -80,93 +51,111 @@ if __name__ == "__main__":
     if args.out_workspace:
         output_client = RecognitionClient(token=args.auth_token, endpoint=args.api_prefix, workspace=args.out_workspace)
         # map (cache) of labels to be added to images in the output workspace
+        output_index = output_client.get_workspace_index()
+        output_ws_labels = output_index.label_ids_by_name()
 
     counts_per_label = {}
 
     image_dir = os.path.join(args.output_dir, "images_tmp")
     os.makedirs(image_dir, exist_ok=True)
 
-    # getting all images of label (paginated result)
-    images, next_page, status = detection_client.get_training_images()
-    while images:
-        image: Image
-        for image in images:
-            if args.print_details:
-                print(f"processing image {image.id}: {str(image.get_meta_data())}")
-            if ("is_product" in image.get_meta_data() and image.get_meta_data()["is_product"] == 1) or (
-                "verified" in image.get_meta_data() and image.get_meta_data()["verified"] == 0
-            ):
+    def get_images_objects():
+        """
+        Every image is downloaded and decoded only once for all its objects.
+        """
+        # getting all images of label (paginated result)
+        images, next_page, status = detection_client.get_training_images()
+        while images:
+            image: Image
+            for image in images:
                 if args.print_details:
-                    print("\t... skipping due to metadata")
-                continue
-            objects, status = detection_client.get_objects_of_image(image.id)
-            obj: DetectionObject
-            i = 1
-            for obj in objects:
-                if args.label_id and obj.detection_label["id"] != args.label_id:
+                    print(f"processing image {image.id}: {str(image.get_meta_data())}")
+                if ("is_product" in image.get_meta_data() and image.get_meta_data()["is_product"] == 1) or (
+                    "verified" in image.get_meta_data() and image.get_meta_data()["verified"] == 0
+                ):
                     if args.print_details:
-                        print("\t... skipping object due to different label ID: " + str(obj.detection_label))
+                        print("\t... skipping due to metadata")
                     continue
-
-                if any([label_id in obj.recognition_labels for label_id in rec_labels_to_skip]):
-                    if args.print_details:
-                        print("\t... skipping object due to recognition_label: " + str(obj.recognition_labels))
+                objects, status = detection_client.get_objects_of_image(image.id)
+                obj: DetectionObject
+                items = []
+                for obj in objects:
+                    if args.label_id and obj.detection_label["id"] != args.label_id:
+                        if args.print_details:
+                            print("\t... skipping object due to different label ID: " + str(obj.detection_label))
+                        continue
+
+                    if any([label_id in obj.recognition_labels for label_id in rec_labels_to_skip]):
+                        if args.print_details:
+                            print("\t... skipping object due to recognition_label: " + str(obj.recognition_labels))
+                        continue
+
+                    bbox = obj.get_bbox()
+                    if args.min_size > 0 and (bbox[2] - bbox[0] < args.min_size or bbox[3] - bbox[1] < args.min_size):
+                        if args.print_details:
+                            print("\t... skipping object due to size: " + str(bbox))
+                        continue
+
+                    # check the number of images of this type that were already uploaded
+                    if obj.detection_label["id"] not in counts_per_label:
+                        counts_per_label[obj.detection_label["id"]] = 0
+                    if counts_per_label[obj.detection_label["id"]] >= args.max_per_label:
+                        if args.print_details:
+                            print(
+                                "\t... skipping: max number already uploaded for: " + str(obj.detection_label["name"])
+                            )
+                        continue
+                    counts_per_label[obj.detection_label["id"]] += 1
+                    items.append(((image, obj), bbox))
+
+                yield (lambda image=image: detection_client.cv2_imread(image.download(image_dir))), items
+
+            if not next_page:
+                break
+            print(f"loading next page")
+            images, next_page, status = detection_client.get_training_images(next_page)
+            # images = None
+
+    def write_object(key, object_data):
+        image, obj = key
+        image_record = {IMG_DATA: object_data, COLOR_SPACE: "BGR"}
+        if args.resize > 0:
+            image_record[IMG_DATA] = letterbox(image_record[IMG_DATA], args.resize, object_size=args.object_resize)
+
+        object_file = get_file_name(args.output_dir, obj, image)
+        detection_client.cv2_imwrite(image_record, object_file)
+        return image_record, object_file
+
+    pipeline = CropPipeline(transform=write_object, max_workers=args.threads)
+    for (image, obj), (image_record, object_file) in pipeline.process(get_images_objects()):
+        if args.print_details:
+            print("creating file " + str(object_file))
+
+        if output_client:
+            image_record[NORESIZE] = True
+            # check if there is info about "product_id" in the object
+            image_record[META_DATA] = {
+                "from_detection": 1,
+                "is_product": 0,
+                "source_workspace": args.workspace_id,
+                "source_image": image.id,
+                "sqlite_id": image.get_meta_data()["id"],
+            }
+            if "id_product" in obj.get_meta_data() and obj.get_meta_data()["id_product"]:
+                image_record[META_DATA]["id_product"] = obj.get_meta_data()["id_product"]
+            # find label in the target output workspace
+            if obj.detection_label["name"] not in output_ws_labels:
+                # the index could be outdated, the label is searched in the workspace and stored to the index
+                output_labels = output_index.find_labels(obj.detection_label["name"])
+                if not output_labels:
+                    print(f"ERROR finding label '{obj.detection_label['name']}' in target WS")
                     continue
-
-                bbox = obj.get_bbox()
-                if args.min_size > 0 and (bbox[2] - bbox[0] < args.min_size or bbox[3] - bbox[1] < args.min_size):
-                    if args.print_details:
-                        print("\t... skipping object due to size: " + str(bbox))
-                    continue
-
-                # check the number of images of this type that were already uploaded
-                if obj.detection_label["id"] not in counts_per_label:
-                    counts_per_label[obj.detection_label["id"]] = 0
-                if counts_per_label[obj.detection_label["id"]] >= args.max_per_label:
-                    if args.print_details:
-                        print("\t... skipping: max number already uploaded for: " + str(obj.detection_label["name"]))
-                    continue
-                counts_per_label[obj.detection_label["id"]] += 1
-
-                image_record = image.extract_object_data(obj.get_bbox(), image_dir)
-                if args.resize > 0:
-                    image_record[IMG_DATA] = resize(image_record[IMG_DATA], args.resize, args.object_resize)
-
-                object_file = get_file_name(args.output_dir, obj, image)
-                detection_client.cv2_imwrite(image_record, object_file)
-                if args.print_details:
-                    print("creating file " + str(object_file))
-
-                if output_client:
-                    image_record[NORESIZE] = True
-                    # check if there is info about "product_id" in the object
-                    image_record[META_DATA] = {
-                        "from_detection": 1,
-                        "is_product": 0,
-                        "source_workspace": args.workspace_id,
-                        "source_image": image.id,
-                        "sqlite_id": image.get_meta_data()["id"],
-                    }
-                    if "id_product" in obj.get_meta_data() and obj.get_meta_data()["id_product"]:
-                        image_record[META_DATA]["id_product"] = obj.get_meta_data()["id_product"]
-                    # find label in the target output workspace
-                    if obj.detection_label["name"] not in output_ws_labels:
-                        output_labels, status = output_client.get_labels_by_substring(obj.detection_label["name"])
-                        if not output_labels:
-                            print(f"ERROR finding label '{obj.detection_label['name']}' in target WS: {str(status)}")
-                            continue
-                        output_ws_labels[obj.detection_label["name"]] = output_labels[0].id
-                    image_record[LABELS] = [output_ws_labels[obj.detection_label["name"]]]
-                    if args.label_to_add:
-                        image_record[LABELS].append(args.label_to_add)
-
-                    results = output_client.upload_images([image_record])
-                    # results = output_client.parallel_records_processing(records, client.upload_images, output=True)
-
-                i += 1
-
-        if not next_page:
-            break
-        print(f"loading next page")
-        images, next_page, status = detection_client.get_training_images(next_page)
-        # images = None
+                output_ws_labels[obj.detection_label["name"]] = output_labels[0].id
+            image_record[LABELS] = [output_ws_labels[obj.detection_label["name"]]]
+            if args.label_to_add:
+                image_record[LABELS].append(args.label_to_add)
+
+            results = output_client.upload_images([image_record])
+            # results = output_client.parallel_records_processing(records, client.upload_images, output=True)
+    for source, error in pipeline.errors:
+        print("unable to process " + str(source) + ": " + error)
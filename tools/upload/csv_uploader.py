@@ -20,9 +20,9 @@ class Processor:
         self.dryrun = dryrun
         self.mock_id = 0  # for creating label ids during dryrun
 
-        # list of all available labels
-        labels_all, _ = client.get_all_labels()
-        self.labels_all = {l.name: l for l in labels_all}
+        # list of all available labels (from the local index of the workspace)
+        self.index = client.get_workspace_index()
+        self.labels_all = {l.name: l for l in self.index.get_labels()}
 
     def run(self, file: str, labels: List[str], print_details: bool):
         labels_for_each = self._label_ids(labels)
@@ -61,13 +61,18 @@ class Processor:
         ids = []
         for label in labels:
             if label not in self.labels_all:
-                if self.create_labels:
+                # the index could be outdated, look into the workspace before creating the label
+                found = self.index.find_labels(label)
+                if found:
+                    self.labels_all[label] = found[0]
+                elif self.create_labels:
                     if args.dryrun:
                         print(f"would create label: {label}")
                         self.labels_all[label] = LabelMock(f"mock{self.mock_id}")
                         self.mock_id += 1
                     else:
                         self.labels_all[label], _ = client.create_label(label, "automatically created label")
+                        self.index.put_label(self.labels_all[label])
                         print(f"created label: {self.labels_all[label]}")
                 else:
                     print(f"Unknown label {label}, skipping.")
@@ -1,5 +1,11 @@
 import requests
 import json
+import asyncio
+import concurrent.futures
+import http.server
+import socketserver
+import threading
+import time
 
 from ximilar.client import RecognitionClient
 from ximilar.client.constants import *
@@ -7,6 +13,28 @@ from ximilar.client.exceptions import XimilarClientInvalidDataException
 
 
 REQUEST_ENDPOINT = "account/v2/request/"
+DONE = "DONE"
+# statuses after which the request will not change anymore
+FINISHED_STATUSES = [DONE, "ERROR", "FAILED", "CANCELED"]
+# webhook receiver can listen on these hosts without secret
+LOCAL_HOSTS = ["127.0.0.1", "localhost", "::1"]
+
+# background schedulers shared by all the requests of the same account and workspace
+SHARED_SCHEDULERS = {}
+SHARED_SCHEDULERS_LOCK = threading.Lock()
+
+
+def get_shared_scheduler(client):
+    """
+    :param client: AsyncRClient (or AsynchronousRequest)
+    :return: running AsyncRequestScheduler shared by all the clients with the same endpoint, token and workspace
+    """
+    key = (client.endpoint, client.headers["Authorization"], client.workspace)
+    with SHARED_SCHEDULERS_LOCK:
+        if key not in SHARED_SCHEDULERS:
+            SHARED_SCHEDULERS[key] = AsyncRequestScheduler(client)
+            SHARED_SCHEDULERS[key].start()
+        return SHARED_SCHEDULERS[key]
 
 
 class AsyncRClient(RecognitionClient):
@@ -44,6 +72,21 @@ class AsyncRClient(RecognitionClient):
         result = self.post(REQUEST_ENDPOINT, data=data)
         return AsynchronousRequest(self.token, self.endpoint, self.workspace, result)
 
+    def as_completed(self, requests, timeout=None):
+        """
+        Iterate over the requests as they are finished (polled by the shared scheduler).
+        :param requests: list of AsynchronousRequest
+        :param timeout: optional max number of seconds, concurrent.futures.TimeoutError is raised after it
+        :return: iterator of finished AsynchronousRequest, every given request (also repeated one) is yielded
+        """
+        # requests with the same id share one future
+        futures = {}
+        for request in requests:
+            futures.setdefault(request.future(), []).append(request)
+        for future in concurrent.futures.as_completed(futures, timeout=timeout):
+            for request in futures[future]:
+                yield request._set_finished(future.result())
+
 
 class AsynchronousRequest(AsyncRClient):
     def __init__(self, token, endpoint, workspace, async_json):
@@ -70,3 +113,353 @@ class AsynchronousRequest(AsyncRClient):
         result = self.get(REQUEST_ENDPOINT + self.id + "/status")
         self.status = result["status"]
         return self.status
+
+    def future(self):
+        """
+        :return: concurrent.futures.Future of the request polled by the shared scheduler
+        """
+        return get_shared_scheduler(self).track(self)
+
+    def _set_finished(self, request):
+        # the scheduler could track other instance of the same request
+        self.status, self.response = request.status, request.response
+        return self
+
+    def wait(self, timeout=None):
+        """
+        Block until the request is finished.
+        :param timeout: optional max number of seconds
+        :return: True if the request is finished, otherwise False
+        """
+        try:
+            self._set_finished(self.future().result(timeout=timeout))
+            return True
+        except concurrent.futures.TimeoutError:
+            return False
+
+    async def result(self):
+        """
+        Wait (in asyncio event loop) until the request is finished.
+        :return: response of the request
+        """
+        self._set_finished(await asyncio.wrap_future(self.future()))
+        return self.response
+
+
+class _Tracked(object):
+    def __init__(self, request, interval):
+        self.request = request
+        self.future = concurrent.futures.Future()
+        self.interval = interval
+        self.next_check = time.monotonic() + interval
+
+
+class AsyncRequestScheduler(object):
+    """
+    Tracks many asynchronous requests and polls them until they are finished. Every request is checked
+    with its own exponential backoff, if many requests should be checked at once then the listing of
+    requests (get_requests) is used instead of one GET per request. Requests which are not on the first
+    max_pages pages of the listing are checked one by one.
+
+    Usage:
+        scheduler = AsyncRequestScheduler(client)
+        future = scheduler.track(client.submit(request, "__TYPE__"), callback=lambda request: print(request.response))
+        scheduler.run()  # or scheduler.start() to poll in background thread
+        request = future.result()
+    """
+
+    def __init__(self, client, min_interval=1.0, max_interval=60.0, backoff=2.0, list_threshold=10, max_pages=5):
+        """
+        :param client: AsyncRClient
+        :param min_interval: seconds to the first check of the request
+        :param max_interval: max seconds between two checks of the request
+        :param backoff: how the interval between checks grows
+        :param list_threshold: min number of requests to check at once to use the listing of requests
+        :param max_pages: max number of pages of the listing read in one poll
+        """
+        self.client = client
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.list_threshold = list_threshold
+        self.max_pages = max_pages
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.tracked = {}  # request id -> _Tracked
+        self.received = {}  # request id -> json of finished request resolved before it was tracked (webhook)
+        self.thread = None
+        self.running = False
+
+    def __len__(self):
+        with self.lock:
+            return len(self.tracked)
+
+    def track(self, request, callback=None, interval=None):
+        """
+        Start tracking of the request.
+        :param request: AsynchronousRequest
+        :param callback: optional function called with finished request
+        :param interval: optional seconds to the first check of the request, default is min_interval
+        :return: concurrent.futures.Future with the finished request
+        """
+        with self.lock:
+            tracked = self.tracked.get(request.id)
+            if tracked is None:
+                interval = self.min_interval if interval is None else interval
+                tracked = self.tracked[request.id] = _Tracked(request, interval)
+            request_json = self.received.pop(request.id, None)
+        if callback is not None:
+            tracked.future.add_done_callback(lambda future: callback(future.result()))
+        if request_json is not None:
+            self._finish(request.id, request_json[STATUS], request_json.get("response"))
+        elif request.status in FINISHED_STATUSES and request.response is not None:
+            self._finish(request.id, request.status, request.response)
+        self.wakeup.set()
+        return tracked.future
+
+    def resolve(self, request_json):
+        """
+        Finish the tracked request with received json (for example from webhook). Json of request which is not
+        tracked yet is kept and the request is finished when it is tracked.
+        :return: True if the request was tracked and it is finished now
+        """
+        if request_json.get(STATUS) not in FINISHED_STATUSES or ID not in request_json:
+            return False
+        with self.lock:
+            if request_json[ID] not in self.tracked:
+                if len(self.received) >= 10000:
+                    self.received.pop(next(iter(self.received)))
+                self.received[request_json[ID]] = request_json
+                return False
+        self._finish(request_json[ID], request_json[STATUS], request_json.get("response"))
+        return True
+
+    def _finish(self, request_id, status, response):
+        with self.lock:
+            tracked = self.tracked.pop(request_id, None)
+        if tracked is not None:
+            tracked.request.status, tracked.request.response = status, response
+            tracked.future.set_result(tracked.request)
+
+    def _postpone(self, tracked):
+        tracked.interval = min(tracked.interval * self.backoff, self.max_interval)
+        tracked.next_check = time.monotonic() + tracked.interval
+
+    def poll(self):
+        """
+        Check all the requests which should be checked now.
+        :return: number of requests finished in this poll
+        """
+        now = time.monotonic()
+        with self.lock:
+            due = dict((request_id, t) for request_id, t in self.tracked.items() if t.next_check <= now)
+        if not due:
+            return 0
+
+        finished = self._poll_listing(due) if len(due) >= self.list_threshold else self._poll_each(due)
+        for request_id, tracked in due.items():
+            if request_id not in finished:
+                self._postpone(tracked)
+        return len(finished)
+
+    def _poll_each(self, due):
+        finished = set()
+        for request_id in due:
+            try:
+                # one GET returns both status and response
+                request, _ = self.client.get_request(request_id)
+            except Exception as e:
+                continue
+            if request.status in FINISHED_STATUSES:
+                self._finish(request_id, request.status, request.response)
+                finished.add(request_id)
+        return finished
+
+    def _poll_listing(self, due):
+        finished, listed, page_url, pages = set(), set(), None, 0
+        while pages < self.max_pages and len(listed) < len(due):
+            try:
+                # listing of all the statuses, the requests which are listed as not finished are not checked again
+                page, page_url, _ = self.client.get_requests(page_url=page_url)
+            except Exception as e:
+                break
+            for request in page:
+                if request.id not in due or request.id in listed:
+                    continue
+                listed.add(request.id)
+                if request.status not in FINISHED_STATUSES:
+                    continue
+                if request.response is None:
+                    try:
+                        request, _ = self.client.get_request(request.id)
+                    except Exception as e:
+                        continue
+                self._finish(request.id, request.status, request.response)
+                finished.add(request.id)
+            pages += 1
+            if not page_url:
+                break
+            # next url contains the endpoint which is added again during the request
+            endpoint = self.client.endpoint
+            page_url = page_url.replace(endpoint, "").replace(endpoint.replace("https", "http"), "")
+
+        # requests which are not on the read pages of the listing are checked one by one
+        return finished | self._poll_each([request_id for request_id in due if request_id not in listed])
+
+    def next_check(self):
+        """
+        :return: seconds to the next needed check or None if nothing is tracked
+        """
+        with self.lock:
+            if not self.tracked:
+                return None
+            return max(min(t.next_check for t in self.tracked.values()) - time.monotonic(), 0.0)
+
+    def run(self, timeout=None):
+        """
+        Poll until all the tracked requests are finished.
+        :param timeout: optional max number of seconds
+        :return: True if all the requests are finished
+        """
+        end = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            self.poll()
+            wait = self.next_check()
+            if wait is None:
+                return True
+            if end is not None:
+                if time.monotonic() >= end:
+                    return False
+                wait = min(wait, end - time.monotonic())
+            time.sleep(wait)
+
+    def start(self):
+        """
+        Start polling in daemon thread, the thread waits while nothing is tracked.
+        """
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+            self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _loop(self):
+        while self.running:
+            self.wakeup.clear()
+            try:
+                self.poll()
+            except Exception as e:
+                pass
+            self.wakeup.wait(self.next_check())
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # http.server.ThreadingHTTPServer is available only since python 3.7
+    daemon_threads = True
+
+
+class WebhookReceiver(object):
+    """
+    Local HTTP server which receives webhooks of finished asynchronous requests, so they do not need to be polled.
+    The webhooks resolve the shared scheduler of the client, so they finish also wait(), result(), future() and
+    as_completed() of the requests. Requests are still polled with long intervals as fallback if the webhook
+    does not arrive.
+
+    Usage:
+        receiver = WebhookReceiver(client, "0.0.0.0", 8080, public_url="https://__HOST__/ximilar", secret="__SECRET__")
+        receiver.start()
+        future = receiver.submit(request, "__TYPE__")
+        print(future.result().response)
+        receiver.stop()
+    """
+
+    def __init__(self, client, host="127.0.0.1", port=8080, public_url=None, secret=None, fallback_interval=60.0):
+        """
+        :param client: AsyncRClient
+        :param host: interface to listen on, secret is required for other than local interface
+        :param port: port to listen on (0 for any free port)
+        :param public_url: url of this receiver reachable from the internet (default http://host:port/)
+        :param secret: string which must be in X-Webhook-Secret header of every webhook
+        :param fallback_interval: seconds to the first polling of the request
+        """
+        if secret is None and host not in LOCAL_HOSTS:
+            raise Exception("Please specify secret of the webhooks when listening on " + host + "!")
+
+        self.client = client
+        self.secret = secret
+        self.fallback_interval = fallback_interval
+        self.scheduler = get_shared_scheduler(client)
+        self.server = _ThreadingHTTPServer((host, port), self._handler())
+        self.public_url = public_url if public_url else "http://%s:%d/" % (host, self.server.server_address[1])
+        self.thread = None
+
+    def _handler(self):
+        receiver = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                if receiver.secret is not None and self.headers.get("X-Webhook-Secret") != receiver.secret:
+                    self.send_response(403)
+                    self.end_headers()
+                    return
+                try:
+                    body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                    receiver.receive(json.loads(body))
+                    self.send_response(200)
+                except Exception as e:
+                    self.send_response(400)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def receive(self, request_json):
+        """
+        Process webhook with json of the request.
+        """
+        if request_json.get(STATUS) in FINISHED_STATUSES and request_json.get("response") is None:
+            # webhook without the response, the finished request is downloaded
+            request, _ = self.client.get_request(request_json[ID])
+            request_json = dict(request_json, status=request.status, response=request.response)
+        self.scheduler.resolve(request_json)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.scheduler.start()
+
+    def stop(self):
+        """
+        Stop the server, the shared scheduler keeps polling the requests.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+    def webhook(self):
+        """
+        :return: webhook definition which is sent with the request
+        """
+        webhook = {"endpoint": self.public_url}
+        if self.secret is not None:
+            webhook["headers"] = {"X-Webhook-Secret": self.secret}
+        return webhook
+
+    def submit(self, request, type, **kwargs):
+        """
+        Submit the request with webhook to this receiver.
+        :return: concurrent.futures.Future with the finished AsynchronousRequest
+        """
+        return self.track(self.client.submit(request, type, webhook=self.webhook(), **kwargs))
+
+    def track(self, request):
+        return self.scheduler.track(request, interval=self.fallback_interval)
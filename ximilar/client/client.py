@@ -1,9 +1,8 @@
 import requests
 import json
-import base64
 import cv2
 import os
-import re
+import time
 import numpy as np
 import concurrent.futures
 import urllib.parse
@@ -12,10 +11,32 @@ from tqdm import tqdm
 
 from ximilar.client.constants import *
 from ximilar.client.exceptions import XimilarClientException
+from ximilar.client.utils.base64_data import base64_payload, decode_base64, encode_base64
 from ximilar.client.utils.decorators import retry_when
+from ximilar.client.utils.image_probe import JPEG, probe_base64
+from ximilar.client.utils.metrics import DEFAULT_REGISTRY
+from ximilar.client.utils.resize import fit_size, resize_batch
+from ximilar.client.utils.singleflight import SingleFlight
 
 CONFIG_ENDPOINT = "account/v2/config/"
-BASE64_HEADER_PATTERN = re.compile(r"^data:image/(\w+);base64,")
+
+# in-flight GET requests shared by all the clients (entities like Task, Label, ... are separate clients)
+GET_FLIGHTS = SingleFlight()
+
+
+def record_retry(http_method=None):
+    """
+    Creates hook for retry_when decorator which records the retry to the metrics of the client (first argument).
+    :param http_method: name of http method, if None then it is taken from the 'method' argument (default POST)
+    """
+
+    def hook(args, kwargs, exception):
+        client = args[0]
+        api_endpoint = args[1] if len(args) > 1 else kwargs.get("api_endpoint", "")
+        method = http_method or kwargs.get("method", requests.post).__name__.upper()
+        client.metrics.record_retry(method, api_endpoint, exception)
+
+    return hook
 
 
 class RestClient(object):
@@ -25,9 +46,16 @@ class RestClient(object):
     All objects contains TOKEN and ENDPOINT information.
     """
 
-    def __init__(self, token, endpoint=ENDPOINT, max_image_size=600, resource_name="", request_timeout=90):
+    def __init__(
+        self, token, endpoint=ENDPOINT, max_image_size=600, resource_name="", request_timeout=90, metrics=None
+    ):
         self.token = token
         self.cache = {}
+        self.metrics = metrics if metrics is not None else DEFAULT_REGISTRY
+        self.coalesce_get = True
+        self.dedup = None
+        self.encoding_policy = None
+        self.encoding_policies = {}  # api endpoint -> EncodingPolicy
         self.endpoint = endpoint
         self.max_image_size = max_image_size
         self.headers = {
@@ -84,7 +112,36 @@ class RestClient(object):
         url = "/".join(map(lambda x: str(x).rstrip("/").lstrip("/"), args))
         return url
 
-    @retry_when(ConnectionError)
+    def send_request(self, method, api_endpoint, url, **kwargs):
+        """
+        Send the http request with requests lib and record its latency and size to the metrics.
+        :param method: requests.get, requests.post, ...
+        :param api_endpoint: endpoint path (used for the metrics)
+        :param url: full url of the request
+        :return: response
+        """
+        data = kwargs.get("data", None)
+        bytes_sent = len(data) if isinstance(data, (str, bytes)) else 0
+        start = time.perf_counter()
+        try:
+            result = method(url, **kwargs)
+        except Exception:
+            self.metrics.record_request(
+                method.__name__.upper(), api_endpoint, time.perf_counter() - start, bytes_sent=bytes_sent
+            )
+            raise
+
+        self.metrics.record_request(
+            method.__name__.upper(),
+            api_endpoint,
+            time.perf_counter() - start,
+            bytes_sent=bytes_sent,
+            bytes_received=len(result.content),
+            status_code=result.status_code,
+        )
+        return result
+
+    @retry_when(ConnectionError, on_retry=record_retry("GET"))
     def get(self, api_endpoint, data=None, params=None):
         """
         Call the http GET request with data.
@@ -93,8 +150,22 @@ class RestClient(object):
         :param params: optional dictionary of URL params
         :return: json response
         """
-        result = requests.get(
-            self.urljoin(self.endpoint, api_endpoint),
+        url = self.urljoin(self.endpoint, api_endpoint)
+        if not self.coalesce_get:
+            return self._get_json(api_endpoint, url, data, params)
+
+        # concurrent identical requests (same url, params, data and headers/token) share one http call
+        key = (url, repr(sorted(params.items())) if params else None, repr(data), repr(sorted(self.headers.items())))
+        result, shared = GET_FLIGHTS.do(key, self._get_json, api_endpoint, url, data, params)
+        if shared:
+            self.metrics.record_coalesced("GET", api_endpoint)
+        return result
+
+    def _get_json(self, api_endpoint, url, data, params):
+        result = self.send_request(
+            requests.get,
+            api_endpoint,
+            url,
             params=params,
             headers=self.headers,
             data=data,
@@ -102,7 +173,7 @@ class RestClient(object):
         )
         return result.json()
 
-    @retry_when(ConnectionError)
+    @retry_when(ConnectionError, on_retry=record_retry())
     def post(self, api_endpoint, data=None, files=None, params=None, method=requests.post, headers=None):
         """
         Call the http POST request with data.
@@ -121,7 +192,9 @@ class RestClient(object):
         if data is not None:
             data = json.dumps(data)
 
-        result = method(
+        result = self.send_request(
+            method,
+            api_endpoint,
             self.urljoin(self.endpoint, api_endpoint),
             params=params,
             headers=self.headers if headers is None else headers,
@@ -129,6 +202,8 @@ class RestClient(object):
             files=files,
             timeout=self.request_timeout,
         )
+        # GET which started before this write could return stale data, so later GETs must not join it
+        GET_FLIGHTS.forget()
         # todo: check JSON RESULT CODES -> raise XimilarClientException
         # todo: check HTTP STATUS CODES -> raise XimilarClientException
         try:
@@ -137,21 +212,21 @@ class RestClient(object):
         except ValueError as e:
             return None
 
-    @retry_when(ConnectionError)
+    @retry_when(ConnectionError, on_retry=record_retry("PUT"))
     def put(self, api_endpoint, data=None, files=None, params=None):
         """
         Call the http PUT request with data
         """
         return self.post(api_endpoint, data=data, files=files, params=params, method=requests.put)
 
-    @retry_when(ConnectionError)
+    @retry_when(ConnectionError, on_retry=record_retry("PATCH"))
     def patch(self, api_endpoint, data=None, files=None, params=None):
         """
         Call the http PATCH request with data
         """
         return self.post(api_endpoint, data=data, files=files, params=params, method=requests.patch)
 
-    @retry_when(ConnectionError)
+    @retry_when(ConnectionError, on_retry=record_retry("DELETE"))
     def delete(self, api_endpoint, data=None, params=None):
         """
         Call the http DELETE request with data.
@@ -163,7 +238,16 @@ class RestClient(object):
         self.invalidate()
 
         url = urllib.parse.urljoin(self.endpoint, api_endpoint)
-        result = requests.delete(url, params=params, headers=self.headers, data=data, timeout=self.request_timeout)
+        result = self.send_request(
+            requests.delete,
+            api_endpoint,
+            url,
+            params=params,
+            headers=self.headers,
+            data=data,
+            timeout=self.request_timeout,
+        )
+        GET_FLIGHTS.forget()
 
         if result.status_code == HTTP_NO_CONTENT_204:
             return result
@@ -272,21 +356,18 @@ class RestClient(object):
         if not resize or self.max_image_size == 0:
             return image_data
 
-        height, width, _ = image_data.shape
-        if height > self.max_image_size and width > self.max_image_size and not aspect_ratio:
-            image_data = cv2.resize(image_data, (self.max_image_size, self.max_image_size))
-        if height > self.max_image_size and width > self.max_image_size and aspect_ratio:
-            image_data = cv2.resize(image_data, self.get_aspect_ratio_dim(image_data, self.max_image_size))
-        return image_data
+        return self.resize_images([image_data], aspect_ratio=aspect_ratio)[0]
+
+    def resize_images(self, images, aspect_ratio=True):
+        """
+        Resize batch of images that are no bigger than max_size, the resized images share one buffer.
+        :param images: list of cv2/np ndarray
+        :return: list of cv2/np ndarray
+        """
+        return resize_batch(images, self.max_image_size, aspect_ratio=aspect_ratio)
 
     def get_aspect_ratio_dim(self, image, img_size):
-        if image.shape[0] > image.shape[1]:
-            r = float(img_size) / image.shape[1]
-            dim = (img_size, int(image.shape[0] * r))
-        else:
-            r = float(img_size) / image.shape[0]
-            dim = (int(image.shape[1] * r), img_size)
-        return dim
+        return fit_size(image.shape[0], image.shape[1], img_size, shorter=True)
 
     def cv2_imread(self, path):
         image = cv2.imread(str(path))
@@ -306,24 +387,36 @@ class RestClient(object):
         cv2.imwrite(path, image)
         return True
 
-    def load_base64_file(self, path, resize=True):
+    def get_encoding_policy(self, api_endpoint=None):
+        """
+        :param api_endpoint: endpoint where the images are sent, default is PREDICT_ENDPOINT of the client
+        :return: EncodingPolicy of the endpoint (encoding_policies), otherwise encoding_policy of the client or None
+        """
+        if api_endpoint is None:
+            api_endpoint = getattr(self, "PREDICT_ENDPOINT", None)
+        return self.encoding_policies.get(api_endpoint, self.encoding_policy)
+
+    def load_base64_file(self, path, resize=True, encoding_policy=None):
         """
         Load file from disk to base64.
         :param path: local path to the image
+        :param encoding_policy: EncodingPolicy for this call, default is the policy of PREDICT_ENDPOINT
         :return: base64 encoded string
         """
-        # if the image is quite small then just convert it to base64
-        if (not resize) or os.stat(path).st_size / (1024 * 1024) < 0.1:
+        # if the image is quite small (and fits the encoding policy) then just convert it to base64
+        encoding_policy = encoding_policy or self.get_encoding_policy()
+        size = os.stat(path).st_size
+        if (not resize) or (size / (1024 * 1024) < 0.1 and (encoding_policy is None or encoding_policy.fits(size))):
             with open(path, "rb") as image_file:
-                encoded_string = base64.b64encode(image_file.read()).decode("utf-8")
+                encoded_string = encode_base64(image_file.read(), header=None)
             return encoded_string
 
         # otherwise convert it to cv2 matrix, then encode it  and then to base64
         image = self.cv2_imread(path)
-        image = self.cv2img_to_base64(image, image_space="BGR", resize=resize)
+        image = self.cv2img_to_base64(image, image_space="BGR", resize=resize, encoding_policy=encoding_policy)
         return image
 
-    def cv2img_to_base64(self, image, image_space="RGB", resize=True):
+    def cv2img_to_base64(self, image, image_space="RGB", resize=True, encoding_policy=None):
         """
         Load raw numpy/cv2 data of image to base64. The input image to this method should have RGB order.
         The ximilar accepts base64 data to have BGR order that is why we convert it here.
@@ -334,29 +427,49 @@ class RestClient(object):
         :param image: numpy/cv2 data with RGB order
         :param image_space: from which color space we are converting (default RGB)
         :param resize: if we want to resize image
+        :param encoding_policy: EncodingPolicy for this call, default is the policy of PREDICT_ENDPOINT
         :return: base64 encoded string
         """
         image = self._convert_image_to_bgr(image, image_space)
         image = self.resize_image_data(image, resize=resize)
+
+        encoding_policy = encoding_policy or self.get_encoding_policy()
+        if encoding_policy is not None:
+            return encode_base64(encoding_policy.encode(image), header=encoding_policy.header)
+
         retval, buffer = cv2.imencode(".jpg", image, params=[cv2.IMWRITE_JPEG_QUALITY, 96])
-        jpg_as_text = "data:image/jpeg;base64," + base64.b64encode(buffer).decode("utf-8")
-        return jpg_as_text
+        return encode_base64(buffer)
+
+    def is_compliant_base64(self, base64image, encoding_policy=None):
+        """
+        Check only from the header of the image if the base64 data can be sent as they are, which means jpeg image
+        with 3 channels, normal exif orientation and size which would not be changed by resize_image_data
+        (and which fits the target size of the encoding policy).
+        :param base64image: base64 image encoded
+        :param encoding_policy: EncodingPolicy for this call, default is the policy of PREDICT_ENDPOINT
+        :return: True if the data do not need to be decoded and encoded again
+        """
+        if not isinstance(base64image, str):
+            return False
+
+        encoding_policy = encoding_policy or self.get_encoding_policy()
+        if encoding_policy is not None and not encoding_policy.fits(len(base64_payload(base64image)) * 3 // 4):
+            return False
+
+        info = probe_base64(base64image)
+        if info is None or info["format"] != JPEG or info["channels"] != 3 or info.get("orientation", 1) != 1:
+            return False
+        return not (info["width"] > self.max_image_size and info["height"] > self.max_image_size)
 
     def base64_to_cv2img(self, base64image):
         """
         Convert base64 data to image in BGR format.
-        :param base64image: base64 image encoded
+        :param base64image: base64 image encoded (str, bytes or memoryview, with or without header)
         :return: opencv2/numpy image
         """
         try:
-            header = BASE64_HEADER_PATTERN.match(base64image)
-            if header:
-                base64data = BASE64_HEADER_PATTERN.sub("", base64image)
-                base64image = base64data
-
-            img_array = base64.b64decode(base64image)
-
-            image = np.frombuffer(img_array, dtype=np.uint8)
+            # the header is skipped by slicing and the data are decoded without any intermediate copy
+            image = np.frombuffer(decode_base64(base64image), dtype=np.uint8)
             image = cv2.imdecode(image, 1)
             if image.shape[2] != 3:
                 raise Exception("Image has not shape (height, width, 3)")
@@ -380,15 +493,21 @@ class RestClient(object):
         image = self.cv2img_to_base64(image, resize=resize)
         return image
 
-    def preprocess_records(self, records):
+    def preprocess_records(self, records, encoding_policy=None, api_endpoint=None):
         """
         Preprocess all records (list of dictionaries with possible '_base64'|'_file'|'_url' fields
         before processing/upload to Ximilar Application.
         :param records: list of dictionaries
+        :param encoding_policy: EncodingPolicy for this call, default is the policy of the endpoint
+        :param api_endpoint: endpoint where the records are sent, default is PREDICT_ENDPOINT of the client
         :return: modified list of dictionaries
         """
+        encoding_policy = encoding_policy or self.get_encoding_policy(api_endpoint)
+        start = time.perf_counter()
+
         # (shallow) copy the records in order not to modify the incoming dictionaries
         records = [rec.copy() for rec in records]
+        resized = self._resize_image_data_records(records)
         for i in range(len(records)):
             if (
                 FILE not in records[i]
@@ -403,27 +522,83 @@ class RestClient(object):
             noresize = NORESIZE in records[i] and records[i][NORESIZE]
 
             if FILE in records[i] and BASE64 not in records[i] and IMG_DATA not in records[i]:
-                records[i][BASE64] = self.load_base64_file(records[i][FILE], resize=not noresize)
+                records[i][BASE64] = self.load_base64_file(
+                    records[i][FILE], resize=not noresize, encoding_policy=encoding_policy
+                )
             elif (BASE64 in records[i] or URL in records[i]) and (noresize or self.max_image_size == 0):
                 # if we have base64 and we do not want to resize it at all
                 pass
+            elif BASE64 in records[i] and self.is_compliant_base64(records[i][BASE64], encoding_policy):
+                # jpeg which does not need resizing is sent as it is, without decoding and encoding again
+                pass
             elif BASE64 in records[i]:
                 # if we have base64 and we need to resize it
                 image = self.base64_to_cv2img(records[i][BASE64])
-                records[i][BASE64] = self.cv2img_to_base64(image, image_space="BGR", resize=not noresize)
+                records[i][BASE64] = self.cv2img_to_base64(
+                    image, image_space="BGR", resize=not noresize, encoding_policy=encoding_policy
+                )
+            elif i in resized:
+                records[i][BASE64] = self.cv2img_to_base64(
+                    resized[i],
+                    image_space=records[i].get(COLOR_SPACE, "RGB"),
+                    resize=False,
+                    encoding_policy=encoding_policy,
+                )
             elif IMG_DATA in records[i]:
                 records[i][BASE64] = self.cv2img_to_base64(
                     records[i][IMG_DATA],
                     image_space=records[i][COLOR_SPACE] if COLOR_SPACE in records[i] else "RGB",
                     resize=not noresize,
+                    encoding_policy=encoding_policy,
                 )
 
             # finally we need to delete the image data and just send url or base64
             if IMG_DATA in records[i]:
                 del records[i][IMG_DATA]
 
+        self.metrics.record_preprocessing(self._type(), time.perf_counter() - start, records=len(records))
         return records
 
+    def _resize_image_data_records(self, records):
+        """
+        Resize image data of the records (which are going to be encoded) in one batch.
+        :return: dictionary index of record -> resized image
+        """
+        # resizing before the color conversion gives same result only for the channel swap (RGB -> BGR)
+        indexes = [
+            i
+            for i, record in enumerate(records)
+            if IMG_DATA in record
+            and BASE64 not in record
+            and URL not in record
+            and not record.get(NORESIZE)
+            and record.get(COLOR_SPACE, "RGB") in ["RGB", "BGR"]
+        ]
+        if not indexes or self.max_image_size == 0:
+            return {}
+        return dict(zip(indexes, self.resize_images([records[i][IMG_DATA] for i in indexes])))
+
+    def deduplicate_records(self, records, same_id=False, register=True):
+        """
+        Filter duplicate records with the dedup index (DedupIndex) of the client, if it is set.
+        :param records: list of dictionaries
+        :param same_id: if True then only records with the same _id (and image) are duplicates
+        :param register: if False then the unique records must be registered by register_records after they were sent
+        :return: list of unique records, list of duplicate records
+        """
+        if self.dedup is None:
+            return records, []
+        return self.dedup.filter(records, same_id=same_id, register=register)
+
+    def register_records(self, records):
+        """
+        Add the successfully sent records to the dedup index of the client, if it is set.
+        :param records: list of dictionaries
+        """
+        if self.dedup is not None:
+            for record in records:
+                self.dedup.register(record)
+
     def custom_endpoint_processing(self, records, endpoint):
         """
         Records processing for your custom endpoint.
@@ -90,6 +90,12 @@ COLOR = "color"
 REAL_IMAGE = "real"
 VALUES = "values"
 
+# Dominant colors
+DOMINANT_COLORS = "_dominant_colors"
+RGB_COLORS = "rgb_colors"
+LAB_COLORS = "lab_colors"
+PERCENTAGES = "percentages"
+
 # Flows
 TOP_NODE = "top_node"
 VALID = "valid"
@@ -104,3 +110,6 @@ QUERY_RECORD = "query_record"
 COLLECTION = "collection"
 COLLECTION_ID = "collection-id"
 ANSWER_RECORDS = "answer_records"
+ANSWER_COUNT = "answer_count"
+DESCRIPTOR = "_descriptor"
+DISTANCE = "_distance"
@@ -1,9 +1,8 @@
 from ximilar.client import RecognitionClient
 from ximilar.client.recognition import Image, IMAGE_ENDPOINT
 from ximilar.client.constants import *
+from ximilar.client.utils.crops import CropPipeline, crop_view, decode_image
 
-from urllib.request import urlopen
-import numpy as np
 import cv2
 
 
@@ -322,6 +321,22 @@ class DetectionClient(RecognitionClient):
         self.check_json_status(result)
         return result
 
+    def extract_objects_images(self, objects, transform=None, max_workers=4):
+        """
+        Cut images of many objects, every image is downloaded and decoded only once for all its objects.
+
+        Usage:
+            for obj, crop in client.extract_objects_images(objects, transform=lambda obj, crop: crop.copy()):
+                ...
+
+        :param objects: list of DetectionObject
+        :param transform: function (object, crop) -> result which runs concurrently, default returns copy of crop
+        :param max_workers: number of concurrent transforms
+        :return: generator of (object, result)
+        """
+        pipeline = CropPipeline(transform=transform, max_workers=max_workers, flags=cv2.IMREAD_UNCHANGED)
+        return pipeline.process_objects(objects)
+
 
 class DetectionTask(DetectionClient):
     def __init__(self, token, endpoint, task_json, max_image_size):
@@ -596,11 +611,8 @@ class DetectionObject(DetectionClient):
         }
 
     def extract_object_image(self):
-        xmin, ymin, xmax, ymax = self.data
-        response = urlopen(self.image[IMG_PATH])
-        arr = np.asarray(bytearray(response.read()), dtype="uint8")
-        img = cv2.imdecode(arr, cv2.IMREAD_UNCHANGED)
-        return img[ymin:ymax, xmin:xmax]
+        # copy of the crop, so the full image is not held in memory (use extract_objects_images for many objects)
+        return crop_view(decode_image(self.image[IMG_PATH], cv2.IMREAD_UNCHANGED), self.data).copy()
 
     def get_bbox(self):
         return self.data
@@ -1,3 +1,10 @@
+import concurrent.futures
+import copy
+import hashlib
+import json
+import threading
+import time
+
 from ximilar.client import RestClient
 from ximilar.client.constants import *
 
@@ -9,18 +16,36 @@ class FlowsClient(RestClient):
         super().__init__(token=token, endpoint=endpoint, max_image_size=max_image_size, resource_name=resource_name)
 
         self.PREDICT_ENDPOINT = "/flows/v2/process"
+        self.flow_registry = None
+
+    def flow_client(self, flow):
+        """
+        Client which preprocesses records for the flow (Flow entity resizes images to image_size of the flow).
+        :param flow: flow id or Flow entity
+        """
+        if isinstance(flow, Flow):
+            return flow
+        if self.flow_registry is not None:
+            cached = self.flow_registry.get(flow)
+            if cached is not None:
+                return cached
+        return self
 
     def construct_data(self, flow=None, records=None, store_images=None):
         if flow is None or records is None or len(records) == 0:
             raise Exception("Please specify flow and records!")
 
-        data = {"flow": flow, RECORDS: self.preprocess_records(records)}
+        records = self.flow_client(flow).preprocess_records(records)
+        data = {"flow": flow.id if isinstance(flow, Flow) else flow, RECORDS: records}
         if store_images is not None:
             data[STORE_IMAGES] = store_images
 
         return data
 
     def get_all_flows(self):
+        if self.flow_registry is not None:
+            return self.flow_registry.get_all()
+
         flows, status = self.get_all_paginated_items(FLOW_ENDPOINT)
 
         if not flows and status[STATUS] == STATUS_ERROR:
@@ -29,6 +54,10 @@ class FlowsClient(RestClient):
         return [Flow(self.token, self.endpoint, flow_json) for flow_json in flows], RESULT_OK
 
     def get_flow(self, flow_id):
+        if self.flow_registry is not None:
+            flow = self.flow_registry.get(flow_id)
+            return flow, RESULT_OK if flow is not None else RESULT_ERROR
+
         flow_json = self.get(FLOW_ENDPOINT + flow_id)
 
         if DETAIL in flow_json:
@@ -36,10 +65,62 @@ class FlowsClient(RestClient):
 
         return Flow(self.token, self.endpoint, flow_json, max_image_size=self.max_image_size), RESULT_OK
 
+    def get_flow_json(self, flow_id):
+        """
+        Returns full definition of the flow in json format.
+        """
+        return self.get(FLOW_ENDPOINT + str(flow_id) + "/json")
+
     def process_flow(self, flow, records, store_images=None):
         data = self.construct_data(flow=flow, records=records, store_images=store_images)
         return self.post(self.PREDICT_ENDPOINT, data=data)
 
+    def process_flows(self, flows, records, store_images=None, max_workers=None):
+        """
+        Process the records by several flows, the records are preprocessed only once and the flows are
+        called concurrently.
+        :param flows: list of flow ids (or Flow entities), flow given several times is processed only once
+        :param records: list of dictionaries with _url, _file, _base64
+        :param max_workers: number of concurrent requests, default is number of flows
+        :return: json with records (for every record dictionary flow id -> result record) and status of every flow
+        """
+        # results are keyed by the flow id, so the repeated flows are removed
+        unique = {}
+        for flow in flows:
+            unique.setdefault(flow.id if isinstance(flow, Flow) else flow, flow)
+        flow_ids = list(unique)
+        if not flow_ids or not records:
+            raise Exception("Please specify flows and records!")
+
+        # flows with same image size share the preprocessed records
+        clients = {flow_id: self.flow_client(flow) for flow_id, flow in unique.items()}
+        preprocessed = {}
+        for client in clients.values():
+            if client.max_image_size not in preprocessed:
+                preprocessed[client.max_image_size] = client.preprocess_records(records)
+
+        def process(flow_id):
+            data = {"flow": flow_id, RECORDS: preprocessed[clients[flow_id].max_image_size]}
+            if store_images is not None:
+                data[STORE_IMAGES] = store_images
+            try:
+                return self.post(self.PREDICT_ENDPOINT, data=data)
+            except Exception as e:
+                return {STATUS: {"code": 500, "text": str(e)}}
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or len(flow_ids)) as executor:
+            results = dict(zip(flow_ids, executor.map(process, flow_ids)))
+
+        merged, statuses = [{} for _ in records], {}
+        for flow_id, result in results.items():
+            if not isinstance(result, dict):
+                result = {STATUS: {"code": 500, "text": "Unable to parse the response."}}
+            statuses[flow_id] = result.get(STATUS)
+            flow_records = result.get(RECORDS, [])
+            for i in range(len(records)):
+                merged[i][flow_id] = flow_records[i] if len(flow_records) == len(records) else None
+        return {RECORDS: merged, STATUS: statuses}
+
 
 class Flow(FlowsClient):
     """
@@ -47,6 +128,11 @@ class Flow(FlowsClient):
     """
 
     def __init__(self, token, endpoint, flow_json, max_image_size=512):
+        """
+        :param max_image_size: size of the images sent to the flow, None for image_size of the flow
+        """
+        image_size = int(flow_json["image_size"]) if "image_size" in flow_json else 512
+        max_image_size = image_size if max_image_size is None else max_image_size
         super().__init__(token, endpoint=endpoint, max_image_size=max_image_size, resource_name="")
 
         self.id = flow_json[ID]
@@ -55,16 +141,144 @@ class Flow(FlowsClient):
         self.workspace = flow_json[WORKSPACE]
         self.top_node = flow_json[TOP_NODE]
         self.valid = flow_json[VALID]
-        self.image_size = int(flow_json["image_size"]) if "image_size" in flow_json else 512
+        self.image_size = image_size
 
     def to_json(self):
         """
         Returns flow in json format.
         """
-        return self.get("/flows/v2/flow/" + str(self.id) + "/json")
+        if self.flow_registry is not None:
+            return self.flow_registry.get_json(self.id)
+        return self.get_flow_json(self.id)
 
     def process(self, records, store_images=None):
         """
         Call processing of the flow.
         """
         return self.process_flow(self.id, records, store_images=store_images)
+
+
+def flow_fingerprint(flow_json):
+    """
+    :return: sha1 of the flow json, used for detection of changed flows
+    """
+    return hashlib.sha1(json.dumps(flow_json, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class FlowRegistry(object):
+    """
+    Cache of the flows with TTL. After the TTL expires the flow is fetched again (or all flows with one paginated
+    listing), if the flow did not change then the same Flow entity is kept, otherwise new Flow entity is created.
+    The json definitions (which can change also without change of the flow) are cached with the same TTL.
+    Flows from the registry preprocess the records with image_size of the flow.
+
+    Usage:
+        client = FlowsClient("__API_TOKEN__")
+        client.flow_registry = FlowRegistry(client, ttl=300)
+        flow, status = client.get_flow("__FLOW_ID__")
+        client.process_flow("__FLOW_ID__", records)
+    """
+
+    def __init__(self, client, ttl=300):
+        """
+        :param client: FlowsClient
+        :param ttl: how many seconds is the flow valid without checking the api
+        """
+        self.client = client
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.flows = {}  # id -> (expires, fingerprint, Flow)
+        self.definitions = {}  # id -> (expires, fingerprint, json definition)
+        self.listing = None  # (expires, list of ids) of the last get_all
+        self.refreshes, self.changes = 0, 0
+
+    def _store(self, flow_json, expires):
+        fingerprint = flow_fingerprint(flow_json)
+        with self.lock:
+            self.refreshes += 1
+            cached = self.flows.get(flow_json[ID])
+            if cached is not None and cached[1] == fingerprint:
+                self.flows[flow_json[ID]] = (expires, fingerprint, cached[2])
+                return cached[2]
+
+            if cached is not None:
+                self.changes += 1
+            flow = Flow(self.client.token, self.client.endpoint, flow_json, max_image_size=None)
+            flow.headers = self.client.headers
+            flow.flow_registry = self
+            self.flows[flow_json[ID]] = (expires, fingerprint, flow)
+            return flow
+
+    def get(self, flow_id, refresh=False):
+        """
+        :param refresh: ignore the TTL and check the flow in the api
+        :return: Flow or None if the flow does not exist
+        """
+        with self.lock:
+            cached = self.flows.get(flow_id)
+        if cached is not None and cached[0] > time.time() and not refresh:
+            return cached[2]
+
+        flow_json = self.client.get(FLOW_ENDPOINT + str(flow_id))
+        if not isinstance(flow_json, dict) or ID not in flow_json:
+            self.invalidate(flow_id)
+            return None
+        return self._store(flow_json, time.time() + self.ttl)
+
+    def get_all(self, refresh=False):
+        """
+        :param refresh: ignore the TTL and list the flows in the api
+        :return: list of Flow entities, status
+        """
+        now = time.time()
+        with self.lock:
+            listing = self.listing
+            if listing is not None and listing[0] > now and not refresh:
+                flows = [self.flows[flow_id][2] for flow_id in listing[1] if flow_id in self.flows]
+                if len(flows) == len(listing[1]):
+                    return flows, RESULT_OK
+
+        items, status = self.client.get_all_paginated_items(FLOW_ENDPOINT)
+        if not items and status[STATUS] == STATUS_ERROR:
+            return None, status
+
+        expires = time.time() + self.ttl
+        flows = [self._store(flow_json, expires) for flow_json in items]
+        with self.lock:
+            for flow_id in set(self.flows).difference(flow.id for flow in flows):
+                del self.flows[flow_id]
+            self.listing = (expires, [flow.id for flow in flows])
+        return flows, RESULT_OK
+
+    def get_json(self, flow_id):
+        """
+        :return: full json definition of the flow, downloaded again if the flow changed or the TTL expired
+        """
+        flow = self.get(flow_id)
+        if flow is None:
+            return self.client.get_flow_json(flow_id)
+
+        with self.lock:
+            fingerprint = self.flows[flow_id][1] if flow_id in self.flows else None
+            cached = self.definitions.get(flow_id)
+        if cached is not None and cached[0] > time.time() and cached[1] == fingerprint:
+            return copy.deepcopy(cached[2])
+
+        definition = self.client.get_flow_json(flow_id)
+        if isinstance(definition, dict) and DETAIL not in definition:
+            with self.lock:
+                self.definitions[flow_id] = (time.time() + self.ttl, fingerprint, copy.deepcopy(definition))
+        return definition
+
+    def invalidate(self, flow_id=None):
+        """
+        Remove the flow (or all flows if flow_id is None) from the registry.
+        """
+        with self.lock:
+            if flow_id is None:
+                self.flows.clear()
+                self.definitions.clear()
+            else:
+                self.flows.pop(flow_id, None)
+                self.definitions.pop(flow_id, None)
+            self.listing = None
@@ -4,6 +4,9 @@ import json
 from ximilar.client import RestClient
 from ximilar.client.constants import *
 from ximilar.client.exceptions import XimilarClientInvalidDataException
+from ximilar.client.utils.entity_cache import ENTITY_CACHE
+from ximilar.client.utils.result_cache import ResultCache
+from ximilar.client.utils.workspace_index import WorkspaceIndex
 
 LABEL_ENDPOINT = "recognition/v2/label/"
 TASK_ENDPOINT = "recognition/v2/task/"
@@ -29,6 +32,20 @@ class RecognitionClient(RestClient):
         self.workspace = workspace  # this must be set before calling supers
         super().__init__(token=token, endpoint=endpoint, max_image_size=max_image_size, resource_name=resource_name)
         self.PREDICT_ENDPOINT = CLASSIFY_ENDPOINT
+        self.entity_cache = ENTITY_CACHE
+        self.result_cache = None
+
+    def cache_namespace(self):
+        """
+        Entities in the entity cache are separated by endpoint and authorization of the client.
+        """
+        return self.endpoint, self.headers["Authorization"]
+
+    def invalidate_label(self, label_id):
+        """
+        Drop cached json of label (for example after its images or tasks were modified).
+        """
+        self.entity_cache.invalidate(self.cache_namespace(), LABEL_ENDPOINT, label_id)
 
     def get(self, api_endpoint, data=None, params=None):
         """
@@ -58,19 +75,25 @@ class RecognitionClient(RestClient):
         """
         Getting recognition task by the id/uuid.
         """
-        task_json = self.get(TASK_ENDPOINT + task_id)
-        if ID not in task_json:
-            status = {STATUS: task_json[DETAIL]} if DETAIL in task_json else {STATUS: "Not Found"}
-            return None, status
+        task_json = self.entity_cache.get(self.cache_namespace(), TASK_ENDPOINT, task_id)
+        if task_json is None:
+            task_json = self.get(TASK_ENDPOINT + task_id)
+            if ID not in task_json:
+                status = {STATUS: task_json[DETAIL]} if DETAIL in task_json else {STATUS: "Not Found"}
+                return None, status
+            self.entity_cache.put(self.cache_namespace(), TASK_ENDPOINT, task_json)
         return Task(self.token, self.endpoint, task_json), RESULT_OK
 
     def get_label(self, label_id):
         """
         Getting recognition label by the id/uuid.
         """
-        label_json = self.get(LABEL_ENDPOINT + label_id)
-        if ID not in label_json:
-            return None, {STATUS: "label with id not found"}
+        label_json = self.entity_cache.get(self.cache_namespace(), LABEL_ENDPOINT, label_id)
+        if label_json is None:
+            label_json = self.get(LABEL_ENDPOINT + label_id)
+            if ID not in label_json:
+                return None, {STATUS: "label with id not found"}
+            self.entity_cache.put(self.cache_namespace(), LABEL_ENDPOINT, label_json)
         return Label(self.token, self.endpoint, label_json), RESULT_OK
 
     def get_model(self, model_id):
@@ -102,6 +125,11 @@ class RecognitionClient(RestClient):
         if not tasks and status[STATUS] == STATUS_ERROR:
             return None, status
 
+        for task in tasks:
+            self.entity_cache.put(self.cache_namespace(), TASK_ENDPOINT, task, scope=self.workspace)
+        if not suffix:
+            self.entity_cache.set_complete(self.cache_namespace(), TASK_ENDPOINT, self.workspace)
+
         return [Task(self.token, self.endpoint, t_json) for t_json in tasks], RESULT_OK
 
     def get_all_labels(self, suffix=""):
@@ -116,6 +144,9 @@ class RecognitionClient(RestClient):
 
         for label in labels:
             label["workspace"] = self.workspace
+            self.entity_cache.put(self.cache_namespace(), LABEL_ENDPOINT, label, scope=self.workspace)
+        if not suffix:
+            self.entity_cache.set_complete(self.cache_namespace(), LABEL_ENDPOINT, self.workspace)
 
         return [Label(self.token, self.endpoint, l_json) for l_json in labels], RESULT_OK
 
@@ -123,6 +154,15 @@ class RecognitionClient(RestClient):
         """
         Get all tasks with the name.
         """
+        namespace = self.cache_namespace()
+        if self.entity_cache.is_complete(namespace, TASK_ENDPOINT, self.workspace):
+            task_ids, _ = self.entity_cache.find_by_name(namespace, TASK_ENDPOINT, self.workspace, name)
+            tasks = [self.get_task(task_id)[0] for task_id in task_ids]
+            if all(tasks):
+                if tasks:
+                    return tasks, RESULT_OK
+                return None, {STATUS: "Task with this name not found!"}
+
         tasks, result = self.get_all_tasks()
 
         tasks_to_return = []
@@ -138,11 +178,27 @@ class RecognitionClient(RestClient):
 
         return None, {STATUS: "Task with this name not found!"}
 
+    def get_workspace_index(self, path=None, max_age=24 * 3600, links=False):
+        """
+        Get local (sqlite) index of tasks, labels and their links in the workspace.
+        The index can be up to max_age seconds old, see WorkspaceIndex.find_labels/find_tasks/refresh_links.
+        :param path: optional path to the index file, by default it is stored in ~/.ximilar/index/
+        :param max_age: the index is refreshed when it is older than max_age seconds (0 refreshes it always)
+        :param links: if True then the refresh downloads labels of all tasks, see WorkspaceIndex.refresh
+        :return: WorkspaceIndex
+        """
+        index = WorkspaceIndex(self, path)
+        if index.age() > max_age:
+            index.refresh(links=links)
+        return index
+
     def add_label_to_image(self, image_id, label_id):
         """
         Add label to the image.
         """
-        return self.post(IMAGE_ENDPOINT + image_id + "/add-label/", data={LABEL_ID: label_id})
+        result = self.post(IMAGE_ENDPOINT + image_id + "/add-label/", data={LABEL_ID: label_id})
+        self.invalidate_label(label_id)
+        return result
 
     def get_training_images(self, page_url=None, verification=None, real=None, test=False):
         """
@@ -227,7 +283,10 @@ class RecognitionClient(RestClient):
             else:
                 data["unmark-real"] = True
 
-        return self.post(api_endpoint=IMAGE_ENDPOINT + "update", data=data)
+        result = self.post(api_endpoint=IMAGE_ENDPOINT + "update", data=data)
+        for label_id in labels + add_labels + remove_labels:
+            self.invalidate_label(label_id)
+        return result
 
     def get_labels_by_substring(self, name):
         """
@@ -242,8 +301,18 @@ class RecognitionClient(RestClient):
 
     def get_label_by_name(self, name):
         """
-        Get label with specified name which also belongs to this task.
+        Get label with specified name in the workspace.
         """
+        label_ids, complete = self.entity_cache.find_by_name(
+            self.cache_namespace(), LABEL_ENDPOINT, self.workspace, name
+        )
+        if label_ids:
+            label, result = self.get_label(label_ids[0])
+            if label is not None and label.name == name:
+                return label, RESULT_OK
+        elif complete:
+            return None, {STATUS: "Label with this name not found!"}
+
         labels, result = self.get_labels_by_substring(name)
         if result[STATUS] == STATUS_OK:
             for label in labels:
@@ -264,13 +333,18 @@ class RecognitionClient(RestClient):
         """
         Remove recognition task by id/uuid.
         """
-        return self.delete(TASK_ENDPOINT + task_id + "/")
+        result = self.delete(TASK_ENDPOINT + task_id + "/")
+        self.entity_cache.remove(self.cache_namespace(), TASK_ENDPOINT, task_id)
+        self.entity_cache.remove_list(self.cache_namespace(), (TASK_ENDPOINT, task_id, LABELS))
+        return result
 
     def remove_label(self, label_id):
         """
         Remove recognition label by id/uuid.
         """
-        return self.delete(LABEL_ENDPOINT + label_id)
+        result = self.delete(LABEL_ENDPOINT + label_id)
+        self.entity_cache.remove(self.cache_namespace(), LABEL_ENDPOINT, label_id)
+        return result
 
     def remove_image(self, image_id):
         """
@@ -290,6 +364,7 @@ class RecognitionClient(RestClient):
         if ID not in task_json:
             msg = task_json[DETAIL] if DETAIL in task_json else "unexpected error"
             return None, {STATUS: msg}
+        self.entity_cache.put(self.cache_namespace(), TASK_ENDPOINT, task_json, scope=self.workspace)
         return Task(self.token, self.endpoint, task_json), RESULT_OK
 
     def create_label(self, name, description=None, output_name=None, label_type=CATEGORY, **kwargs):
@@ -305,6 +380,7 @@ class RecognitionClient(RestClient):
         label_json = self.post(LABEL_ENDPOINT, data=data)
         if ID not in label_json:
             return None, {STATUS: "unexpected error"}
+        self.entity_cache.put(self.cache_namespace(), LABEL_ENDPOINT, label_json, scope=self.workspace)
         return Label(self.token, self.endpoint, label_json), RESULT_OK
 
     def create_point(self, image_id=None, name=None, data=None):
@@ -334,7 +410,9 @@ class RecognitionClient(RestClient):
 
     def upload_images(self, records):
         """
-        Upload one or more files and add labels to them.
+        Upload one or more files and add labels to them. With dedup index (client.dedup) the duplicate records
+        are not uploaded, their labels and meta data are added to the original image. Near duplicates (perceptual
+        hash within the threshold) are merged too, use DedupIndex(perceptual=False) to merge only exact copies.
         :param records: list of dictionaries with labels and one of '_base64', '_file', '_url'
                         specify noresize: True to save image without (default False)
                        [{'_file': '__FILE_PATH__', 'labels': ['__UUID_1__', '__UUID_2__'], noresize: False}, ...]
@@ -343,29 +421,17 @@ class RecognitionClient(RestClient):
         images = []
         worst_status = RESULT_OK
         for record in records:
-            files, data = None, None
-            noresize = NORESIZE in record and record[NORESIZE]
-            noresize_on_server = noresize or self.max_image_size > 1024
-            metadata = record[META_DATA] if META_DATA in record and record[META_DATA] else {}
-            test_image = record[TEST_IMAGE] if TEST_IMAGE in record else False
-
-            data = self._create_image_data(record, noresize, noresize_on_server, test_image, metadata)
-
-            image_json = self.post(IMAGE_ENDPOINT, files=files, data=data)
-            image = None
+            # duplicate of image uploaded by this client is not uploaded again, it only gets labels and meta data
+            original = self.dedup.find(record, register=False) if self.dedup is not None else None
+            if original is not None:
+                image, status = self._get_duplicate_image(original, record)
+            else:
+                image, status = self._upload_image(record)
 
-            if image_json is None:
-                worst_status = {STATUS: "image not uploaded " + str(record)}
+            if status != RESULT_OK:
+                worst_status = status
+            if image is None:
                 continue
-            elif "detail" in image_json and "already exists" in image_json["detail"]:
-                image, worst_status = self.parse_already_inserted(image_json["detail"])
-            elif isinstance(image_json, list) and "already exists" in image_json[0]:
-                image, worst_status = self.parse_already_inserted(image_json[0])
-            elif ID not in image_json:
-                worst_status = {STATUS: "image not uploaded " + str(record)}
-                continue
-            else:
-                image = Image(self.token, self.endpoint, image_json)
 
             if REAL_IMAGE in record:
                 image.set_real(record[REAL_IMAGE])
@@ -381,10 +447,56 @@ class RecognitionClient(RestClient):
             images.append(image)
         return images, worst_status
 
+    def _upload_image(self, record):
+        """
+        Upload image of the record (without labels).
+        :return: image (None if it was not uploaded), status
+        """
+        files, data = None, None
+        noresize = NORESIZE in record and record[NORESIZE]
+        noresize_on_server = noresize or self.max_image_size > 1024
+        metadata = record[META_DATA] if META_DATA in record and record[META_DATA] else {}
+        test_image = record[TEST_IMAGE] if TEST_IMAGE in record else False
+
+        data = self._create_image_data(record, noresize, noresize_on_server, test_image, metadata)
+
+        image_json = self.post(IMAGE_ENDPOINT, files=files, data=data)
+        if image_json is None:
+            return None, {STATUS: "image not uploaded " + str(record)}
+        elif "detail" in image_json and "already exists" in image_json["detail"]:
+            image, status = self.parse_already_inserted(image_json["detail"])
+        elif isinstance(image_json, list) and "already exists" in image_json[0]:
+            image, status = self.parse_already_inserted(image_json[0])
+        elif ID not in image_json:
+            return None, {STATUS: "image not uploaded " + str(record)}
+        else:
+            image, status = Image(self.token, self.endpoint, image_json), RESULT_OK
+
+        if self.dedup is not None and image is not None:
+            self.dedup.register(record, key=image.id)
+        return image, status
+
+    def _get_duplicate_image(self, image_id, record):
+        """
+        Image which was already uploaded instead of the duplicate record with meta data of the record added to it.
+        The image is not downloaded again, it is created from its id (only the meta data are downloaded when
+        the record has some, because they are extended).
+        :return: image, status
+        """
+        image_json = {ID: image_id, IMG_PATH: None, THUMB_IMG_PATH: None, WORKSPACE: self.workspace}
+        image = Image(self.token, self.endpoint, image_json)
+
+        if META_DATA in record and record[META_DATA]:
+            image.add_meta_data(record[META_DATA])
+        return image, {STATUS: "exists"}
+
     def _create_image_data(self, record, noresize, noresize_on_server, test_image, metadata):
+        encoding_policy = self.get_encoding_policy(IMAGE_ENDPOINT)
         if IMG_DATA in record:
             return {
-                "base64": self.cv2img_to_base64(record[IMG_DATA], record[COLOR_SPACE], resize=not noresize),
+                "base64": self.cv2img_to_base64(
+                    record[IMG_DATA], record[COLOR_SPACE], resize=not noresize, encoding_policy=encoding_policy
+                ),
                 NORESIZE: noresize_on_server,
                 TEST_IMAGE: test_image,
                 META_DATA: metadata,
@@ -394,7 +506,7 @@ class RecognitionClient(RestClient):
             # We cannot send files to request along with json data (for workspace)
             # That is why we load image from disk to base64 representation
             return {
-                "base64": self.load_base64_file(record[FILE], resize=not noresize),
+                "base64": self.load_base64_file(record[FILE], resize=not noresize, encoding_policy=encoding_policy),
                 NORESIZE: noresize_on_server,
                 TEST_IMAGE: test_image,
                 META_DATA: metadata,
@@ -447,14 +559,40 @@ class RecognitionClient(RestClient):
         :return: json response
         """
         # version is default set to None, so ximilar will determine which one to take
-        data = self.construct_data(records=records, task_id=task_id, version=version, store_images=store_images)
-        result = self.post(self.PREDICT_ENDPOINT, data=data)
+        result = self.classify_records(records, task_id, version=version, store_images=store_images)
         try:
             self.check_json_status(result)
             return result
         except Exception as e:
             return None
 
+    def classify_records(self, records, task_id, version=None, store_images=None, production_version=None):
+        """
+        Classify records on the task, if the result_cache (ResultCache) is set then only the records
+        which are not in the cache for (image, task, model version) are sent to the endpoint. The resolved
+        model version is sent with the request, so the cached results are always computed by this version.
+        Records with _url are identified by the url (the image is not downloaded), so the url must not change
+        its content.
+        :param production_version: version used when version is None, if not known it is taken from the task
+        :return: json response
+        """
+        data = self.construct_data(records=records, task_id=task_id, version=version, store_images=store_images)
+        if self.result_cache is None or store_images:
+            return self.post(self.PREDICT_ENDPOINT, data=data)
+
+        if version is None:
+            if production_version is None:
+                task, _ = self.get_task(task_id)
+                production_version = task.production_version if task is not None else None
+            version = production_version
+        if version is None:
+            return self.post(self.PREDICT_ENDPOINT, data=data)
+
+        def send(records_to_send):
+            return self.post(self.PREDICT_ENDPOINT, data=dict(data, **{RECORDS: records_to_send, VERSION: version}))
+
+        return self.result_cache.process(data[RECORDS], (task_id, version), send)
+
 
 class Task(RecognitionClient):
     """
@@ -481,7 +619,9 @@ class Task(RecognitionClient):
         Create new training/model and add it to the queue.
         :return: None
         """
-        return self.post(TASK_ENDPOINT + self.id + "/train/")
+        result = self.post(TASK_ENDPOINT + self.id + "/train/")
+        self.entity_cache.invalidate(self.cache_namespace(), TASK_ENDPOINT, self.id)
+        return result
 
     def remove(self):
         """
@@ -506,15 +646,23 @@ class Task(RecognitionClient):
         Get labels of this task.
         :return: list of Labels
         """
-        if LABELS in self.cache:
-            return self.cache[LABELS], RESULT_OK
-        else:
-            labels, result = self.get_all_labels(suffix="?task=" + self.id)
+        labels_json = self.entity_cache.get_list(self.cache_namespace(), self._labels_key())
+        if labels_json is not None:
+            return [Label(self.token, self.endpoint, l_json) for l_json in labels_json], RESULT_OK
+
+        labels, result = self.get_all_labels(suffix="?task=" + self.id)
+        if result[STATUS] == STATUS_OK:
+            self.entity_cache.put_list(
+                self.cache_namespace(), self._labels_key(), LABEL_ENDPOINT, [label.id for label in labels]
+            )
+        return labels, result
 
-            if result[STATUS] == STATUS_OK:
-                self.cache[LABELS] = labels
+    def _labels_key(self):
+        return TASK_ENDPOINT, self.id, LABELS
 
-            return self.cache[LABELS], result
+    def _labels_changed(self, label_id):
+        self.entity_cache.remove_list(self.cache_namespace(), self._labels_key())
+        self.invalidate_label(label_id)
 
     def get_label_by_name(self, name):
         """
@@ -545,8 +693,8 @@ class Task(RecognitionClient):
         :return: json response
         """
         # version is default set to None, so ximilar will determine which one to take
-        data = self.construct_data(records=records, task_id=self.id, version=version, store_images=store_images)
-        result = self.post(self.PREDICT_ENDPOINT, data=data)
+        # production version of this (possibly old) object could be outdated, it is taken from the (cached) task
+        result = self.classify_records(records, self.id, version=version, store_images=store_images)
 
         self.check_json_status(result)
         return result
@@ -558,7 +706,9 @@ class Task(RecognitionClient):
         :return: json/dict result
         """
         data = {LABEL_ID: label_id}
-        return self.post(TASK_ENDPOINT + self.id + "/add-label/", data=data)
+        result = self.post(TASK_ENDPOINT + self.id + "/add-label/", data=data)
+        self._labels_changed(label_id)
+        return result
 
     def detach_label(self, label_id):
         """
@@ -566,7 +716,9 @@ class Task(RecognitionClient):
         :param label_id: identification of label
         :return: json/dict result
         """
-        return self.post(TASK_ENDPOINT + self.id + "/remove-label/", data={LABEL_ID: label_id})
+        result = self.post(TASK_ENDPOINT + self.id + "/remove-label/", data={LABEL_ID: label_id})
+        self._labels_changed(label_id)
+        return result
 
     def to_json(self):
         labels, status = self.get_labels()
@@ -631,6 +783,7 @@ class Label(RecognitionClient):
         :return: None
         """
         self.delete(LABEL_ENDPOINT + self.id + "/wipe")
+        self.entity_cache.remove(self.cache_namespace(), LABEL_ENDPOINT, self.id)
 
     def get_images_count(self):
         """
@@ -681,7 +834,9 @@ class Label(RecognitionClient):
         :param image_id: id of label
         :return: result
         """
-        return self.post(IMAGE_ENDPOINT + image_id + "/remove-label/", data={LABEL_ID: self.id})
+        result = self.post(IMAGE_ENDPOINT + image_id + "/remove-label/", data={LABEL_ID: self.id})
+        self.invalidate_label(self.id)
+        return result
 
     def remove(self):
         return self.remove_label(self.id)
@@ -694,7 +849,9 @@ class Label(RecognitionClient):
         :param task_id: identification of label
         :return: json/dict result
         """
-        return self.post(LABEL_ENDPOINT + self.id + "/add-task/", data={TASK_ID: task_id})
+        result = self.post(LABEL_ENDPOINT + self.id + "/add-task/", data={TASK_ID: task_id})
+        self.invalidate_label(self.id)
+        return result
 
     def detach_annotate_task(self, task_id):
         """
@@ -704,7 +861,9 @@ class Label(RecognitionClient):
         :param task_id: identification of label
         :return: json/dict result
         """
-        return self.post(LABEL_ENDPOINT + self.id + "/remove-task/", data={TASK_ID: task_id})
+        result = self.post(LABEL_ENDPOINT + self.id + "/remove-task/", data={TASK_ID: task_id})
+        self.invalidate_label(self.id)
+        return result
 
     def get_annotate_tasks(self):
         data = self.get(LABEL_ENDPOINT + self.id)
@@ -783,7 +942,9 @@ class Image(RecognitionClient):
         :return: result
         """
         data = {LABEL_ID: label_id} if value is None else {LABEL_ID: label_id, "value": value}
-        return self.post(IMAGE_ENDPOINT + self.id + "/add-label/", data=data)
+        result = self.post(IMAGE_ENDPOINT + self.id + "/add-label/", data=data)
+        self.invalidate_label(label_id)
+        return result
 
     def update_label(self, label_id, value=None):
         """
@@ -798,7 +959,9 @@ class Image(RecognitionClient):
         :param label_id: id of label
         :return: result
         """
-        return self.post(IMAGE_ENDPOINT + self.id + "/remove-label/", data={LABEL_ID: label_id})
+        result = self.post(IMAGE_ENDPOINT + self.id + "/remove-label/", data={LABEL_ID: label_id})
+        self.invalidate_label(label_id)
+        return result
 
     def remove_label(self, label_id):
         return self.detach_label(label_id)
@@ -1,5 +1,6 @@
 from ximilar.client import RestClient
 from ximilar.client.constants import *
+from ximilar.client.utils.output_sink import DirectorySink, OutputPipeline
 
 REMOVEBG_ENDPOINT_PRECISE = "removebg/precise/removebg"
 REMOVEBG_ENDPOINT_FAST = "removebg/fast/removebg"
@@ -22,5 +23,19 @@ class RemoveBGClient(RestClient):
         return self.post(self.PREDICT_ENDPOINT, data={RECORDS: records})
 
     def removebg_fast(self, records):
-        records = self.preprocess_records(records)
+        records = self.preprocess_records(records, api_endpoint=REMOVEBG_ENDPOINT_FAST)
         return self.post(REMOVEBG_ENDPOINT_FAST, data={RECORDS: records})
+
+    def removebg_stream(self, records, sink, fast=False, batch_size=1, max_workers=3, download_workers=6):
+        """
+        Remove background of the records and stream the output images to the sink as soon as they are ready.
+        :param sink: path to directory or DirectorySink (or any object with write(name, chunks) method)
+        :param fast: use fast endpoint instead of precise
+        :return: generator of result records with '_output_paths' field
+        """
+        sink = DirectorySink(sink) if isinstance(sink, str) else sink
+        method = self.removebg_fast if fast else self.removebg_precise
+        pipeline = OutputPipeline(
+            method, sink, batch_size=batch_size, max_workers=max_workers, download_workers=download_workers
+        )
+        return pipeline.process(records)
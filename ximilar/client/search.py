@@ -1,4 +1,14 @@
+import concurrent.futures
+import copy
+import hashlib
+import json
+
+from tqdm import tqdm
+
 from ximilar.client import RestClient
+from ximilar.client.exceptions import XimilarClientException
+from ximilar.client.utils.collection_export import CollectionExporter
+from ximilar.client.utils.decorators import retry_when
 from ximilar.client.constants import (
     RECORDS,
     ENDPOINT,
@@ -16,6 +26,8 @@ from ximilar.client.constants import (
     IMAGE_MATCHING,
     ANSWER_RECORDS,
     NEXT,
+    IMG_DATA,
+    STATUS,
 )
 
 SIMILARITY_PHOTOS = "similarity/photos/v2/"
@@ -37,6 +49,20 @@ KNN_VISUAL_TAGS = "visualTagsKNN"
 PING = "ping"
 RANK_RECORDS = "visualRankRecords"
 
+# response of insert when all the records were filtered as duplicates
+NOTHING_TO_INSERT = {"status": {"code": 200, "text": "OK (all records are duplicates)"}}
+
+
+def error_code(result, field=STATUS):
+    """
+    :param result: json response or record
+    :param field: field with the status
+    :return: code of the status if it is an error (>= 300), otherwise None
+    """
+    status = result.get(field) if isinstance(result, dict) else None
+    code = status.get("code", 200) if isinstance(status, dict) else 200
+    return code if code >= 300 else None
+
 
 class SimilarityPhotosClient(RestClient):
     def __init__(
@@ -45,6 +71,7 @@ class SimilarityPhotosClient(RestClient):
         super().__init__(token=token, endpoint=endpoint, max_image_size=512, resource_name=resource_name)
         self.headers[COLLECTION_ID] = collection_id
         self.PREDICT_ENDPOINT = KNN_VISUAL
+        self.search_cache = None
 
     def construct_data(
         self, query_record=None, filter=None, k=5, fields_to_return=[_ID], custom_flow=None, records=[], **kwargs
@@ -77,6 +104,32 @@ class SimilarityPhotosClient(RestClient):
 
         return data
 
+    def cached_post(self, api_endpoint, data):
+        """
+        POST request with the response taken from the search_cache (ResultCache) if it is set. The key is the
+        collection, endpoint and the whole (preprocessed) data, so different filter, k or fields_to_return
+        are cached separately.
+        :return: json response
+        """
+        if self.search_cache is None:
+            return self.post(api_endpoint, data=data)
+
+        data_json = json.dumps([self.headers[COLLECTION_ID], api_endpoint, data], sort_keys=True)
+        key = hashlib.sha1(data_json.encode("utf-8")).hexdigest()
+        result = self.search_cache.get(key)
+        if result is None:
+            result = self.post(api_endpoint, data=data)
+            if isinstance(result, dict) and ANSWER_RECORDS in result:
+                self.search_cache.put(key, result)
+        return result
+
+    def invalidate_search_cache(self):
+        """
+        Clear the search cache, it is called by every insert, update and remove of this client.
+        """
+        if self.search_cache is not None:
+            self.search_cache.clear()
+
     def allRecords(self, size=1000, page=1, fields_to_return=[_ID]):
         if size > 0:
             result = self.post("allRecords?size=%s&page=%s" % (size, page), data={FIELDS_TO_RETURN: fields_to_return})
@@ -109,6 +162,19 @@ class SimilarityPhotosClient(RestClient):
             page_counter += 1
             result = self.allRecords(batch_size, page_counter, fields_to_return)
 
+    def export_records(self, directory, fields_to_return=[_ID], batch_size=1000, max_workers=4):
+        """
+        Export all records in parallel to gzipped JSONL shards (see CollectionExporter), interrupted export
+        continues when called again with the same directory.
+        :param directory: output directory
+        :param fields_to_return: fields to be returned for each record in the collection
+        :param batch_size: number of records in one page
+        :param max_workers: number of concurrent requests
+        :return: summary dictionary
+        """
+        exporter = CollectionExporter(self, fields_to_return, page_size=batch_size, max_workers=max_workers)
+        return exporter.export(directory)
+
     def search(self, query_record, filter=None, k=5, fields_to_return=[_ID]):
         """
         Calls visual knn
@@ -119,7 +185,45 @@ class SimilarityPhotosClient(RestClient):
         :return: json response
         """
         data = self.construct_data(query_record, filter=filter, k=k, fields_to_return=fields_to_return)
-        return self.post(self.PREDICT_ENDPOINT, data=data)
+        return self.cached_post(self.PREDICT_ENDPOINT, data=data)
+
+    def search_batch(self, query_records, filter=None, k=5, fields_to_return=[_ID], max_workers=3):
+        """
+        Calls visual knn for many query records, the queries are sent concurrently and identical queries only once.
+        :param query_records: list of dictionaries with field '_id' (from your collection) or '_url' or "_base64' data
+        :param max_workers: how many requests are sent concurrently
+        :return: list of json responses aligned with query_records, failed query has json with status (code and text)
+        """
+
+        def search_one(query_record):
+            try:
+                result = self.search(query_record, filter=filter, k=k, fields_to_return=fields_to_return)
+            except Exception as e:
+                return {STATUS: {"code": 500, "text": str(e)}}
+            if result is None:
+                return {STATUS: {"code": 500, "text": "Unable to parse the response."}}
+            return result
+
+        def query_key(i, record):
+            # queries with image data can not be compared cheaply and not serializable queries fail in search_one,
+            # they are always sent on their own
+            if IMG_DATA in record:
+                return "query", i
+            try:
+                return json.dumps(record, sort_keys=True)
+            except Exception as e:
+                return "query", i
+
+        keys = [query_key(i, record) for i, record in enumerate(query_records)]
+        queries = dict(zip(keys, query_records))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = dict(zip(queries.keys(), executor.map(search_one, queries.values())))
+
+        answers, seen = [], set()
+        for key in keys:
+            answers.append(copy.deepcopy(results[key]) if key in seen else results[key])
+            seen.add(key)
+        return answers
 
     def search_and_rank(self, query_record, records, fields_to_return=[_ID]):
         """
@@ -131,9 +235,9 @@ class SimilarityPhotosClient(RestClient):
         :return: json response
         """
         data = self.construct_data(query_record, fields_to_return=fields_to_return)
-        data[RECORDS] = self.preprocess_records(records)
+        data[RECORDS] = self.preprocess_records(records, api_endpoint=RANK_RECORDS)
         del data[K_COUNT]
-        return self.post(RANK_RECORDS, data=data)
+        return self.cached_post(RANK_RECORDS, data=data)
 
     def random(self, filter=None, count=10, fields_to_return=[_ID]):
         """
@@ -157,7 +261,9 @@ class SimilarityPhotosClient(RestClient):
         :return: json response
         """
         data = {RECORDS: records, FIELDS_TO_RETURN: fields_to_return}
-        return self.post(UPDATE, data=data)
+        result = self.post(UPDATE, data=data)
+        self.invalidate_search_cache()
+        return result
 
     def remove(self, records):
         """
@@ -166,7 +272,9 @@ class SimilarityPhotosClient(RestClient):
         :return: json response
         """
         data = {RECORDS: records}
-        return self.post(DELETE, data=data)
+        result = self.post(DELETE, data=data)
+        self.invalidate_search_cache()
+        return result
 
     def insert(self, records):
         """
@@ -174,9 +282,92 @@ class SimilarityPhotosClient(RestClient):
         :param records: dictionary with your "_id" and with one of "_url", "_file" or "_base64" to extract descriptor.
         :return: json response
         """
-        records = self.preprocess_records(records)
-        data = {RECORDS: records}
-        return self.post(INSERT, data=data)
+        return self._insert(records, lambda preprocessed: preprocessed)
+
+    def _insert(self, records, fill_records):
+        """
+        Insert the records which are not duplicates (with the same _id) of already inserted records.
+        :param fill_records: function which creates the records for the request from the preprocessed records
+        :return: json response
+        """
+        # same image with other _id is a new record, records are registered only when they were inserted
+        records, _ = self.deduplicate_records(records, same_id=True, register=False)
+        if not records:
+            return copy.deepcopy(NOTHING_TO_INSERT)
+
+        data = {RECORDS: fill_records(self.preprocess_records(records, api_endpoint=INSERT))}
+        result = self.post(INSERT, data=data)
+        self.invalidate_search_cache()
+
+        if isinstance(result, dict) and error_code(result) is None:
+            # some endpoints return status of every record
+            statuses = result.get(RECORDS)
+            if not isinstance(statuses, list) or len(statuses) != len(records):
+                statuses = [None] * len(records)
+            self.register_records(
+                [rec for rec, status in zip(records, statuses) if error_code(status, "_status") is None]
+            )
+        return result
+
+    def remove_many(self, records, batch_size=1000, max_workers=4, attempts=3, output=False):
+        """
+        Delete many records from your collection, the records are sent in concurrent batches and failed batches
+        are repeated.
+        :param records: list of dictionaries with '_id' field
+        :param batch_size: number of records in one request
+        :param max_workers: number of concurrent requests
+        :param attempts: how many times the failed batch is sent
+        :param output: show progress bar
+        :return: dictionary with outcome of every record (records) and number of ok and error records
+        """
+        return self._bulk(
+            self.remove, [{_ID: record[_ID]} for record in records], batch_size, max_workers, attempts, output
+        )
+
+    def update_many(self, records, batch_size=100, max_workers=4, attempts=3, output=False):
+        """
+        Update many records with meta-information, see remove_many.
+        :param records: list of dictionaries with field '_id' and your meta-info
+        :return: dictionary with outcome of every record (records) and number of ok and error records
+        """
+        return self._bulk(
+            lambda batch: self.update(batch, fields_to_return=[_ID]), records, batch_size, max_workers, attempts, output
+        )
+
+    def _bulk(self, method, records, batch_size, max_workers, attempts, output):
+        @retry_when(XimilarClientException, attempts=attempts, start_pause=1, multiply_pause=2, verbose=0)
+        def send(batch):
+            result = method(batch)
+            if not isinstance(result, dict):
+                raise XimilarClientException(500, "Unable to parse the response.")
+            if error_code(result) is not None:
+                raise XimilarClientException(error_code(result), result[STATUS].get("text"))
+            return result
+
+        def process(batch):
+            try:
+                result = send(batch)
+            except Exception as e:
+                return [{_ID: record.get(_ID), STATUS: "ERROR", "detail": str(e)} for record in batch]
+
+            outcomes = [{_ID: record.get(_ID), STATUS: "OK"} for record in batch]
+            # some endpoints return status of every record
+            if len(result.get(RECORDS, [])) == len(batch):
+                for outcome, record in zip(outcomes, result[RECORDS]):
+                    if error_code(record, "_status") is not None:
+                        outcome[STATUS], outcome["detail"] = "ERROR", record["_status"].get("text")
+            return outcomes
+
+        batches = list(self.batch(records, n=batch_size))
+        outcomes = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            with tqdm(total=len(records), disable=not output) as pbar:
+                for batch, batch_outcomes in zip(batches, executor.map(process, batches)):
+                    outcomes.extend(batch_outcomes)
+                    pbar.update(len(batch))
+
+        errors = sum(1 for outcome in outcomes if outcome[STATUS] != "OK")
+        return {RECORDS: outcomes, "ok": len(outcomes) - errors, "error": errors}
 
     def get_records(self, records, fields_to_return=[_ID]):
         """
@@ -229,9 +420,7 @@ class SimilarityFashionClient(SimilarityPhotosClient):
         :param records: dictionary with your "_id" and with one of "_url", "_file" or "_base64" to extract descriptor.
         :return: json response
         """
-        records = self.preprocess_records(records)
-        data = {RECORDS: self.fill_data(records, custom_flow)}
-        return self.post(INSERT, data=data)
+        return self._insert(records, lambda preprocessed: self.fill_data(preprocessed, custom_flow))
 
     def descriptor(self, records, custom_flow=None, **kwargs):
         data = self.construct_data(records=records, custom_flow=custom_flow, **kwargs)
@@ -1,7 +1,13 @@
+import concurrent.futures
+
+import cv2
+import numpy as np
 import requests
 
 from ximilar.client import RestClient
 from ximilar.client.constants import *
+from ximilar.client.utils.output_sink import OUTPUT_URL_FIELDS, DirectorySink, OutputPipeline
+from ximilar.client.utils.tiling import TileStitcher
 
 RECORDS = "records"
 
@@ -28,3 +34,104 @@ class UpscaleClient(RestClient):
         data = self.construct_data(records, **kwargs)
         result = self.post(f"/upscaler/{scale}x/upscale", data=data)
         return result
+
+    def upscale_stream(self, records, scale, sink, batch_size=1, max_workers=3, download_workers=6, **kwargs):
+        """
+        Upscale the records and stream the output images to the sink as soon as they are ready.
+        :param sink: path to directory or DirectorySink (or any object with write(name, chunks) method)
+        :return: generator of result records with '_output_paths' field
+        """
+        sink = DirectorySink(sink) if isinstance(sink, str) else sink
+        pipeline = OutputPipeline(
+            lambda batch: self.upscale(batch, scale, **kwargs),
+            sink,
+            batch_size=batch_size,
+            max_workers=max_workers,
+            download_workers=download_workers,
+        )
+        return pipeline.process(records)
+
+    def load_image(self, record):
+        """
+        Load the image of the record in full resolution.
+        :param record: dictionary with _file, _url, _base64 or _img_data
+        :return: numpy image in BGR order
+        """
+        if IMG_DATA in record:
+            return self._convert_image_to_bgr(record[IMG_DATA], record.get(COLOR_SPACE, "RGB"))
+        if FILE in record:
+            return self.cv2_imread(record[FILE])
+        if BASE64 in record:
+            return self.base64_to_cv2img(record[BASE64])
+        if URL in record:
+            response = requests.get(record[URL], headers={"Accept": "*/*", "User-Agent": "request"}, timeout=30)
+            return cv2.imdecode(np.frombuffer(response.content, dtype=np.uint8), cv2.IMREAD_COLOR)
+        raise Exception("Please specify one of '_file', '_base64', '_url', '_img_data' field in record")
+
+    def upscale_tile(self, tile, scale, **kwargs):
+        """
+        Upscale one tile (BGR numpy image) without any resizing.
+        :return: upscaled tile in BGR order
+        """
+        record = {BASE64: self.cv2img_to_base64(tile, image_space="BGR", resize=False), NORESIZE: True}
+        result = self.upscale([record], scale, **kwargs)
+        if not isinstance(result, dict) or not result.get(RECORDS):
+            raise Exception("Unable to upscale the tile: " + str(result)[:200])
+
+        result_record = result[RECORDS][0]
+        urls = [result_record[field] for field in OUTPUT_URL_FIELDS if result_record.get(field)]
+        if urls:
+            response = requests.get(urls[0], timeout=self.request_timeout)
+            response.raise_for_status()
+            upscaled = cv2.imdecode(np.frombuffer(response.content, dtype=np.uint8), cv2.IMREAD_COLOR)
+        elif BASE64 in result_record:
+            upscaled = self.base64_to_cv2img(result_record[BASE64])
+        else:
+            raise Exception("Unable to upscale the tile: " + str(result_record.get(STATUS, result_record))[:200])
+
+        # error page or truncated download
+        if upscaled is None:
+            raise Exception("Unable to decode the upscaled tile " + (urls[0] if urls else "from base64"))
+        return upscaled
+
+    def upscale_tiled(self, record, scale, tile_size=512, overlap=32, max_workers=3, output=None, **kwargs):
+        """
+        Upscale large image by overlapping tiles which are sent concurrently and blended back into one image,
+        so the requests stay small even for huge images.
+        :param record: dictionary with _file, _url, _base64 or _img_data
+        :param scale: 2, 4 or 8
+        :param tile_size: size of the tiles (in pixels of the input image)
+        :param overlap: overlap of the neighbouring tiles, the tiles are blended in it
+        :param max_workers: number of concurrent requests
+        :param output: optional pre-allocated uint8 array for the result, for example np.memmap
+        :return: upscaled image (numpy, BGR order)
+        """
+        image = self.load_image(record)
+        height, width = image.shape[:2]
+        stitcher = TileStitcher(height, width, scale=scale, tile_size=tile_size, overlap=overlap, output=output)
+
+        tiles, futures = iter(stitcher.tiles()), {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while True:
+                # limited number of tiles in flight keeps the memory bounded
+                while len(futures) < 2 * max_workers:
+                    tile = next(tiles, None)
+                    if tile is None:
+                        break
+                    row, column, (y0, y1), (x0, x1) = tile
+                    future = executor.submit(self.upscale_tile, image[y0:y1, x0:x1], scale, **kwargs)
+                    futures[future] = (row, column)
+                if not futures:
+                    break
+
+                done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    row, column = futures.pop(future)
+                    try:
+                        stitcher.add(row, column, future.result())
+                    except Exception as e:
+                        for other in futures:
+                            other.cancel()
+                        raise Exception("Unable to upscale tile (row %d, column %d): %s" % (row, column, e)) from e
+
+        return stitcher.output
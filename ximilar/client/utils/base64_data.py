@@ -0,0 +1,50 @@
+import binascii
+
+JPEG_HEADER = "data:image/jpeg;base64,"
+# max length of data:image/...;base64, header which is searched at the start of the data
+MAX_HEADER_LENGTH = 64
+
+
+def header_length(data):
+    """
+    :param data: base64 data (str, bytes, bytearray or memoryview)
+    :return: length of the data:image/...;base64, header or 0 if there is no header
+    """
+    prefix = data[:MAX_HEADER_LENGTH]
+    if not isinstance(prefix, str):
+        prefix = bytes(prefix).decode("ascii", errors="replace")
+    if not prefix.startswith("data:image/"):
+        return 0
+
+    end = prefix.find(";base64,")
+    return end + len(";base64,") if end >= 0 else 0
+
+
+def base64_payload(data):
+    """
+    Base64 data without the header. The header is removed by slicing, bytes-like data are never copied
+    (memoryview of the payload is returned), str is copied only if it has the header.
+    """
+    start = header_length(data)
+    if isinstance(data, str):
+        return data[start:] if start else data
+    return memoryview(data)[start:]
+
+
+def decode_base64(data):
+    """
+    :param data: base64 data with or without header (str, bytes, bytearray or memoryview)
+    :return: bytes
+    """
+    # ascii str is read by binascii directly, without encoding it to bytes first
+    return binascii.a2b_base64(base64_payload(data))
+
+
+def encode_base64(buffer, header=JPEG_HEADER):
+    """
+    :param buffer: bytes-like data (bytes, memoryview, numpy buffer from cv2.imencode)
+    :param header: header prepended to the base64 data (None for no header)
+    :return: str with base64 data
+    """
+    encoded = binascii.b2a_base64(buffer, newline=False).decode("ascii")
+    return header + encoded if header else encoded
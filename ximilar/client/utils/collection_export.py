@@ -0,0 +1,151 @@
+import concurrent.futures
+import gzip
+import json
+import os
+
+from ximilar.client.constants import *
+from ximilar.client.constants import _ID
+from ximilar.client.utils.json_data import read_json_file_iterator
+
+MANIFEST = "manifest.json"
+
+
+class CollectionExporter(object):
+    """
+    Exports all records of similarity collection to gzipped JSONL shards. Every shard is a range of
+    pages of allRecords, the shards are downloaded concurrently and every finished shard is written to
+    the manifest, so interrupted export continues from the first unfinished shard (use pages_per_shard=1
+    to resume from the last finished page).
+
+    Usage:
+        exporter = CollectionExporter(client, fields_to_return=["_id", "_url"], max_workers=4)
+        summary = exporter.export("__EXPORT_DIRECTORY__")
+        for record in read_export("__EXPORT_DIRECTORY__"):
+            ...
+    """
+
+    def __init__(self, client, fields_to_return=[_ID], page_size=1000, pages_per_shard=10, max_workers=4):
+        """
+        :param client: similarity search client (SimilarityPhotosClient, SimilarityProductsClient, ...)
+        :param fields_to_return: fields of the records to export
+        :param page_size: number of records in one allRecords request
+        :param pages_per_shard: number of pages in one shard file
+        :param max_workers: number of shards downloaded concurrently
+        """
+        self.client = client
+        self.fields_to_return = fields_to_return
+        self.page_size = page_size
+        self.pages_per_shard = pages_per_shard
+        self.max_workers = max_workers
+
+    @staticmethod
+    def shard_path(directory, shard):
+        return os.path.join(directory, "shard-%05d.jsonl.gz" % shard)
+
+    def _load_manifest(self, directory):
+        settings = {
+            "fields_to_return": self.fields_to_return,
+            "page_size": self.page_size,
+            "pages_per_shard": self.pages_per_shard,
+        }
+        path = os.path.join(directory, MANIFEST)
+        if not os.path.exists(path):
+            return dict(settings, shards={}, last_shard=None, complete=False)
+
+        with open(path) as f:
+            manifest = json.load(f)
+        if any(manifest[key] != value for key, value in settings.items()):
+            raise Exception("Directory contains export with different settings, please use another directory.")
+        return manifest
+
+    def _save_manifest(self, directory, manifest):
+        path = os.path.join(directory, MANIFEST)
+        with open(path + ".tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(path + ".tmp", path)
+
+    def export_shard(self, directory, shard):
+        """
+        Download pages of the shard and write them to the shard file.
+        :return: number of records, True if the shard contains the last page of the collection
+        """
+        path, count, last = self.shard_path(directory, shard), 0, False
+        with gzip.open(path + ".tmp", "wt", encoding="utf-8", compresslevel=5) as f:
+            for page in range(shard * self.pages_per_shard + 1, (shard + 1) * self.pages_per_shard + 1):
+                result = self.client.allRecords(self.page_size, page, self.fields_to_return)
+                # response without records is an error, not the end of the collection
+                if not isinstance(result, dict) or not isinstance(result.get(ANSWER_RECORDS), list):
+                    raise Exception("Unable to download page " + str(page) + " of the collection: " + str(result))
+
+                records = result[ANSWER_RECORDS]
+                if records:
+                    f.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+                    count += len(records)
+                if not records or NEXT not in result:
+                    last = True
+                    break
+
+        if count:
+            os.replace(path + ".tmp", path)
+        else:
+            os.remove(path + ".tmp")
+        return count, last
+
+    def export(self, directory):
+        """
+        Export (or continue with interrupted export of) the collection to the directory.
+        :return: summary dictionary with number of records, shards and complete flag
+        """
+        os.makedirs(directory, exist_ok=True)
+        manifest = self._load_manifest(directory)
+        last_shard = manifest["last_shard"]
+
+        futures, next_shard, failed = {}, 0, {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                while (
+                    not failed and len(futures) < self.max_workers and (last_shard is None or next_shard <= last_shard)
+                ):
+                    if str(next_shard) not in manifest["shards"]:
+                        futures[executor.submit(self.export_shard, directory, next_shard)] = next_shard
+                    next_shard += 1
+                if not futures:
+                    break
+
+                done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    shard = futures.pop(future)
+                    try:
+                        count, last = future.result()
+                    except Exception as e:
+                        # shards after the end of the collection can fail, the running shards are finished
+                        failed[shard] = e
+                        continue
+
+                    if last and (last_shard is None or shard < last_shard):
+                        last_shard = manifest["last_shard"] = shard
+                        for other in [other for other in manifest["shards"] if int(other) > shard]:
+                            del manifest["shards"][other]
+                    if last_shard is None or shard <= last_shard:
+                        manifest["shards"][str(shard)] = count
+                    self._save_manifest(directory, manifest)
+
+        errors = [failed[shard] for shard in sorted(failed) if last_shard is None or shard <= last_shard]
+        if errors:
+            raise errors[0]
+
+        manifest["complete"] = True
+        self._save_manifest(directory, manifest)
+        return {"records": sum(manifest["shards"].values()), "shards": len(manifest["shards"]), "complete": True}
+
+
+def read_export(directory):
+    """
+    Iterate over all records of export made by CollectionExporter.
+    """
+    with open(os.path.join(directory, MANIFEST)) as f:
+        manifest = json.load(f)
+
+    for shard in sorted(int(shard) for shard, count in manifest["shards"].items() if count):
+        for record in read_json_file_iterator(CollectionExporter.shard_path(directory, shard)):
+            yield record
@@ -0,0 +1,167 @@
+import concurrent.futures
+import hashlib
+import json
+
+from tqdm import tqdm
+
+from ximilar.client.constants import *
+from ximilar.client.constants import _ID
+from ximilar.client.search import error_code
+
+# fields with image data which are never stored in the collection (so they can not be compared)
+IMAGE_DATA_FIELDS = [BASE64, FILE, IMG_DATA, COLOR_SPACE, NORESIZE]
+
+
+def field_fingerprints(record, fields):
+    """
+    :return: dictionary field -> short hash of its value for the fields present in the record
+    """
+    return {
+        field: hashlib.sha1(json.dumps(record[field], sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+        for field in fields
+        if field in record
+    }
+
+
+class CollectionSync(object):
+    """
+    Synchronizes similarity collection with local records (for example your catalogue) and sends only the
+    needed operations instead of inserting everything again:
+
+        insert  records which are not in the collection
+        update  records with changed meta data (update does not change the descriptor)
+        reinsert records with changed image (_url), they are inserted again (insert replaces the record)
+        remove  records which are not in the local records (only with remove_missing=True)
+
+    The collection records are compared by fingerprints (hash) of their fields, only the fields present
+    in the local records (or the configured meta_fields) are downloaded from the collection. Every record is
+    compared only in the fields which it has, field which is only in the collection record does not make it
+    changed (update can not remove it anyway).
+
+    Usage:
+        sync = CollectionSync(SimilarityPhotosClient("__API_TOKEN__", collection_id="__COLLECTION_ID__"))
+        plan = sync.plan(records)
+        summary = sync.sync(records)
+    """
+
+    def __init__(
+        self, client, image_fields=[URL], batch_size=100, max_workers=3, remove_missing=False, meta_fields=None
+    ):
+        """
+        :param client: similarity search client (SimilarityPhotosClient, SimilarityProductsClient, ...)
+        :param image_fields: fields which change the descriptor of the record (change leads to reinsert)
+        :param batch_size: number of records in one insert/update/remove request
+        :param max_workers: number of concurrent requests
+        :param remove_missing: remove records from the collection which are not in the local records
+        :param meta_fields: optional list of compared meta data fields, default are all fields of the local records
+        """
+        self.client = client
+        self.image_fields = image_fields
+        self.meta_fields = meta_fields
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.remove_missing = remove_missing
+
+    def _fields(self, records):
+        fields = set()
+        for record in records:
+            fields.update(record.keys())
+        fields.difference_update([_ID] + IMAGE_DATA_FIELDS)
+        meta_fields = fields.difference(self.image_fields) if self.meta_fields is None else self.meta_fields
+        return sorted(meta_fields), sorted(fields.intersection(self.image_fields))
+
+    def remote_fingerprints(self, meta_fields, image_fields):
+        """
+        :return: dictionary _id -> field_fingerprints of the image and meta data fields of all records in the collection
+        """
+        if not meta_fields and not image_fields:
+            result = self.client.get_all_ids()
+            return {record[_ID]: {} for record in result[ANSWER_RECORDS]}
+
+        return {
+            record[_ID]: field_fingerprints(record, meta_fields + image_fields)
+            for record in self.client.all_records_iter(meta_fields + image_fields, batch_size=1000)
+        }
+
+    def plan(self, records):
+        """
+        Compare the local records with the collection.
+        :param records: list of local records with '_id' field
+        :return: dictionary with lists of records to insert, update, reinsert and ids to remove
+        """
+        records = list(records)
+        if any(_ID not in record for record in records):
+            raise Exception("Every record must have '_id' field for the synchronization.")
+
+        meta_fields, image_fields = self._fields(records)
+        remote = self.remote_fingerprints(meta_fields, image_fields)
+
+        plan = {"insert": [], "update": [], "reinsert": [], "remove": []}
+        for record in records:
+            if record[_ID] not in remote:
+                plan["insert"].append(record)
+                continue
+
+            # only the fields of the local record are compared (record with _file has no comparable image field)
+            remote_fields = remote[record[_ID]]
+            image_changed = field_fingerprints(record, image_fields)
+            meta_changed = field_fingerprints(record, meta_fields)
+            if any(remote_fields.get(field) != value for field, value in image_changed.items()):
+                plan["reinsert"].append(record)
+            elif any(remote_fields.get(field) != value for field, value in meta_changed.items()):
+                plan["update"].append(record)
+
+        if self.remove_missing:
+            local_ids = set(record[_ID] for record in records)
+            plan["remove"] = [record_id for record_id in remote if record_id not in local_ids]
+        return plan
+
+    def _process(self, records, method, output):
+        """
+        Send the records in concurrent batches, failed batch or record is counted as error and the synchronization
+        continues.
+        :return: dictionary with number of records and number of failed records
+        """
+        if not records:
+            return {"records": 0, "error": 0}
+
+        def process_batch(batch):
+            try:
+                result = method(batch)
+            except Exception as e:
+                return len(batch)
+            if not isinstance(result, dict) or error_code(result) is not None:
+                return len(batch)
+            # some endpoints return status of every record
+            statuses = result.get(RECORDS)
+            if not isinstance(statuses, list) or len(statuses) != len(batch):
+                return 0
+            return sum(1 for status in statuses if error_code(status, "_status") is not None)
+
+        batches, errors = list(self.client.batch(records, n=self.batch_size)), 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            with tqdm(total=len(records), disable=not output) as pbar:
+                for batch, batch_errors in zip(batches, executor.map(process_batch, batches)):
+                    errors += batch_errors
+                    pbar.update(len(batch))
+        return {"records": len(records), "error": errors}
+
+    def sync(self, records, dry_run=False, output=False):
+        """
+        Synchronize the collection with the local records. Records are inserted and updated first and removed
+        at the end, changed images are inserted again without removing, so failed request does not lose a record.
+        :param dry_run: only compute the plan without any change of the collection
+        :param output: show progress bars
+        :return: summary, dictionary operation -> {"records": count, "error": number of failed records}
+        """
+        plan = self.plan(records)
+        if dry_run:
+            return {operation: {"records": len(items), "error": 0} for operation, items in plan.items()}
+
+        summary = {"insert": self._process(plan["insert"], self.client.insert, output)}
+        summary["reinsert"] = self._process(plan["reinsert"], self.client.insert, output)
+        summary["update"] = self._process(plan["update"], self.client.update, output)
+        summary["remove"] = self._process(
+            [{_ID: record_id} for record_id in plan["remove"]], self.client.remove, output
+        )
+        return summary
@@ -0,0 +1,134 @@
+import concurrent.futures
+import os
+
+import cv2
+import numpy as np
+import requests
+
+from ximilar.client.constants import *
+
+
+def decode_image(source, flags=cv2.IMREAD_COLOR, timeout=30):
+    """
+    Fetch and decode the image.
+    :param source: url, path to the file, numpy image or function which returns numpy image
+    :return: numpy image (BGR order)
+    """
+    if isinstance(source, np.ndarray):
+        return source
+    if callable(source):
+        # for example cv2.imread which returns None for corrupted file
+        image = source()
+    elif source.startswith("http://") or source.startswith("https://"):
+        response = requests.get(source, headers={"Accept": "*/*", "User-Agent": "request"}, timeout=timeout)
+        response.raise_for_status()
+        image = cv2.imdecode(np.frombuffer(response.content, dtype=np.uint8), flags)
+    else:
+        image = cv2.imdecode(np.fromfile(os.fspath(source), dtype=np.uint8), flags)
+
+    if image is None:
+        raise Exception("Unable to decode image " + str(source))
+    return image
+
+
+def crop_view(image, bbox):
+    """
+    Crop of the image without copying the data (numpy view), the bounding box is clipped to the image.
+    :param bbox: [xmin, ymin, xmax, ymax]
+    """
+    height, width = image.shape[:2]
+    xmin, ymin = max(int(bbox[0]), 0), max(int(bbox[1]), 0)
+    xmax, ymax = min(int(bbox[2]), width), min(int(bbox[3]), height)
+    return image[ymin:ymax, xmin:xmax]
+
+
+class CropPipeline(object):
+    """
+    Cuts objects (bounding boxes) from images. Every image is fetched and decoded only once for all its objects,
+    the crops are numpy views of the decoded image and the transform (resize, padding, encoding, writing, ...)
+    runs concurrently. Only max_images decoded images are held in memory at once.
+
+    Images which can not be fetched or decoded and objects whose transform failed are skipped and stored in errors.
+
+    Usage:
+        pipeline = CropPipeline(transform=lambda key, crop: cv2.imwrite(key + ".jpg", crop), max_workers=4)
+        groups = [("https://.../image.jpg", [("object-1", [10, 10, 100, 100]), ("object-2", [50, 0, 80, 40])])]
+        for key, result in pipeline.process(groups):
+            ...
+    """
+
+    def __init__(self, transform=None, max_workers=4, max_images=4, flags=cv2.IMREAD_COLOR):
+        """
+        :param transform: function (key, crop) -> result, default returns copy of the crop
+        :param max_workers: number of concurrent transforms
+        :param max_images: number of images fetched/decoded concurrently and held in memory
+        :param flags: cv2.imdecode flags
+        """
+        self.transform = transform if transform is not None else lambda key, crop: crop.copy()
+        self.max_workers = max_workers
+        self.max_images = max_images
+        self.flags = flags
+        self.errors = []  # (source of the image or key of the object, error message)
+
+    def process(self, groups):
+        """
+        :param groups: iterable of (source, items), source is url, path, numpy image or function returning image,
+                       items is list of (key, bbox)
+        :return: generator of (key, result) in order of completion
+        """
+        groups = iter(groups)
+        decoding, transforming, remaining, group_id = {}, {}, {}, 0
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_images) as decoder:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as worker:
+                while True:
+                    while len(decoding) + len(remaining) < self.max_images:
+                        group = next(groups, None)
+                        if group is None:
+                            break
+                        source, items = group
+                        if items:
+                            decoding[decoder.submit(decode_image, source, self.flags)] = (source, items)
+                    if not decoding and not transforming:
+                        break
+
+                    done, _ = concurrent.futures.wait(
+                        list(decoding) + list(transforming), return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        if future in decoding:
+                            source, items = decoding.pop(future)
+                            try:
+                                image = future.result()
+                            except Exception as e:
+                                self.errors.append((source, str(e)))
+                                continue
+
+                            group_id += 1
+                            remaining[group_id] = len(items)
+                            for key, bbox in items:
+                                crop = crop_view(image, bbox)
+                                transforming[worker.submit(self.transform, key, crop)] = (group_id, key)
+                        else:
+                            finished_group, key = transforming.pop(future)
+                            remaining[finished_group] -= 1
+                            if not remaining[finished_group]:
+                                # the decoded image is released with its last crop
+                                del remaining[finished_group]
+                            try:
+                                result = future.result()
+                            except Exception as e:
+                                self.errors.append((key, str(e)))
+                                continue
+                            yield key, result
+
+    def process_objects(self, objects):
+        """
+        Cut detection objects (DetectionObject), the objects of the same image share one download and decoding.
+        :return: generator of (object, result)
+        """
+        groups = {}
+        for detection_object in objects:
+            source = detection_object.image[IMG_PATH]
+            groups.setdefault(source, []).append((detection_object, detection_object.data))
+        return self.process(groups.items())
@@ -2,7 +2,7 @@ from functools import wraps
 import time
 
 
-def retry_when(*exceptions, attempts=4, start_pause=5, multiply_pause=4, verbose=1):
+def retry_when(*exceptions, attempts=4, start_pause=5, multiply_pause=4, verbose=1, on_retry=None):
     """
     Decorator which repeats given function in case any given exception occurs.
     By default, execute 4 times with 5, 20 and 80 second breaks between attempts.
@@ -13,6 +13,7 @@ def retry_when(*exceptions, attempts=4, start_pause=5, multiply_pause=4, verbose
     :param start_pause: how many seconds we will be between first and second attempt; default 5
     :param multiply_pause: how the time between attempts will change; default 4 (pause is 4x longer after each failure)
     :param verbose: 0 for no prints, 1 print message when function call is no successful; default: 1
+    :param on_retry: optional callable(args, kwargs, exception) called before every repeated attempt
     """
 
     def decorator(function):
@@ -31,6 +32,8 @@ def retry_when(*exceptions, attempts=4, start_pause=5, multiply_pause=4, verbose
                         )
                     if i + 1 == attempts:
                         raise e
+                    if on_retry is not None:
+                        on_retry(args, kwargs, e)
 
                     time.sleep(next_try_sec)
                     next_try_sec *= multiply_pause
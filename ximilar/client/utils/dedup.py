@@ -0,0 +1,206 @@
+import hashlib
+import threading
+
+import cv2
+import numpy as np
+
+from ximilar.client.constants import *
+from ximilar.client.constants import _ID
+from ximilar.client.utils.base64_data import decode_base64
+
+# number of set bits for every byte value, used for vectorized hamming distance of the hashes
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def difference_hash(image):
+    """
+    Perceptual (difference) 64 bit hash of the image, similar images have hashes with small hamming distance.
+    :param image: cv2/numpy image (grayscale or 3 channels)
+    :return: integer
+    """
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    image = cv2.resize(image, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (image[:, 1:] > image[:, :-1]).flatten()
+    return int(np.packbits(bits, bitorder="little").view(np.uint64)[0])
+
+
+class DedupIndex(object):
+    """
+    Client side index of already seen images which filters duplicate records before they are preprocessed
+    and sent to the API (upload_images of recognition, insert of similarity collections).
+
+    Every record is checked by exact hash of its data (file content, base64 data, image data or url) and
+    by perceptual hash of the image with the hamming distance threshold (records with _url only are compared
+    by the url, they are not downloaded). Records without image data (for example only with _id) are never filtered.
+
+    With same_id=True only the records with the same _id and the same (or near) image are duplicates, this is used
+    by collections where the same image with other _id is a new record. Records can be registered only after they
+    were successfully sent (register=False and register), so the failed records are not filtered when repeated.
+
+    Usage:
+        client.dedup = DedupIndex(threshold=6)
+        images, status = client.upload_images(records)
+        print(client.dedup.duplicates)
+    """
+
+    def __init__(self, threshold=6, perceptual=True):
+        """
+        :param threshold: max hamming distance (0-64) of perceptual hashes of near duplicate images
+        :param perceptual: if False then only exact duplicates are filtered
+        """
+        self.threshold = threshold
+        self.perceptual = perceptual
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.exact = {}  # exact hash -> key of the first record
+            self.hashes = np.zeros(1024, dtype=np.uint64)
+            self.keys = []  # key of the record for every perceptual hash
+            self.ids = {}  # _id of the record -> exact hash, perceptual hash
+            self.duplicates = []  # (key of duplicate record, key of original record)
+
+    def __len__(self):
+        return len(self.exact)
+
+    @staticmethod
+    def record_key(record):
+        for field in [_ID, FILE, URL]:
+            if field in record:
+                return record[field]
+        return None
+
+    def hash_record(self, record):
+        """
+        :return: exact hash (string), perceptual hash (integer or None), or None, None if the record has no image
+        """
+        if IMG_DATA in record:
+            image = np.ascontiguousarray(record[IMG_DATA])
+            exact = hashlib.sha1(image.tobytes()).hexdigest()
+            return exact, difference_hash(image) if self.perceptual else None
+
+        if FILE in record:
+            with open(record[FILE], "rb") as image_file:
+                data = image_file.read()
+        elif BASE64 in record:
+            data = decode_base64(record[BASE64])
+        elif URL in record:
+            return "url:" + hashlib.sha1(record[URL].encode("utf-8")).hexdigest(), None
+        else:
+            return None, None
+
+        exact = hashlib.sha1(data).hexdigest()
+        if not self.perceptual:
+            return exact, None
+
+        # reduced decoding is much faster and good enough for 9x8 hash
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+        return exact, difference_hash(image) if image is not None else None
+
+    def _nearest(self, phash):
+        """
+        :return: index of the nearest perceptual hash within the threshold or None
+        """
+        if not self.keys:
+            return None
+
+        xor = np.bitwise_xor(self.hashes[: len(self.keys)], np.uint64(phash))
+        distances = POPCOUNT[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+        best = int(np.argmin(distances))
+        return best if distances[best] <= self.threshold else None
+
+    def _original(self, record, exact, phash, same_id):
+        """
+        :return: key of the original record or None (the lock must be held)
+        """
+        if same_id:
+            seen = self.ids.get(record.get(_ID))
+            if seen is None:
+                return None
+            near = phash is not None and seen[1] is not None and bin(phash ^ seen[1]).count("1") <= self.threshold
+            return record[_ID] if seen[0] == exact or near else None
+
+        if exact in self.exact:
+            return self.exact[exact]
+        nearest = self._nearest(phash) if phash is not None else None
+        return self.keys[nearest] if nearest is not None else None
+
+    def _add(self, record, exact, phash, key):
+        # the lock must be held
+        self.exact.setdefault(exact, key)
+        if _ID in record:
+            self.ids[record[_ID]] = exact, phash
+        if phash is not None:
+            if len(self.keys) == len(self.hashes):
+                self.hashes = np.concatenate([self.hashes, np.zeros_like(self.hashes)])
+            self.hashes[len(self.keys)] = phash
+            self.keys.append(key)
+
+    def _find(self, record, hashes, same_id, register, key):
+        exact, phash = hashes
+        if exact is None:
+            return None
+
+        with self.lock:
+            original = self._original(record, exact, phash, same_id)
+            if original is not None:
+                self.duplicates.append((self.record_key(record), original))
+            elif register:
+                self._add(record, exact, phash, self.record_key(record) if key is None else key)
+        return original
+
+    def find(self, record, same_id=False, register=True, key=None):
+        """
+        Check the record against the index and add it if it is not a duplicate.
+        :param record: dictionary with '_file', '_base64', '_url' or '_img_data'
+        :param same_id: if True then only record with the same _id (and image) is duplicate
+        :param register: if False then the record is not added to the index (see register)
+        :param key: key under which the record is added, default is its _id, _file or _url
+        :return: key of the original record if the record is duplicate, otherwise None
+        """
+        return self._find(record, self.hash_record(record), same_id, register, key)
+
+    def check(self, record, same_id=False, register=True):
+        """
+        Check the record against the index and add it if it is not a duplicate.
+        :return: True if the record is duplicate, otherwise False
+        """
+        return self.find(record, same_id=same_id, register=register) is not None
+
+    def register(self, record, key=None):
+        """
+        Add the record (for example after it was successfully uploaded) to the index.
+        :param record: dictionary with '_file', '_base64', '_url' or '_img_data'
+        :param key: key under which the record is added, default is its _id, _file or _url
+        """
+        exact, phash = self.hash_record(record)
+        if exact is not None:
+            with self.lock:
+                self._add(record, exact, phash, self.record_key(record) if key is None else key)
+
+    def filter(self, records, same_id=False, register=True):
+        """
+        :param records: list of dictionaries with '_file', '_base64', '_url' or '_img_data'
+        :param same_id: if True then only records with the same _id (and image) are duplicates
+        :param register: if False then the unique records are not added to the index (see register), duplicates
+                         inside the records are still filtered
+        :return: list of unique records, list of duplicate records
+        """
+        # index of this call only, it finds duplicates inside the records when they are not registered
+        batch = None if register else DedupIndex(self.threshold, self.perceptual)
+        unique, duplicates = [], []
+        for record in records:
+            hashes = self.hash_record(record)
+            duplicate = self._find(record, hashes, same_id, register, None) is not None
+            if not duplicate and batch is not None and batch._find(record, hashes, same_id, True, None) is not None:
+                with self.lock:
+                    self.duplicates.append(batch.duplicates[-1])
+                duplicate = True
+
+            if duplicate:
+                duplicates.append(record)
+            else:
+                unique.append(record)
+        return unique, duplicates
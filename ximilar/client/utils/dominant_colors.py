@@ -0,0 +1,191 @@
+import numpy as np
+
+from ximilar.client.constants import *
+
+# sRGB (D65) -> XYZ matrix and reference white
+RGB_TO_XYZ = np.array(
+    [[0.4124564, 0.3575761, 0.1804375], [0.2126729, 0.7151522, 0.0721750], [0.0193339, 0.1191920, 0.9503041]]
+)
+WHITE_D65 = np.array([0.95047, 1.0, 1.08883])
+
+
+def rgb_to_lab(rgb):
+    """
+    Vectorized conversion of sRGB colors to CIE LAB.
+    :param rgb: array (..., 3) with values 0-255
+    :return: float32 array (..., 3)
+    """
+    rgb = np.asarray(rgb, dtype=np.float64) / 255.0
+    linear = np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92)
+    xyz = linear @ RGB_TO_XYZ.T / WHITE_D65
+    f = np.where(xyz > 216 / 24389, np.cbrt(xyz), (24389 / 27 * xyz + 16) / 116)
+    lab = np.stack([116 * f[..., 1] - 16, 500 * (f[..., 0] - f[..., 1]), 200 * (f[..., 1] - f[..., 2])], axis=-1)
+    return lab.astype(np.float32)
+
+
+class DominantColors(object):
+    """
+    Dominant colors of many records in flat numpy arrays, every row is one color of some record:
+
+        record   index of the record (position in the given records)
+        rgb      (n, 3) float32 rgb colors
+        lab      (n, 3) float32 lab colors
+        percent  (n,) float32 percentages of the colors in the image (0-100)
+
+    Records without dominant colors (for example failed ones) have no rows.
+
+    Usage:
+        colors = DominantColors.from_records(client.dominantcolor(records)[RECORDS])
+        palette_ids = colors.nearest_palette(palette_rgb)
+        shares = colors.palette_shares(palette_rgb)
+    """
+
+    def __init__(self, record, rgb, lab, percent, count):
+        """
+        :param count: number of records
+        """
+        self.record = record
+        self.rgb = rgb
+        self.lab = lab
+        self.percent = percent
+        self.count = count
+
+    def __len__(self):
+        return len(self.record)
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        :param records: result records of DominantColorClient.dominantcolor with '_dominant_colors' field
+        """
+        index, rgb, lab, percent, has_lab, count = [], [], [], [], True, 0
+        for i, record in enumerate(records):
+            count += 1
+            colors = record.get(DOMINANT_COLORS) if isinstance(record, dict) else None
+            if not colors or not colors.get(RGB_COLORS):
+                continue
+
+            n = len(colors[RGB_COLORS])
+            index.extend([i] * n)
+            rgb.extend(colors[RGB_COLORS])
+            percent.extend(colors.get(PERCENTAGES) or [100.0 / n] * n)
+            if has_lab and len(colors.get(LAB_COLORS) or []) == n:
+                lab.extend(colors[LAB_COLORS])
+            else:
+                has_lab = False
+
+        rgb = np.array(rgb, dtype=np.float32).reshape(-1, 3)
+        lab = np.array(lab, dtype=np.float32).reshape(-1, 3) if has_lab else rgb_to_lab(rgb)
+        return cls(np.array(index, dtype=np.int64), rgb, lab, np.array(percent, dtype=np.float32), count)
+
+    @classmethod
+    def from_responses(cls, responses):
+        """
+        :param responses: iterable of json responses of DominantColorClient.dominantcolor
+        """
+        return cls.concatenate([cls.from_records(response.get(RECORDS, [])) for response in responses])
+
+    @classmethod
+    def concatenate(cls, parts):
+        """
+        Join dominant colors of consecutive batches of records.
+        """
+        offsets = np.cumsum([0] + [part.count for part in parts])
+        return cls(
+            np.concatenate([np.zeros(0, dtype=np.int64)] + [part.record + o for part, o in zip(parts, offsets)]),
+            np.concatenate([np.zeros((0, 3), dtype=np.float32)] + [part.rgb for part in parts]),
+            np.concatenate([np.zeros((0, 3), dtype=np.float32)] + [part.lab for part in parts]),
+            np.concatenate([np.zeros(0, dtype=np.float32)] + [part.percent for part in parts]),
+            int(offsets[-1]),
+        )
+
+    def dominant(self):
+        """
+        :return: index of the row with the highest percentage for every record (-1 for records without colors)
+        """
+        order = np.lexsort((-self.percent, self.record))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = self.record[order][1:] != self.record[order][:-1]
+        result = np.full(self.count, -1, dtype=np.int64)
+        result[self.record[order][first]] = order[first]
+        return result
+
+    def nearest_palette(self, palette, space="lab", batch_size=65536):
+        """
+        Map every color to the nearest color of the palette (euclidean distance, in lab it is delta E 76).
+        :param palette: (p, 3) array of rgb colors 0-255
+        :param space: "lab" or "rgb"
+        :param batch_size: number of colors processed at once (memory is batch_size * p floats)
+        :return: (n,) array of palette indexes
+        """
+        palette = np.asarray(palette, dtype=np.float32).reshape(-1, 3)
+        colors, palette = (self.lab, rgb_to_lab(palette)) if space == "lab" else (self.rgb, palette)
+        palette_norm = (palette**2).sum(axis=1)
+
+        result = np.empty(len(colors), dtype=np.int64)
+        for start in range(0, len(colors), batch_size):
+            batch = colors[start : start + batch_size]
+            # |c - p|^2 without the |c|^2 term which is same for the whole row
+            result[start : start + batch_size] = np.argmin(palette_norm - 2 * batch @ palette.T, axis=1)
+        return result
+
+    def palette_shares(self, palette, space="lab"):
+        """
+        :return: (records, p) array with percentage of every palette color in every record
+        """
+        palette = np.asarray(palette).reshape(-1, 3)
+        shares = np.zeros((self.count, len(palette)), dtype=np.float32)
+        np.add.at(shares, (self.record, self.nearest_palette(palette, space=space)), self.percent)
+        return shares
+
+    def palette_histogram(self, palette, space="lab", weighted=True):
+        """
+        :param weighted: weight colors by their percentages, otherwise count the colors
+        :return: (p,) array, total share (or count) of every palette color over all records
+        """
+        palette = np.asarray(palette).reshape(-1, 3)
+        weights = self.percent if weighted else None
+        return np.bincount(self.nearest_palette(palette, space=space), weights=weights, minlength=len(palette))
+
+    def histogram(self, bins=8, weighted=True):
+        """
+        :param bins: number of bins for every rgb channel
+        :return: (bins, bins, bins) rgb histogram of all colors
+        """
+        weights = self.percent if weighted else None
+        histogram, _ = np.histogramdd(self.rgb, bins=(bins, bins, bins), range=[(0, 256)] * 3, weights=weights)
+        return histogram
+
+
+class DominantColorsAggregator(object):
+    """
+    Aggregation of dominant colors over stream of responses with constant memory (only the histograms are kept).
+
+    Usage:
+        aggregator = DominantColorsAggregator(palette_rgb)
+        for batch in batches:
+            aggregator.update(client.dominantcolor(batch))
+        print(aggregator.palette_counts / aggregator.records)
+    """
+
+    def __init__(self, palette, space="lab", bins=8):
+        self.palette = np.asarray(palette, dtype=np.float32).reshape(-1, 3)
+        self.space = space
+        self.bins = bins
+        self.records = 0
+        self.palette_counts = np.zeros(len(self.palette))
+        self.palette_records = np.zeros(len(self.palette), dtype=np.int64)
+        self.histogram = np.zeros((bins, bins, bins))
+
+    def update(self, response):
+        """
+        :param response: json response of dominantcolor or list of result records
+        """
+        records = response.get(RECORDS, []) if isinstance(response, dict) else response
+        colors = DominantColors.from_records(records)
+        self.records += colors.count
+        shares = colors.palette_shares(self.palette, space=self.space)
+        self.palette_counts += shares.sum(axis=0)
+        self.palette_records += (shares > 0).sum(axis=0)
+        self.histogram += colors.histogram(self.bins)
+        return colors
@@ -0,0 +1,83 @@
+import cv2
+
+from ximilar.client.utils.base64_data import JPEG_HEADER
+
+WEBP_HEADER = "data:image/webp;base64,"
+
+
+class EncodingPolicy(object):
+    """
+    How the images are encoded before they are sent to the api. By default (no policy) the client encodes jpeg
+    with quality 96. With target size the highest quality which fits the size is found by binary search
+    (but never lower than min_quality), which makes the requests much smaller for services working on small images.
+
+    Usage:
+        client.encoding_policy = EncodingPolicy(target_bytes=60000, min_quality=75)
+        client.encoding_policy = EncodingPolicy(quality=90, webp=True)
+        client.encoding_policies["insert"] = EncodingPolicy(quality=96)  # only for this endpoint of the client
+        records = client.preprocess_records(records, encoding_policy=EncodingPolicy(quality=80))
+    """
+
+    def __init__(self, quality=96, target_bytes=None, min_quality=75, webp=False, max_steps=5):
+        """
+        :param quality: max quality (0-100)
+        :param target_bytes: max size of the encoded image in bytes (the base64 data are 4/3 bigger), None for no limit
+        :param min_quality: quality floor when searching for the target size
+        :param webp: encode to webp instead of jpeg
+        :param max_steps: max number of encodings in the search
+        """
+        self.quality = quality
+        self.target_bytes = target_bytes
+        self.min_quality = min(min_quality, quality)
+        self.webp = webp
+        self.max_steps = max_steps
+        self.header = WEBP_HEADER if webp else JPEG_HEADER
+
+    def __repr__(self):
+        return "EncodingPolicy(quality=%s, target_bytes=%s, min_quality=%s, webp=%s)" % (
+            self.quality,
+            self.target_bytes,
+            self.min_quality,
+            self.webp,
+        )
+
+    def encode_quality(self, image, quality):
+        if self.webp:
+            retval, buffer = cv2.imencode(".webp", image, params=[cv2.IMWRITE_WEBP_QUALITY, quality])
+        else:
+            retval, buffer = cv2.imencode(".jpg", image, params=[cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not retval:
+            raise Exception("Unable to encode the image.")
+        return buffer
+
+    def encode(self, image):
+        """
+        :param image: numpy image in BGR order
+        :return: buffer with encoded image
+        """
+        buffer = self.encode_quality(image, self.quality)
+        if self.target_bytes is None or buffer.size <= self.target_bytes:
+            return buffer
+
+        # size of the image grows with the quality, find the highest quality within the target size
+        low, high, best, smallest = self.min_quality, self.quality - 1, None, buffer
+        for _ in range(self.max_steps):
+            if low > high:
+                break
+            middle = (low + high) // 2
+            candidate = self.encode_quality(image, middle)
+            if candidate.size <= self.target_bytes:
+                best, low = candidate, middle + 1
+            else:
+                smallest, high = candidate, middle - 1
+
+        if best is not None:
+            return best
+        return smallest if high < self.min_quality else self.encode_quality(image, self.min_quality)
+
+    def fits(self, size):
+        """
+        :param size: size of already encoded jpeg image in bytes
+        :return: True if the image can be sent as it is
+        """
+        return not self.webp and (self.target_bytes is None or size <= self.target_bytes)
@@ -0,0 +1,164 @@
+import threading
+import time
+
+from ximilar.client.constants import ID, NAME
+
+
+class EntityCache(object):
+    """
+    Thread safe TTL cache of entity json (task, label, ...) shared by all the client instances.
+
+    Every entry lives in a namespace (endpoint and authorization of the client) and is identified by the kind
+    of the entity (for example its endpoint) and its id. Entities can be also indexed by name in some
+    scope (workspace), lists of entity ids (for example labels of a task) can be cached too.
+
+    Writes should evict only the entities they touch:
+        remove(...)     entity was deleted, it is dropped together with its name index and lists containing it
+        invalidate(...) entity was modified, only its json is dropped, the name index stays valid
+    """
+
+    def __init__(self, ttl=300):
+        """
+        :param ttl: how many seconds are the entries valid, 0 disables the cache
+        """
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.entities = {}  # (namespace, kind, id) -> (expires, json)
+            self.names = {}  # (namespace, kind, scope, name) -> {id: expires}
+            self.named = {}  # (namespace, kind, id) -> set of (scope, name)
+            self.complete = {}  # (namespace, kind, scope) -> expires
+            self.lists = {}  # (namespace, key) -> (expires, kind, [ids])
+
+    def _expires(self):
+        return time.monotonic() + self.ttl
+
+    def _fresh(self, expires):
+        return expires > time.monotonic()
+
+    def get(self, namespace, kind, entity_id):
+        """
+        :return: cached json of the entity or None
+        """
+        if not self.ttl:
+            return None
+
+        with self.lock:
+            entry = self.entities.get((namespace, kind, entity_id))
+            if entry is None or not self._fresh(entry[0]):
+                return None
+            return entry[1]
+
+    def put(self, namespace, kind, entity_json, scope=None):
+        """
+        Store the json of entity, if scope is given then the entity is also indexed by name in the scope.
+        """
+        if not self.ttl or ID not in entity_json:
+            return
+
+        key, expires = (namespace, kind, entity_json[ID]), self._expires()
+        with self.lock:
+            self.entities[key] = (expires, entity_json)
+            if scope is None or NAME not in entity_json:
+                return
+
+            # entity could be renamed so remove it from other names in the scope
+            for old_scope, old_name in list(self.named.get(key, ())):
+                if old_scope == scope and old_name != entity_json[NAME]:
+                    self._unindex(key, old_scope, old_name)
+
+            self.names.setdefault((namespace, kind, scope, entity_json[NAME]), {})[entity_json[ID]] = expires
+            self.named.setdefault(key, set()).add((scope, entity_json[NAME]))
+
+    def _unindex(self, key, scope, name):
+        namespace, kind, entity_id = key
+        ids = self.names.get((namespace, kind, scope, name), {})
+        ids.pop(entity_id, None)
+        if not ids:
+            self.names.pop((namespace, kind, scope, name), None)
+        self.named.get(key, set()).discard((scope, name))
+
+    def find_by_name(self, namespace, kind, scope, name):
+        """
+        :return: list of ids of entities with the name, True if the scope listing of all entities is fresh
+        """
+        if not self.ttl:
+            return [], False
+
+        with self.lock:
+            ids = self.names.get((namespace, kind, scope, name), {})
+            complete = self._fresh(self.complete.get((namespace, kind, scope), 0))
+            return [entity_id for entity_id, expires in ids.items() if self._fresh(expires)], complete
+
+    def set_complete(self, namespace, kind, scope):
+        """
+        Mark that all the entities of the kind in the scope were put to the cache (whole listing was downloaded).
+        """
+        if self.ttl:
+            with self.lock:
+                self.complete[(namespace, kind, scope)] = self._expires()
+
+    def is_complete(self, namespace, kind, scope):
+        with self.lock:
+            return bool(self.ttl) and self._fresh(self.complete.get((namespace, kind, scope), 0))
+
+    def get_list(self, namespace, key):
+        """
+        :return: list of cached json of entities in the list or None if the list or any of its entity is not cached
+        """
+        if not self.ttl:
+            return None
+
+        with self.lock:
+            entry = self.lists.get((namespace, key))
+            if entry is None or not self._fresh(entry[0]):
+                return None
+
+            result = []
+            for entity_id in entry[2]:
+                entity = self.entities.get((namespace, entry[1], entity_id))
+                if entity is None or not self._fresh(entity[0]):
+                    return None
+                result.append(entity[1])
+            return result
+
+    def put_list(self, namespace, key, kind, entity_ids):
+        """
+        Store the list of entity ids (for example labels of task), the entities itself must be put separately.
+        """
+        if self.ttl:
+            with self.lock:
+                self.lists[(namespace, key)] = (self._expires(), kind, list(entity_ids))
+
+    def remove_list(self, namespace, key):
+        with self.lock:
+            self.lists.pop((namespace, key), None)
+
+    def invalidate(self, namespace, kind, entity_id):
+        """
+        Entity was modified (but not renamed), drop its json.
+        """
+        with self.lock:
+            self.entities.pop((namespace, kind, entity_id), None)
+
+    def remove(self, namespace, kind, entity_id):
+        """
+        Entity was deleted, drop its json, name index and all lists which contain it.
+        """
+        key = (namespace, kind, entity_id)
+        with self.lock:
+            self.entities.pop(key, None)
+            for scope, name in list(self.named.get(key, ())):
+                self._unindex(key, scope, name)
+            self.named.pop(key, None)
+
+            for list_key, (expires, list_kind, ids) in list(self.lists.items()):
+                if list_key[0] == namespace and list_kind == kind and entity_id in ids:
+                    del self.lists[list_key]
+
+
+# cache shared by all the clients
+ENTITY_CACHE = EntityCache()
@@ -0,0 +1,125 @@
+import binascii
+import struct
+
+from ximilar.client.utils.base64_data import base64_payload
+
+JPEG = "jpeg"
+PNG = "png"
+WEBP = "webp"
+
+# start of frame markers of jpeg (baseline, progressive, lossless, ...), they contain the size of the image
+SOF_MARKERS = set(range(0xC0, 0xD0)).difference([0xC4, 0xC8, 0xCC])
+# markers without length
+STANDALONE_MARKERS = set(range(0xD0, 0xDA)).union([0x01])
+
+
+class NeedMoreData(Exception):
+    pass
+
+
+def _exif_orientation(segment):
+    """
+    :param segment: content of jpeg APP1 segment
+    :return: orientation from exif (1 is normal orientation)
+    """
+    if segment[:6] != b"Exif\x00\x00":
+        return 1
+    tiff = segment[6:]
+    endian = "<" if tiff[:2] == b"II" else ">"
+    offset = struct.unpack(endian + "I", tiff[4:8])[0]
+    for k in range(struct.unpack(endian + "H", tiff[offset : offset + 2])[0]):
+        entry = tiff[offset + 2 + 12 * k : offset + 14 + 12 * k]
+        if struct.unpack(endian + "H", entry[:2])[0] == 0x0112:
+            return struct.unpack(endian + "H", entry[8:10])[0]
+    return 1
+
+
+def _probe_jpeg(data):
+    i, orientation = 2, 1
+    while True:
+        if i + 4 > len(data):
+            raise NeedMoreData()
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:  # fill byte
+            i += 1
+            continue
+        if marker in STANDALONE_MARKERS:
+            i += 2
+            continue
+        if marker in SOF_MARKERS:
+            if i + 10 > len(data):
+                raise NeedMoreData()
+            height, width = struct.unpack(">HH", data[i + 5 : i + 9])
+            return {
+                "format": JPEG,
+                "width": width,
+                "height": height,
+                "channels": data[i + 9],
+                "orientation": orientation,
+            }
+        if marker == 0xDA:  # start of scan without frame header
+            return None
+
+        end = i + 2 + struct.unpack(">H", data[i + 2 : i + 4])[0]
+        if marker == 0xE1 and orientation == 1:
+            if end > len(data):
+                raise NeedMoreData()
+            orientation = _exif_orientation(data[i + 4 : end])
+        i = end
+
+
+def probe_image(data):
+    """
+    Read format and size of the image only from its header (jpeg, png, webp).
+    :param data: bytes (start of the image file is enough)
+    :return: dictionary with format, width, height, channels (and exif orientation of jpeg) or None if unknown format
+    :raise NeedMoreData: if the header is not complete
+    """
+    data = bytes(data)
+    if data[:2] == b"\xff\xd8":
+        return _probe_jpeg(data)
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        if len(data) < 26:
+            raise NeedMoreData()
+        width, height = struct.unpack(">II", data[16:24])
+        channels = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}.get(data[25])
+        return {"format": PNG, "width": width, "height": height, "channels": channels}
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        if len(data) < 30:
+            raise NeedMoreData()
+        if data[12:16] == b"VP8 ":
+            width, height = struct.unpack("<HH", data[26:30])
+            return {"format": WEBP, "width": width & 0x3FFF, "height": height & 0x3FFF, "channels": 3}
+        if data[12:16] == b"VP8L":
+            bits = struct.unpack("<I", data[21:25])[0]
+            return {"format": WEBP, "width": (bits & 0x3FFF) + 1, "height": ((bits >> 14) & 0x3FFF) + 1, "channels": 4}
+        if data[12:16] == b"VP8X":
+            width = int.from_bytes(data[24:27], "little") + 1
+            height = int.from_bytes(data[27:30], "little") + 1
+            return {"format": WEBP, "width": width, "height": height, "channels": 4}
+    if len(data) < 12:
+        raise NeedMoreData()
+    return None
+
+
+def probe_base64(data, chunk=4096):
+    """
+    Read format and size of the base64 encoded image, only the start of the data is decoded
+    (more is decoded only if the header is longer, for example jpeg with big exif).
+    :param data: base64 data with or without header (str, bytes or memoryview)
+    :return: dictionary with format, width, height, channels or None if unknown format
+    """
+    payload = base64_payload(data)
+    length = chunk
+    while True:
+        complete = length >= len(payload)
+        try:
+            return probe_image(binascii.a2b_base64(payload[: length - length % 4] if not complete else payload))
+        except NeedMoreData:
+            if complete:
+                return None
+        except (binascii.Error, struct.error, IndexError):
+            return None
+        length *= 4
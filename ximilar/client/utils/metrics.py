@@ -0,0 +1,258 @@
+import bisect
+import re
+import threading
+
+# upper bounds (seconds) of the latency histogram buckets, the last bucket is always +Inf
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 90.0)
+
+ID_SEGMENT_PATTERN = re.compile(r"^([a-fA-F0-9]{8}-[a-fA-F0-9]{4}-[a-fA-F0-9]{4}-[a-fA-F0-9]{4}-[a-fA-F0-9]{12}|\d+)$")
+
+
+def normalize_endpoint(api_endpoint):
+    """
+    Turns endpoint path into a label with bounded cardinality, query string is dropped and
+    every uuid/number segment is replaced with {id}.
+    For example "recognition/v2/task/__UUID__/add-label/?x=1" => "recognition/v2/task/{id}/add-label"
+    :param api_endpoint: endpoint path
+    :return: normalized endpoint path
+    """
+    path = str(api_endpoint).split("?")[0].strip("/")
+    return "/".join("{id}" if ID_SEGMENT_PATTERN.match(segment) else segment for segment in path.split("/"))
+
+
+class Histogram(object):
+    """
+    Cumulative histogram of observed values (Prometheus style).
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        :return: list of (upper bound, cumulative count) including the +Inf bucket
+        """
+        result, total = [], 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def to_json(self):
+        return {"buckets": [[bound, count] for bound, count in self.cumulative()], "sum": self.sum, "count": self.count}
+
+
+class EndpointStats(object):
+    """
+    Aggregated statistics of one (method, endpoint) pair.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.coalesced = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency = Histogram(buckets)
+
+    def to_json(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "retries": self.retries,
+            "coalesced": self.coalesced,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "latency": self.latency.to_json(),
+        }
+
+
+class MetricsRegistry(object):
+    """
+    Thread safe registry of client metrics. It records per endpoint request count, errors, retries,
+    bytes sent/received and network latency histogram, together with the time spent in preprocessing
+    of the records (loading, resizing and encoding of images) per client type.
+
+    Usage:
+        registry = MetricsRegistry()
+        registry.add_listener(lambda event: print(event))
+        client = RecognitionClient("__API_TOKEN__", metrics=registry)
+        ...
+        print(registry.to_prometheus())
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, prefix="ximilar_client"):
+        self.buckets = tuple(buckets)
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+            self.preprocessing = {}
+
+    def add_listener(self, callback):
+        """
+        Register callback which is called with every recorded event (dictionary).
+        :param callback: callable accepting one dictionary
+        """
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self.listeners.remove(callback)
+
+    def _notify(self, event):
+        for listener in list(self.listeners):
+            listener(event)
+
+    def _stats(self, method, endpoint):
+        key = (method, endpoint)
+        if key not in self.endpoints:
+            self.endpoints[key] = EndpointStats(self.buckets)
+        return self.endpoints[key]
+
+    def record_request(self, method, api_endpoint, latency, bytes_sent=0, bytes_received=0, status_code=None):
+        """
+        Record one finished (or failed when status_code is None) http request.
+        :param method: http method name (GET, POST, ...)
+        :param api_endpoint: endpoint path, it is normalized with normalize_endpoint
+        :param latency: network time in seconds
+        :param bytes_sent: size of the request body
+        :param bytes_received: size of the response body
+        :param status_code: http status code of the response
+        """
+        endpoint = normalize_endpoint(api_endpoint)
+        with self.lock:
+            stats = self._stats(method, endpoint)
+            stats.requests += 1
+            stats.bytes_sent += bytes_sent
+            stats.bytes_received += bytes_received
+            stats.latency.observe(latency)
+            if status_code is None or status_code >= 400:
+                stats.errors += 1
+
+        self._notify(
+            {
+                "event": "request",
+                "method": method,
+                "endpoint": endpoint,
+                "latency": latency,
+                "bytes_sent": bytes_sent,
+                "bytes_received": bytes_received,
+                "status_code": status_code,
+            }
+        )
+
+    def record_retry(self, method, api_endpoint, exception=None):
+        endpoint = normalize_endpoint(api_endpoint)
+        with self.lock:
+            self._stats(method, endpoint).retries += 1
+
+        self._notify(
+            {
+                "event": "retry",
+                "method": method,
+                "endpoint": endpoint,
+                "exception": type(exception).__name__ if exception else None,
+            }
+        )
+
+    def record_coalesced(self, method, api_endpoint):
+        """
+        Record request which was not sent because it shared the result of identical request in flight.
+        """
+        endpoint = normalize_endpoint(api_endpoint)
+        with self.lock:
+            self._stats(method, endpoint).coalesced += 1
+
+        self._notify({"event": "coalesced", "method": method, "endpoint": endpoint})
+
+    def record_preprocessing(self, client_type, duration, records=0):
+        """
+        Record time spent in preprocessing of the records.
+        :param client_type: name of the client class (RecognitionClient, ...)
+        :param duration: time in seconds
+        :param records: number of preprocessed records
+        """
+        with self.lock:
+            if client_type not in self.preprocessing:
+                self.preprocessing[client_type] = {"records": 0, "time": Histogram(self.buckets)}
+            self.preprocessing[client_type]["records"] += records
+            self.preprocessing[client_type]["time"].observe(duration)
+
+        self._notify({"event": "preprocessing", "client": client_type, "duration": duration, "records": records})
+
+    def snapshot(self):
+        """
+        :return: dictionary with all the recorded metrics
+        """
+        with self.lock:
+            return {
+                "endpoints": [
+                    dict(method=method, endpoint=endpoint, **stats.to_json())
+                    for (method, endpoint), stats in sorted(self.endpoints.items())
+                ],
+                "preprocessing": [
+                    {"client": client, "records": stats["records"], "time": stats["time"].to_json()}
+                    for client, stats in sorted(self.preprocessing.items())
+                ],
+            }
+
+    def to_prometheus(self):
+        """
+        Export the metrics in Prometheus text exposition format.
+        :return: string
+        """
+        lines = []
+
+        def header(name, kind, text):
+            lines.append("# HELP %s_%s %s" % (self.prefix, name, text))
+            lines.append("# TYPE %s_%s %s" % (self.prefix, name, kind))
+
+        def histogram(name, labels, hist):
+            for bound, count in hist.cumulative():
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append('%s_%s_bucket{%s,le="%s"} %d' % (self.prefix, name, labels, le, count))
+            lines.append("%s_%s_sum{%s} %r" % (self.prefix, name, labels, hist.sum))
+            lines.append("%s_%s_count{%s} %d" % (self.prefix, name, labels, hist.count))
+
+        with self.lock:
+            items = sorted(self.endpoints.items())
+            labels = {key: 'method="%s",endpoint="%s"' % key for key, _ in items}
+
+            for field, text in [
+                ("requests", "Number of http requests."),
+                ("errors", "Number of failed http requests (connection error or status >= 400)."),
+                ("retries", "Number of retried http requests."),
+                ("coalesced", "Number of requests served by identical request in flight."),
+                ("bytes_sent", "Size of request bodies in bytes."),
+                ("bytes_received", "Size of response bodies in bytes."),
+            ]:
+                header(field + "_total", "counter", text)
+                for key, stats in items:
+                    lines.append("%s_%s_total{%s} %d" % (self.prefix, field, labels[key], getattr(stats, field)))
+
+            header("request_latency_seconds", "histogram", "Network latency of http requests.")
+            for key, stats in items:
+                histogram("request_latency_seconds", labels[key], stats.latency)
+
+            header("preprocessing_seconds", "histogram", "Time spent in preprocessing of records.")
+            for client, stats in sorted(self.preprocessing.items()):
+                histogram("preprocessing_seconds", 'client="%s"' % client, stats["time"])
+
+        return "\n".join(lines) + "\n"
+
+
+# registry used by every client which was not given its own
+DEFAULT_REGISTRY = MetricsRegistry()
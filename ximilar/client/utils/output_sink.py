@@ -0,0 +1,169 @@
+import concurrent.futures
+import itertools
+import os
+import urllib.parse
+
+import requests
+
+from ximilar.client.constants import *
+from ximilar.client.constants import _ID
+
+# fields of result records with urls of the output images (removebg, upscaler)
+OUTPUT_URL_FIELDS = ["_output_url", "_output_url_mask", "_upscaled_image_url"]
+OUTPUT_PATHS = "_output_paths"
+RECORD_STATUS = "_status"
+CHUNK_SIZE = 1024 * 1024
+
+
+class DirectorySink(object):
+    """
+    Writes the output images to the directory. Every destination (for example adapter of object store) must implement
+    method write(name, chunks) which consumes iterator of bytes and returns location of the stored file.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, name, chunks):
+        path = os.path.join(self.directory, name)
+        with open(path + ".part", "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(path + ".part", path)
+        return path
+
+
+class OutputPipeline(object):
+    """
+    Sends batches of records to the api (removebg, upscale, ...) and as soon as the results arrive it downloads
+    the output images concurrently and streams them to the sink. Only max_workers batches and limited number of
+    downloads are in flight, the images are never held in memory as a whole.
+
+    Usage:
+        pipeline = OutputPipeline(client.removebg_precise, DirectorySink("__OUTPUT_DIR__"))
+        for record in pipeline.process(records):
+            print(record["_output_paths"])
+    """
+
+    def __init__(
+        self, method, sink, url_fields=OUTPUT_URL_FIELDS, batch_size=1, max_workers=3, download_workers=6, timeout=90
+    ):
+        """
+        :param method: method which takes list of records and returns json with result records
+        :param sink: DirectorySink or any object with write(name, chunks) method
+        :param url_fields: fields of the result records with urls which are downloaded
+        :param batch_size: number of records in one api request
+        :param max_workers: number of concurrent api requests
+        :param download_workers: number of concurrent downloads
+        :param timeout: timeout of the download in seconds
+        """
+        self.method = method
+        self.sink = sink
+        self.url_fields = url_fields
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.download_workers = download_workers
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    @staticmethod
+    def output_name(record, index, field, url):
+        """
+        :return: name of the output file, for example 'my-id_output_url.png'
+        """
+        # the _id must not lead outside of the directory
+        name = str(record.get(_ID, index)).replace("/", "_").replace("\\", "_").lstrip(".") or str(index)
+        extension = os.path.splitext(urllib.parse.urlparse(url).path)[1] or ".png"
+        return name + field + extension
+
+    def download(self, url, name):
+        with self.session.get(url, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            return self.sink.write(name, response.iter_content(CHUNK_SIZE))
+
+    def _call(self, batch):
+        try:
+            result = self.method(batch)
+        except Exception as e:
+            return {STATUS: {"code": 500, "text": str(e)}}
+        return result if isinstance(result, dict) else {STATUS: {"code": 500, "text": "Unable to parse the response."}}
+
+    def process(self, records):
+        """
+        :param records: list or iterator of records with _url, _file, _base64
+        :return: generator of result records (in order of completion) with '_output_paths' field (url field -> location),
+                 record without the output or with failed download has '_status' with error
+        """
+        records = iter(records)
+        batches = iter(lambda: list(itertools.islice(records, self.batch_size)), [])
+        calls, downloads, pending, start = {}, {}, {}, 0
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as api_executor:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.download_workers) as download_executor:
+                while True:
+                    # next batch is sent only when the downloads keep up, so the memory stays bounded
+                    while len(calls) < self.max_workers and len(downloads) < 2 * self.download_workers:
+                        batch = next(batches, None)
+                        if batch is None:
+                            break
+                        calls[api_executor.submit(self._call, batch)] = (start, batch)
+                        start += len(batch)
+                    if not calls and not downloads:
+                        break
+
+                    done, _ = concurrent.futures.wait(
+                        list(calls) + list(downloads), return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        if future in calls:
+                            first, batch = calls.pop(future)
+                            result = future.result()
+                            result_records = result.get(RECORDS)
+                            if not isinstance(result_records, list) or len(result_records) != len(batch):
+                                status = result.get(STATUS)
+                                if not isinstance(status, dict) or status.get("code", 500) < 300:
+                                    status = {"code": 500, "text": "Unexpected response: " + str(result)[:200]}
+                                for record in batch:
+                                    record = {k: v for k, v in record.items() if k not in [BASE64, IMG_DATA]}
+                                    record[RECORD_STATUS] = status
+                                    yield record
+                                continue
+
+                            for index, record in enumerate(result_records, first):
+                                urls = [(field, record[field]) for field in self.url_fields if record.get(field)]
+                                record[OUTPUT_PATHS] = {}
+                                if not urls:
+                                    yield record
+                                    continue
+
+                                pending[index] = [record, len(urls)]
+                                for field, url in urls:
+                                    name = self.output_name(record, index, field, url)
+                                    downloads[download_executor.submit(self.download, url, name)] = (index, field)
+                        else:
+                            index, field = downloads.pop(future)
+                            record = pending[index][0]
+                            try:
+                                record[OUTPUT_PATHS][field] = future.result()
+                            except Exception as e:
+                                record[RECORD_STATUS] = {"code": 500, "text": "Download failed: " + str(e)}
+
+                            pending[index][1] -= 1
+                            if not pending[index][1]:
+                                del pending[index]
+                                yield record
+
+    def run(self, records):
+        """
+        Process all records.
+        :return: summary with number of records, stored outputs and errors
+        """
+        summary = {"records": 0, "outputs": 0, "error": 0}
+        for record in self.process(records):
+            summary["records"] += 1
+            summary["outputs"] += len(record.get(OUTPUT_PATHS, {}))
+            status = record.get(RECORD_STATUS)
+            if isinstance(status, dict) and status.get("code", 200) >= 300:
+                summary["error"] += 1
+        return summary
@@ -0,0 +1,97 @@
+import cv2
+import numpy as np
+
+WHITE = (255, 255, 255)
+
+
+def fit_size(height, width, size, shorter=False):
+    """
+    Size of the image resized with the aspect ratio.
+    :param size: target size of the longer side (or of the shorter side if shorter is True)
+    :return: (width, height) for cv2.resize
+    """
+    if shorter:
+        if height > width:
+            return size, int(height * float(size) / width)
+        return int(width * float(size) / height), size
+
+    ratio = max(height, width) / float(size)
+    if ratio < 1.0:
+        return width, height
+    return max(int(width / ratio), 1), max(int(height / ratio), 1)
+
+
+def resize_batch(images, max_size, aspect_ratio=True, interpolation=cv2.INTER_LINEAR):
+    """
+    Resize images which have both sides bigger than max_size (policy of RestClient.resize_image_data),
+    with aspect ratio the shorter side is resized to max_size. All resized images are written to one buffer
+    allocated for the whole batch, images which are not resized are returned as they are.
+    :param images: list of numpy images
+    :return: list of numpy images
+    """
+    shapes = []  # shape of every resized image or None
+    for image in images:
+        height, width = image.shape[:2]
+        if not max_size or height <= max_size or width <= max_size:
+            shapes.append(None)
+            continue
+        width, height = fit_size(height, width, max_size, shorter=True) if aspect_ratio else (max_size, max_size)
+        shapes.append((height, width) + image.shape[2:])
+
+    buffer = np.empty(sum(int(np.prod(shape)) for shape in shapes if shape is not None), dtype=np.uint8)
+    offset, result = 0, []
+    for image, shape in zip(images, shapes):
+        if shape is None:
+            result.append(image)
+        elif image.dtype != np.uint8:
+            result.append(cv2.resize(image, (shape[1], shape[0]), interpolation=interpolation))
+        else:
+            # cv2 writes the resized image directly to the (contiguous) part of the buffer
+            target = buffer[offset : offset + int(np.prod(shape))].reshape(shape)
+            result.append(cv2.resize(image, (shape[1], shape[0]), dst=target, interpolation=interpolation))
+            offset += target.size
+    return result
+
+
+def letterbox_batch(images, size, object_size=None, center=True, color=WHITE, out=None, interpolation=cv2.INTER_LINEAR):
+    """
+    Resize the images with the aspect ratio (only down) and pad them with the color to size x size squares.
+    :param images: list of numpy uint8 images with same number of channels
+    :param size: size of the output square
+    :param object_size: max size of the longer side of the image inside the square, default is size
+    :param center: center the image in the square, otherwise it is in the top left corner
+    :param color: fill color, for example (B, G, R), images with alpha channel are padded with opaque color
+    :param out: optional pre-allocated uint8 array (len(images), size, size, channels)
+    :return: uint8 array (len(images), size, size, channels)
+    """
+    channels = images[0].shape[2] if images and images[0].ndim == 3 else 1
+    if out is None:
+        out = np.empty((len(images), size, size, channels), dtype=np.uint8)
+    # color has one value per channel, missing channels (alpha of BGRA images) are 255 (opaque)
+    color = list(np.atleast_1d(color))[:channels]
+    out[...] = np.asarray(color + [255] * (channels - len(color)), dtype=np.uint8)
+
+    object_size = min(object_size or size, size)
+    for i, image in enumerate(images):
+        image = image.reshape(image.shape[:2] + (-1,))
+        if image.shape[2] != channels:
+            raise Exception("All images in the batch must have same number of channels.")
+
+        height, width = image.shape[:2]
+        width, height = fit_size(height, width, object_size)
+        top, left = ((size - height) // 2, (size - width) // 2) if center else (0, 0)
+        target = out[i, top : top + height, left : left + width]
+        if (height, width) == image.shape[:2]:
+            target[...] = image
+        else:
+            target[...] = cv2.resize(image, (width, height), interpolation=interpolation).reshape(target.shape)
+    return out
+
+
+def letterbox(image, size, object_size=None, center=True, color=WHITE):
+    """
+    Resize the image with the aspect ratio (only down) and pad it with the color to size x size square.
+    :return: uint8 array (size, size, channels)
+    """
+    result = letterbox_batch([image], size, object_size=object_size, center=center, color=color)[0]
+    return result if image.ndim == 3 else result[:, :, 0]
@@ -0,0 +1,155 @@
+import collections
+import copy
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+from ximilar.client.constants import *
+
+RECORD_STATUS = "_status"
+
+
+def record_key(record):
+    """
+    Identification of image in preprocessed record (hash of the base64 data or the url). The image of the url
+    is not downloaded, so the results of url which changes its content are stale until they expire.
+    :return: string or None if the record has no image data
+    """
+    if BASE64 in record:
+        data = record[BASE64]
+        return "base64:" + hashlib.sha1(data.encode("utf-8") if isinstance(data, str) else data).hexdigest()
+    if URL in record:
+        return "url:" + record[URL]
+    return None
+
+
+class ResultCache(object):
+    """
+    LRU cache with TTL of per record results (for example classification of image on task and model version).
+    Optionally the results are stored also in sqlite file (second tier), so they survive restart of the process.
+
+    Usage:
+        client.result_cache = ResultCache(max_size=100000, ttl=24 * 3600, path="results.sqlite3")
+        client.classify_on_task(records, task_id="__TASK_ID__")
+    """
+
+    def __init__(self, max_size=10000, ttl=3600, path=None):
+        """
+        :param max_size: max number of results in memory
+        :param ttl: how many seconds is the result valid
+        :param path: optional path to sqlite file for the disk tier
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.memory = collections.OrderedDict()  # key -> (expires, result)
+        self.hits, self.misses = 0, 0
+
+        self.connection = None
+        if path is not None:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            with self.connection:
+                self.connection.execute(
+                    "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, expires REAL, result TEXT)"
+                )
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None and entry[0] > now:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(entry[1])
+            self.memory.pop(key, None)
+
+            if self.connection is not None:
+                row = self.connection.execute(
+                    "SELECT expires, result FROM results WHERE key = ? AND expires > ?", (key, now)
+                ).fetchone()
+                if row is not None:
+                    self._put_memory(key, row[0], json.loads(row[1]))
+                    self.hits += 1
+                    return json.loads(row[1])
+
+            self.misses += 1
+            return None
+
+    def put(self, key, result):
+        expires = time.time() + self.ttl
+        with self.lock:
+            self._put_memory(key, expires, copy.deepcopy(result))
+            if self.connection is not None:
+                with self.connection:
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO results VALUES (?, ?, ?)", (key, expires, json.dumps(result))
+                    )
+
+    def _put_memory(self, key, expires, result):
+        self.memory[key] = (expires, result)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            if self.connection is not None:
+                with self.connection:
+                    self.connection.execute("DELETE FROM results")
+
+    def process(self, records, context, send):
+        """
+        Answer the records from the cache and send only the missing ones in one batch, records with the same
+        image (and context) are sent only once.
+        :param records: preprocessed records
+        :param context: anything with repr identifying the computation (for example task id and model version)
+        :param send: function which takes list of records and returns json response with records
+        :return: json response with records in the same order as given
+        """
+        keys = []
+        for record in records:
+            image_key = record_key(record)
+            keys.append(
+                hashlib.sha1((repr(context) + "|" + image_key).encode("utf-8")).hexdigest() if image_key else None
+            )
+
+        results = [self.get(key) if key else None for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+
+        # same image in the batch is sent only once (first record with the key), its duplicates share the result
+        first = {}
+        sent = [i for i in missing if keys[i] is None or first.setdefault(keys[i], i) == i]
+
+        if not sent:
+            response = {STATUS: {"code": 200, "text": "OK"}}
+        else:
+            response = send([records[i] for i in sent])
+            if (
+                not isinstance(response, dict)
+                or RECORDS not in response
+                or len(response[RECORDS]) != len(sent)
+                or not isinstance(response.get(STATUS), dict)
+                or response[STATUS].get("code", 200) != 200
+            ):
+                return response
+
+            for i, result_record in zip(sent, response[RECORDS]):
+                # store just the computed fields, the rest of the record is taken from the actual request
+                results[i] = {k: v for k, v in result_record.items() if k not in records[i]}
+                if keys[i] is not None and result_record.get(RECORD_STATUS, {}).get("code", 200) == 200:
+                    self.put(keys[i], results[i])
+
+        answer_records, positions = [], {i: j for j, i in enumerate(sent)}
+        for i, record in enumerate(records):
+            if i in positions:
+                answer_records.append(response[RECORDS][positions[i]])
+            else:
+                answer = {k: v for k, v in record.items() if k != BASE64}
+                answer.update(copy.deepcopy(results[i] if results[i] is not None else results[first[keys[i]]]))
+                answer_records.append(answer)
+
+        response[RECORDS] = answer_records
+        return response
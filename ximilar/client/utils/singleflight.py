@@ -0,0 +1,74 @@
+import copy
+import threading
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """
+    Suppresses duplicate concurrent calls. While a call with some key is in flight, every other caller
+    with the same key waits for it and gets (deep copy of) its result or exception instead of doing the call again.
+
+    Usage:
+        flights = SingleFlight()
+        result, shared = flights.do(("GET", url), requests.get, url)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, function, *args, **kwargs):
+        """
+        Call the function or wait for the result of the same call which is already in flight.
+        :param key: hashable identification of the call
+        :param function: function to call
+        :return: result, True if the result was shared from other call otherwise False
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            # callers often modify the json result so every waiter gets its own copy
+            return copy.deepcopy(call.result), True
+
+        try:
+            call.result = function(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                # the call could be already forgotten and replaced by new one
+                if self.calls.get(key) is call:
+                    del self.calls[key]
+            call.event.set()
+
+        # nobody can join after the key was removed, the stored result must stay untouched for the waiters
+        return copy.deepcopy(call.result) if call.waiters else call.result, False
+
+    def forget(self):
+        """
+        Detach all calls in flight, the callers which come later start new calls (for example after some write
+        changed the data). The callers already waiting still get the result of their call.
+        """
+        with self.lock:
+            self.calls.clear()
+
+    def in_flight(self):
+        with self.lock:
+            return len(self.calls)
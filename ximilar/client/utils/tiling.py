@@ -0,0 +1,122 @@
+import cv2
+import numpy as np
+
+
+def tile_grid(length, tile_size, overlap):
+    """
+    Starts of the tiles which cover the whole length, neighbouring tiles overlap at least by the overlap.
+    :return: list of (start, end)
+    """
+    if length <= tile_size:
+        return [(0, length)]
+
+    count = int(np.ceil((length - overlap) / float(tile_size - overlap)))
+    starts = np.round(np.linspace(0, length - tile_size, count)).astype(int)
+    return [(int(start), int(start) + tile_size) for start in starts]
+
+
+def blend_weights(tiles, index, overlap):
+    """
+    1D weights of the tile, linear ramp in the middle of the overlap with the neighbouring tiles.
+    Weights of all tiles sum to one for every position.
+    :param tiles: list of (start, end) from tile_grid
+    :return: float32 array with length of the tile
+    """
+    start, end = tiles[index]
+    weights = np.ones(end - start, dtype=np.float32)
+    for neighbour, rising in [(index - 1, True), (index + 1, False)]:
+        if neighbour < 0 or neighbour >= len(tiles):
+            continue
+
+        left, right = (tiles[neighbour][1], start) if rising else (tiles[neighbour][0], end)
+        low, high = min(left, right), max(left, right)
+        ramp = min(overlap, high - low)
+        middle = (low + high) / 2.0
+        # position of every pixel inside the ramp (0 - 1), clipped outside of it
+        positions = np.clip((np.arange(start, end) + 0.5 - (middle - ramp / 2.0)) / max(ramp, 1), 0, 1)
+        weights *= positions if rising else 1 - positions
+    return weights
+
+
+class TileStitcher(object):
+    """
+    Blends processed (for example upscaled) tiles into one image. Tiles can be added in any order, but only
+    the bands of the unfinished rows of tiles are held in float, finished rows are written to the output
+    (uint8 array or memory mapped file) immediately.
+
+    Usage:
+        stitcher = TileStitcher(height, width, scale=2, tile_size=512, overlap=32)
+        for row, column, (y0, y1), (x0, x1) in stitcher.tiles():
+            stitcher.add(row, column, process(image[y0:y1, x0:x1]))
+        result = stitcher.output
+    """
+
+    def __init__(self, height, width, scale=1, tile_size=512, overlap=32, channels=3, output=None):
+        """
+        :param height: height of the input image
+        :param width: width of the input image
+        :param scale: scale of the processed tiles
+        :param output: optional pre-allocated uint8 array (height * scale, width * scale, channels), e.g. np.memmap
+        """
+        if overlap * 4 > tile_size:
+            raise Exception("Overlap can be at most quarter of the tile size.")
+
+        self.scale = scale
+        self.overlap = overlap
+        self.channels = channels
+        self.rows = tile_grid(height, tile_size, overlap)
+        self.columns = tile_grid(width, tile_size, overlap)
+        self.output = output
+        if self.output is None:
+            self.output = np.empty((height * scale, width * scale, channels), dtype=np.uint8)
+
+        self.column_weights = [
+            np.repeat(blend_weights(self.columns, j, overlap), scale) for j in range(len(self.columns))
+        ]
+        self.bands = {}  # row -> float32 band
+        self.missing = {row: len(self.columns) for row in range(len(self.rows))}
+        self.next_row = 0
+        self.carry = None  # part of the finished band which overlaps the next row
+
+    def tiles(self):
+        """
+        :return: list of (row, column, (y0, y1), (x0, x1)) of all tiles in the input image
+        """
+        return [(i, j, self.rows[i], self.columns[j]) for i in range(len(self.rows)) for j in range(len(self.columns))]
+
+    def add(self, row, column, tile):
+        """
+        :param tile: processed tile, it is resized if it does not have exactly scaled size
+        """
+        (y0, y1), (x0, x1) = self.rows[row], self.columns[column]
+        height, width = (y1 - y0) * self.scale, (x1 - x0) * self.scale
+        if tile.shape[:2] != (height, width):
+            tile = cv2.resize(tile, (width, height), interpolation=cv2.INTER_CUBIC)
+        if tile.ndim == 2:
+            tile = tile[:, :, None]
+
+        if row not in self.bands:
+            self.bands[row] = np.zeros((height, self.output.shape[1], self.channels), dtype=np.float32)
+        weights = (
+            np.repeat(blend_weights(self.rows, row, self.overlap), self.scale)[:, None] * self.column_weights[column]
+        )
+        self.bands[row][:, x0 * self.scale : x1 * self.scale] += tile[:, :, : self.channels] * weights[:, :, None]
+
+        self.missing[row] -= 1
+        while self.next_row in self.missing and not self.missing[self.next_row]:
+            self._finish_row(self.next_row)
+            self.next_row += 1
+
+    def _finish_row(self, row):
+        band = self.bands.pop(row)
+        if self.carry is not None:
+            band[: len(self.carry)] += self.carry
+
+        start = self.rows[row][0] * self.scale
+        end = self.rows[row + 1][0] * self.scale if row + 1 < len(self.rows) else self.output.shape[0]
+        np.clip(band[: end - start], 0, 255, out=band[: end - start])
+        self.output[start:end] = np.rint(band[: end - start]).astype(np.uint8)
+        self.carry = band[end - start :]
+
+    def done(self):
+        return self.next_row == len(self.rows)
@@ -0,0 +1,385 @@
+import json
+import os
+import threading
+
+import numpy as np
+
+from ximilar.client.constants import *
+from ximilar.client.constants import _ID
+
+# fields of descriptor records which are not stored as meta data
+SKIP_FIELDS = [_ID, DESCRIPTOR, BASE64, FILE, IMG_DATA, "_status", "_width", "_height"]
+
+COMPARISONS = {
+    "$gt": lambda value, x: value is not None and value > x,
+    "$gte": lambda value, x: value is not None and value >= x,
+    "$lt": lambda value, x: value is not None and value < x,
+    "$lte": lambda value, x: value is not None and value <= x,
+    "$ne": lambda value, x: value != x,
+    "$in": lambda value, x: value in x,
+    "$nin": lambda value, x: value not in x,
+    "$exists": lambda value, x: (value is not None) == x,
+}
+
+
+def match_filter(meta_data, filter):
+    """
+    Check meta data of record against filter in (subset of) mongodb syntax,
+    for example {"category": "shoes", "price": {"$lt": 100}, "brand": {"$in": ["a", "b"]}}.
+    :return: True if the record matches
+    """
+    for field, condition in filter.items():
+        if field == "$and":
+            if not all(match_filter(meta_data, sub) for sub in condition):
+                return False
+        elif field == "$or":
+            if not any(match_filter(meta_data, sub) for sub in condition):
+                return False
+        elif isinstance(condition, dict) and condition and all(op in COMPARISONS for op in condition):
+            if not all(COMPARISONS[op](meta_data.get(field), x) for op, x in condition.items()):
+                return False
+        elif meta_data.get(field) != condition:
+            return False
+    return True
+
+
+class VectorIndex(object):
+    """
+    Local index of descriptors (for example from CustomSimilarityClient.descriptor or
+    SimilarityFashionClient.descriptor) which answers kNN queries without calling the API.
+
+    Search is exact brute-force (batched matrix multiplication) by default, for big indexes the approximate
+    inverted file index can be built with build_ivf(), then only nprobe closest clusters are searched.
+    The index can be saved to directory and loaded back with memory mapped descriptors.
+
+    Usage:
+        index = VectorIndex()
+        result = client.descriptor([{"_id": "1", "_url": "__URL__", "category": "shoes"}], task_id="__TASK_ID__")
+        index.add_records(result[RECORDS])
+        index.save("__INDEX_DIR__")
+
+        index = VectorIndex.load("__INDEX_DIR__")
+        result = index.search({"_id": "1"}, k=10, filter={"category": "shoes"}, fields_to_return=["category"])
+    """
+
+    def __init__(self, metric="cosine"):
+        """
+        :param metric: "cosine" (descriptors are normalized) or "euclidean"
+        """
+        if metric not in ["cosine", "euclidean"]:
+            raise Exception("Unknown metric " + str(metric) + ", use cosine or euclidean.")
+
+        self.metric = metric
+        self.lock = threading.Lock()
+        self.vectors = None  # float32 matrix, rows over len(self.ids) are not used yet
+        self.norms = None  # squared norms of the vectors (euclidean metric)
+        self.ids = []
+        self.meta_data = []
+        self.positions = {}  # id -> row
+        self.deleted = np.zeros(0, dtype=bool)
+        self.version = 0
+        self.masks = {}  # json of filter -> (version, mask)
+        self.centroids = None
+        self.assignments = None
+        self.lists = None  # (version, rows sorted by cluster, start of every cluster in the rows)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def _prepare(self, vectors):
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        if self.metric == "cosine":
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors = vectors / np.maximum(norms, 1e-12)
+        return vectors
+
+    def _reserve(self, size, dimension):
+        if self.vectors is None:
+            self.vectors = np.zeros((max(size, 1024), dimension), dtype=np.float32)
+            self.norms = np.zeros(len(self.vectors), dtype=np.float32)
+        elif self.vectors.shape[1] != dimension:
+            raise Exception("Descriptor has dimension %d, index has %d." % (dimension, self.vectors.shape[1]))
+        elif size > len(self.vectors) or not self.vectors.flags.writeable:
+            capacity = max(size, 2 * len(self.vectors)) if size > len(self.vectors) else len(self.vectors)
+            vectors, norms = np.zeros((capacity, dimension), dtype=np.float32), np.zeros(capacity, dtype=np.float32)
+            vectors[: len(self.ids)] = self.vectors[: len(self.ids)]
+            norms[: len(self.ids)] = self.norms[: len(self.ids)]
+            self.vectors, self.norms = vectors, norms
+
+        if len(self.deleted) < len(self.vectors):
+            self.deleted = np.concatenate([self.deleted, np.zeros(len(self.vectors) - len(self.deleted), dtype=bool)])
+
+    def add(self, ids, vectors, meta_data=None):
+        """
+        Insert or replace descriptors in the index.
+        :param ids: list of ids
+        :param vectors: matrix (list of lists) of descriptors
+        :param meta_data: optional list of dictionaries used for filtering and fields_to_return
+        """
+        vectors = self._prepare(vectors)
+        meta_data = meta_data if meta_data is not None else [{} for _ in ids]
+        if not (len(ids) == len(vectors) == len(meta_data)):
+            raise Exception("Number of ids, descriptors and meta data must be the same.")
+
+        with self.lock:
+            self._reserve(len(self.ids) + len(ids), vectors.shape[1])
+            rows = []
+            for record_id, meta in zip(ids, meta_data):
+                if record_id not in self.positions:
+                    self.positions[record_id] = len(self.ids)
+                    self.ids.append(record_id)
+                    self.meta_data.append(None)
+                rows.append(self.positions[record_id])
+                self.meta_data[rows[-1]] = meta
+
+            self.vectors[rows] = vectors
+            self.norms[rows] = (vectors * vectors).sum(axis=1)
+            self.deleted[rows] = False
+            if self.centroids is not None:
+                if len(self.assignments) < len(self.ids):
+                    missing = len(self.ids) - len(self.assignments)
+                    self.assignments = np.concatenate([self.assignments, np.full(missing, -1, dtype=np.int32)])
+                self.assignments[rows] = self._assign(vectors)
+            self.version += 1
+
+    def add_records(self, records, fields=None):
+        """
+        Add records with '_id' and '_descriptor' (response of descriptor methods) to the index.
+        :param records: list of dictionaries
+        :param fields: meta data fields to store, default all fields except the image data
+        """
+        records = [record for record in records if DESCRIPTOR in record and _ID in record]
+        meta_data = [
+            {k: v for k, v in record.items() if (k in fields if fields is not None else k not in SKIP_FIELDS)}
+            for record in records
+        ]
+        if records:
+            self.add([record[_ID] for record in records], [record[DESCRIPTOR] for record in records], meta_data)
+
+    def remove(self, ids):
+        with self.lock:
+            for record_id in ids:
+                row = self.positions.pop(record_id, None)
+                if row is not None:
+                    self.deleted[row] = True
+            self.version += 1
+
+    def get_vector(self, record_id):
+        row = self.positions.get(record_id)
+        return np.array(self.vectors[row]) if row is not None else None
+
+    def _filter_mask(self, filter):
+        """
+        :return: boolean mask of rows matching the filter, it is cached until the index is modified
+        """
+        key = json.dumps(filter, sort_keys=True, default=str)
+        cached = self.masks.get(key)
+        if cached is not None and cached[0] == self.version:
+            return cached[1]
+
+        mask = np.array([meta is not None and match_filter(meta, filter) for meta in self.meta_data], dtype=bool)
+        if len(self.masks) > 100:
+            self.masks.clear()
+        self.masks[key] = (self.version, mask)
+        return mask
+
+    def _distances(self, queries, rows=None):
+        vectors = self.vectors[: len(self.ids)] if rows is None else self.vectors[rows]
+        scores = queries @ vectors.T
+        if self.metric == "cosine":
+            return np.maximum(1.0 - scores, 0.0)
+
+        norms = self.norms[: len(self.ids)] if rows is None else self.norms[rows]
+        return np.maximum((queries * queries).sum(axis=1)[:, np.newaxis] - 2 * scores + norms, 0.0)
+
+    def knn(self, vectors, k=5, filter=None, nprobe=8, batch_size=256):
+        """
+        Find k nearest neighbours of every query descriptor.
+        :param vectors: matrix of query descriptors
+        :param k: number of neighbours
+        :param filter: optional meta data filter (mongodb like syntax, see match_filter)
+        :param nprobe: number of searched clusters if the approximate index was built
+        :param batch_size: number of queries in one matrix multiplication
+        :return: list of lists of (id, distance) sorted by distance
+        """
+        queries = self._prepare(vectors)
+        with self.lock:
+            if not self.ids:
+                return [[] for _ in queries]
+
+            valid = ~self.deleted[: len(self.ids)]
+            if filter:
+                valid &= self._filter_mask(filter)
+
+            results = []
+            for start in range(0, len(queries), batch_size):
+                batch = queries[start : start + batch_size]
+                if self.centroids is not None:
+                    results.extend(self._knn_ivf(batch, k, valid, nprobe))
+                    continue
+
+                distances = self._distances(batch)
+                distances[:, ~valid] = np.inf
+                results.extend(self._top_k(distances, np.arange(len(self.ids)), k))
+            return results
+
+    def _top_k(self, distances, rows, k):
+        results = []
+        count = min(k, distances.shape[1])
+        if count == 0:
+            return [[] for _ in distances]
+
+        best = np.argpartition(distances, count - 1, axis=1)[:, :count]
+        for i in range(len(distances)):
+            order = best[i][np.argsort(distances[i, best[i]])]
+            results.append([(self.ids[rows[j]], float(distances[i, j])) for j in order if np.isfinite(distances[i, j])])
+        return results
+
+    def build_ivf(self, n_lists=None, iterations=10, sample_size=100000, seed=0):
+        """
+        Build approximate inverted file index (k-means clusters of descriptors), queries then search only
+        the nprobe closest clusters. Descriptors added later are assigned to the existing clusters.
+        :param n_lists: number of clusters, default is sqrt of the index size
+        """
+        with self.lock:
+            rows = np.flatnonzero(~self.deleted[: len(self.ids)])
+            if not len(rows):
+                return
+
+            n_lists = min(n_lists or int(np.sqrt(len(rows))) or 1, len(rows))
+            random = np.random.default_rng(seed)
+            sample = self.vectors[random.choice(rows, min(sample_size, len(rows)), replace=False)]
+            centroids = sample[random.choice(len(sample), n_lists, replace=False)].copy()
+
+            for _ in range(iterations):
+                labels = np.argmin(self._centroid_distances(sample, centroids), axis=1)
+                for i in range(n_lists):
+                    members = sample[labels == i]
+                    if len(members):
+                        centroids[i] = members.mean(axis=0)
+
+            self.centroids = centroids
+            self.assignments = np.full(len(self.ids), -1, dtype=np.int32)
+            self.version += 1
+            for start in range(0, len(rows), 10000):
+                self.assignments[rows[start : start + 10000]] = self._assign(self.vectors[rows[start : start + 10000]])
+
+    @staticmethod
+    def _centroid_distances(vectors, centroids):
+        return (centroids * centroids).sum(axis=1)[np.newaxis] - 2 * vectors @ centroids.T
+
+    def _assign(self, vectors):
+        return np.argmin(self._centroid_distances(vectors, self.centroids), axis=1).astype(np.int32)
+
+    def _inverted_lists(self):
+        if self.lists is None or self.lists[0] != self.version:
+            assignments = self.assignments[: len(self.ids)]
+            order = np.argsort(assignments, kind="stable")
+            starts = np.searchsorted(assignments[order], np.arange(len(self.centroids) + 1))
+            self.lists = (self.version, order, starts)
+        return self.lists[1], self.lists[2]
+
+    def _knn_ivf(self, queries, k, valid, nprobe):
+        nprobe = min(nprobe, len(self.centroids))
+        probes = np.argpartition(self._centroid_distances(queries, self.centroids), nprobe - 1, axis=1)[:, :nprobe]
+        order, starts = self._inverted_lists()
+
+        results = []
+        for query, clusters in zip(queries, probes):
+            rows = np.concatenate([order[starts[cluster] : starts[cluster + 1]] for cluster in clusters])
+            rows = rows[valid[rows]]
+            distances = self._distances(query[np.newaxis], rows)
+            results.extend(self._top_k(distances, rows, k))
+        return results
+
+    def search(self, query_record, k=5, filter=None, fields_to_return=[_ID], nprobe=8):
+        """
+        Local equivalent of SimilarityPhotosClient.search (visualKNN).
+        :param query_record: dictionary with '_id' (from the index) or '_descriptor', or list of floats
+        :return: json with answer_records (with _id, _distance and fields_to_return) and answer_count
+        """
+        return self.search_batch([query_record], k=k, filter=filter, fields_to_return=fields_to_return, nprobe=nprobe)[
+            0
+        ]
+
+    def search_batch(self, query_records, k=5, filter=None, fields_to_return=[_ID], nprobe=8):
+        """
+        Search for many queries at once (batched matrix multiplication).
+        :return: list of json results aligned with query_records
+        """
+        vectors, missing = [], []
+        for i, query in enumerate(query_records):
+            vector = query
+            if isinstance(query, dict):
+                vector = query[DESCRIPTOR] if DESCRIPTOR in query else self.get_vector(query.get(_ID))
+            if vector is None:
+                missing.append(i)
+            vectors.append(vector)
+
+        missing = set(missing)
+        found = [i for i in range(len(vectors)) if i not in missing]
+        neighbours = self.knn([vectors[i] for i in found], k=k, filter=filter, nprobe=nprobe) if found else []
+
+        results = [{STATUS: {"code": 404, "text": "Query record not found in the index."}} for _ in query_records]
+        for i, answer in zip(found, neighbours):
+            records = []
+            for record_id, distance in answer:
+                meta = self.meta_data[self.positions[record_id]]
+                record = {k: meta[k] for k in fields_to_return if k in meta}
+                record[_ID], record[DISTANCE] = record_id, distance
+                records.append(record)
+            results[i] = {ANSWER_RECORDS: records, ANSWER_COUNT: len(records), STATUS: {"code": 200, "text": "OK"}}
+        return results
+
+    def save(self, path):
+        """
+        Save the index (without removed records) to the directory.
+        """
+        os.makedirs(path, exist_ok=True)
+        with self.lock:
+            rows = np.flatnonzero(~self.deleted[: len(self.ids)])
+            dimension = self.vectors.shape[1] if self.vectors is not None else 0
+            vectors = self.vectors[rows] if self.vectors is not None else np.zeros((0, 0), dtype=np.float32)
+            np.save(os.path.join(path, "vectors.npy"), vectors)
+            if self.centroids is not None:
+                np.save(os.path.join(path, "centroids.npy"), self.centroids)
+                np.save(os.path.join(path, "assignments.npy"), self.assignments[rows])
+            elif os.path.exists(os.path.join(path, "centroids.npy")):
+                os.remove(os.path.join(path, "centroids.npy"))
+
+            with open(os.path.join(path, "index.json"), "w") as f:
+                json.dump(
+                    {
+                        "metric": self.metric,
+                        "dimension": dimension,
+                        "ids": [self.ids[row] for row in rows],
+                        "meta_data": [self.meta_data[row] for row in rows],
+                    },
+                    f,
+                )
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load the index from directory.
+        :param mmap: if True then the descriptors are memory mapped (read only until something is added)
+        """
+        with open(os.path.join(path, "index.json")) as f:
+            data = json.load(f)
+
+        index = cls(metric=data["metric"])
+        index.ids, index.meta_data = data["ids"], data["meta_data"]
+        index.positions = dict((record_id, row) for row, record_id in enumerate(index.ids))
+        index.deleted = np.zeros(len(index.ids), dtype=bool)
+        if len(index.ids):
+            index.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r" if mmap else None)
+            # norms are used only by euclidean metric, for cosine the descriptors stay lazily mapped
+            if index.metric == "euclidean":
+                index.norms = (np.asarray(index.vectors) ** 2).sum(axis=1)
+            else:
+                index.norms = np.zeros(len(index.vectors), dtype=np.float32)
+
+        if os.path.exists(os.path.join(path, "centroids.npy")):
+            index.centroids = np.load(os.path.join(path, "centroids.npy"))
+            index.assignments = np.load(os.path.join(path, "assignments.npy"))
+        return index
@@ -0,0 +1,307 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from ximilar.client.constants import *
+
+DEFAULT_INDEX_DIR = os.path.join(os.path.expanduser("~"), ".ximilar", "index")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (id TEXT PRIMARY KEY, name TEXT, fingerprint TEXT, json TEXT);
+CREATE TABLE IF NOT EXISTS labels (id TEXT PRIMARY KEY, name TEXT, fingerprint TEXT, json TEXT);
+CREATE TABLE IF NOT EXISTS task_labels (task_id TEXT, label_id TEXT, PRIMARY KEY (task_id, label_id));
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE INDEX IF NOT EXISTS tasks_name ON tasks (name);
+CREATE INDEX IF NOT EXISTS labels_name ON labels (name);
+CREATE INDEX IF NOT EXISTS task_labels_label ON task_labels (label_id);
+"""
+
+
+def fingerprint(entity_json):
+    return hashlib.sha1(json.dumps(entity_json, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def entity_to_json(entity):
+    """
+    Converts Task/Label entity (or json) to json which can be stored in the index.
+    """
+    if isinstance(entity, dict):
+        return entity
+
+    entity_json = {ID: entity.id, NAME: entity.name}
+    for field in [TYPE, DESCRIPTION, OUTPUT_NAME, NEGATIVE_FOR_TASK, PRODUCTION_VERSION, LAST_TRAIN_STATUS]:
+        if hasattr(entity, field):
+            entity_json[field] = getattr(entity, field)
+    return entity_json
+
+
+class WorkspaceIndex(object):
+    """
+    Local SQLite index of tasks, labels and links between them for one workspace.
+    The index is stored on disk so tools working with large workspaces do not need to list all the
+    labels and tasks on every start.
+
+    refresh() is not a fully incremental sync: the API has no listing of changes, so it always lists all tasks
+    and labels. Only the writes to the index and the downloads of the labels of every task are incremental,
+    the rows are rewritten only when they changed and labels of the task are downloaded again only for new
+    or changed tasks (or all of them with links=True). Labels attached or detached by some other client do not change the task, so the links
+    can be stale until refresh(links=True). Changes done by the tool itself should be written through
+    put_task, put_label, link, unlink, remove_task and remove_label.
+
+    The index can be outdated, so before creating a missing entity (or attaching a label) use find_labels,
+    find_tasks and refresh_links which ask the workspace when the index has no answer.
+
+    Usage:
+        index = client.get_workspace_index()
+        label = index.get_label_by_name("__LABEL_NAME__")
+    """
+
+    def __init__(self, client, path=None):
+        """
+        :param client: RecognitionClient of the workspace
+        :param path: path to the sqlite file, default is in ~/.ximilar/index/ and unique for endpoint, workspace, token
+        """
+        self.client = client
+        if path is None:
+            key = "|".join([client.endpoint, str(client.workspace), client.headers["Authorization"]])
+            path = os.path.join(DEFAULT_INDEX_DIR, hashlib.sha1(key.encode("utf-8")).hexdigest()[:16] + ".sqlite3")
+            os.makedirs(DEFAULT_INDEX_DIR, exist_ok=True)
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def age(self):
+        """
+        :return: seconds from the last refresh (infinity if the index was never refreshed)
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM meta WHERE key = 'refreshed'").fetchone()
+        return time.time() - float(row[0]) if row else float("inf")
+
+    def refresh(self, links=False):
+        """
+        Synchronize the index with the workspace. All tasks and labels are listed on every call, only the
+        labels of new or changed tasks are downloaded.
+        :param links: if True then labels of all tasks are downloaded, otherwise only of new/changed tasks
+        :return: status
+        """
+        from ximilar.client.recognition import LABEL_ENDPOINT, TASK_ENDPOINT
+
+        tasks, status = self.client.get_all_paginated_items(TASK_ENDPOINT)
+        if tasks is None:
+            return status
+        labels, status = self.client.get_all_paginated_items(LABEL_ENDPOINT)
+        if labels is None:
+            return status
+
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO labels VALUES (?, ?, ?, ?)", self._changed("labels", labels)
+            )
+            changed = dict((row[0], row) for row in self._changed("tasks", tasks))
+            self.connection.execute("DELETE FROM task_labels WHERE task_id NOT IN (SELECT id FROM tasks)")
+            self.connection.execute("DELETE FROM task_labels WHERE label_id NOT IN (SELECT id FROM labels)")
+
+        for task in tasks:
+            if not links and task[ID] not in changed:
+                continue
+
+            if LABELS in task and isinstance(task[LABELS], list):
+                label_ids = [label[ID] if isinstance(label, dict) else label for label in task[LABELS]]
+            else:
+                label_ids, status = self._fetch_label_ids(task[ID])
+                if label_ids is None:
+                    return status
+
+            # task is stored together with its labels, so interrupted refresh downloads them next time
+            self._store_links(task[ID], label_ids, changed.get(task[ID]))
+
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('refreshed', ?)", (str(time.time()),))
+        return RESULT_OK
+
+    def refresh_links(self, task_id):
+        """
+        Download labels of the task from the workspace and store them to the index.
+        :param task_id: id of the task
+        :return: list of label ids (None on error), status
+        """
+        label_ids, status = self._fetch_label_ids(task_id)
+        if label_ids is not None:
+            self._store_links(task_id, label_ids)
+        return label_ids, status
+
+    def _fetch_label_ids(self, task_id):
+        from ximilar.client.recognition import LABEL_ENDPOINT
+
+        task_labels, status = self.client.get_all_paginated_items(LABEL_ENDPOINT + "?task=" + task_id)
+        if task_labels is None:
+            return None, status
+        return [label[ID] for label in task_labels], status
+
+    def _store_links(self, task_id, label_ids, task_row=None):
+        with self.lock, self.connection:
+            if task_row is not None:
+                self.connection.execute("INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?)", task_row)
+            self.connection.execute("DELETE FROM task_labels WHERE task_id = ?", (task_id,))
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO task_labels VALUES (?, ?)", [(task_id, label_id) for label_id in label_ids]
+            )
+
+    def _changed(self, table, entities):
+        """
+        Delete entities missing in the listing from the table.
+        :return: rows of new or changed entities which should be upserted
+        """
+        stored = dict(self.connection.execute("SELECT id, fingerprint FROM " + table).fetchall())
+        rows = [(e[ID], e[NAME], fingerprint(e), json.dumps(e)) for e in entities]
+        removed = set(stored) - set(row[0] for row in rows)
+
+        self.connection.executemany("DELETE FROM " + table + " WHERE id = ?", [(entity_id,) for entity_id in removed])
+        return [row for row in rows if stored.get(row[0]) != row[2]]
+
+    def _select(self, table, where="", params=()):
+        with self.lock:
+            rows = self.connection.execute("SELECT json FROM " + table + " " + where, params).fetchall()
+
+        entities = [json.loads(row[0]) for row in rows]
+        for entity in entities:
+            # listing of labels does not contain the workspace (see get_all_labels)
+            entity[WORKSPACE] = self.client.workspace
+        return entities
+
+    def get_labels(self, name=None, task_id=None):
+        """
+        :param name: optional, only labels with exactly this name
+        :param task_id: optional, only labels of this task
+        :return: list of Labels
+        """
+        from ximilar.client.recognition import Label
+
+        where, params = [], []
+        if name is not None:
+            where.append("name = ?")
+            params.append(name)
+        if task_id is not None:
+            where.append("id IN (SELECT label_id FROM task_labels WHERE task_id = ?)")
+            params.append(task_id)
+
+        labels = self._select("labels", "WHERE " + " AND ".join(where) if where else "", tuple(params))
+        return [Label(self.client.token, self.client.endpoint, label) for label in labels]
+
+    def get_tasks(self, name=None, label_id=None):
+        """
+        :param name: optional, only tasks with exactly this name
+        :param label_id: optional, only tasks containing this label
+        :return: list of Tasks
+        """
+        from ximilar.client.recognition import Task
+
+        where, params = [], []
+        if name is not None:
+            where.append("name = ?")
+            params.append(name)
+        if label_id is not None:
+            where.append("id IN (SELECT task_id FROM task_labels WHERE label_id = ?)")
+            params.append(label_id)
+
+        tasks = self._select("tasks", "WHERE " + " AND ".join(where) if where else "", tuple(params))
+        return [Task(self.client.token, self.client.endpoint, task) for task in tasks]
+
+    def get_label_by_name(self, name):
+        labels = self.get_labels(name=name)
+        return labels[0] if labels else None
+
+    def get_task_by_name(self, name):
+        tasks = self.get_tasks(name=name)
+        return tasks[0] if tasks else None
+
+    def find_labels(self, name, match=None):
+        """
+        Get labels with exactly this name from the index, when there is none then search them in the workspace
+        (the index could be outdated) and store the found labels to the index.
+        :param name: name of the label
+        :param match: optional function, only labels for which match(label) is True are returned
+        :return: list of Labels
+        """
+        return self._find(self.get_labels(name=name), name, match, self.client.get_labels_by_substring, self.put_label)
+
+    def find_tasks(self, name, match=None):
+        """
+        Get tasks with exactly this name from the index, when there is none then search them in the workspace
+        (the index could be outdated) and store the found tasks to the index.
+        :param name: name of the task
+        :param match: optional function, only tasks for which match(task) is True are returned
+        :return: list of Tasks
+        """
+        return self._find(self.get_tasks(name=name), name, match, self.client.get_tasks_by_name, self.put_task)
+
+    def _find(self, entities, name, match, search, put):
+        entities = [entity for entity in entities if match is None or match(entity)]
+        if entities:
+            return entities
+
+        found, _ = search(name)
+        found = [entity for entity in found or [] if entity.name == name]
+        for entity in found:
+            put(entity)
+        return [entity for entity in found if match is None or match(entity)]
+
+    def label_ids_by_name(self):
+        """
+        :return: dictionary label name -> label id
+        """
+        with self.lock:
+            return dict(self.connection.execute("SELECT name, id FROM labels").fetchall())
+
+    def put_label(self, label):
+        """
+        Insert or update label (entity or json) in the index.
+        """
+        self._put("labels", entity_to_json(label))
+
+    def put_task(self, task):
+        """
+        Insert or update task (entity or json) in the index.
+        """
+        self._put("tasks", entity_to_json(task))
+
+    def _put(self, table, entity_json):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO " + table + " VALUES (?, ?, ?, ?)",
+                (entity_json[ID], entity_json[NAME], fingerprint(entity_json), json.dumps(entity_json)),
+            )
+
+    def link(self, task_id, label_id):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR IGNORE INTO task_labels VALUES (?, ?)", (task_id, label_id))
+
+    def unlink(self, task_id, label_id):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM task_labels WHERE task_id = ? AND label_id = ?", (task_id, label_id))
+
+    def remove_label(self, label_id):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM labels WHERE id = ?", (label_id,))
+            self.connection.execute("DELETE FROM task_labels WHERE label_id = ?", (label_id,))
+
+    def remove_task(self, task_id):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+            self.connection.execute("DELETE FROM task_labels WHERE task_id = ?", (task_id,))